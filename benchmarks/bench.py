@@ -0,0 +1,250 @@
+"""
+benchmarks of detection, matching and composition over synthetic inputs of growing size.
+results are written as json, and can be compared with results of another run (e.g. before an upgrade):
+
+usage: python benchmarks/bench.py out.json [--quick] [--compare baseline.json] [--tolerance 1.25]
+
+exit code is 1 if --compare is given and some benchmark is slower than baseline by more than tolerance, or fails
+though it succeeded in baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)  # cityfinder of this checkout, when run as a script
+
+from cityfinder import synthetic  # noqa: E402
+from cityfinder.city_detector import CityDetector  # noqa: E402
+from cityfinder.city_vector import CityVector, match, default_match_config  # noqa: E402
+from cityfinder.debug import DebugSink, NULL_SINK  # noqa: E402
+from cityfinder.gcp import GCP  # noqa: E402
+from cityfinder.geo import fit_affine  # noqa: E402
+from cityfinder.image_retriever import ImageComposer  # noqa: E402
+
+
+SIZES = {
+    'match': [20, 100, 300],
+    'find_pink_blob': [1000, 2000, 4000],
+    'choose_largest_fartest_blobs': [100, 1000, 10000],
+    'fit_affine': [10, 100, 1000],
+    'compose': [1024, 2048, 4096],
+}
+QUICK_SIZES = {name: sizes[:2] for name, sizes in SIZES.items()}
+
+
+def _stretched(cities, scale_noise):
+    """ cities stretched along y by 1 + scale_noise around their centroid - scan scale isn't uniform """
+    coords = cities.coords.copy()
+    center = coords[:, 1].mean()
+    coords[:, 1] = center + (coords[:, 1] - center) * (1 + scale_noise)
+    return CityVector({name: tuple(xy) for name, xy in zip(cities.names, coords.tolist())})
+
+
+def _match(detected, reference, config, debug=NULL_SINK):
+    """ match, [] if too few gcps to fit affine are found - failure either way """
+    try:
+        return match(detected, reference, config, debug)
+    except np.linalg.LinAlgError:
+        return []
+
+
+def _match_success(detected, reference, config):
+    """ True if match succeeds and every matched city is the true one (outliers match nothing) """
+    debug = DebugSink()
+    if not _match(detected, reference, config, debug):
+        return False
+    city_matches = [event['city_matches'] for event in debug.events if event['event'] == 'final_matches'][-1]
+    return all(city1 == city2 for city1, city2 in city_matches.items())
+
+
+def _sheet(cities, number):
+    """ number cities nearest to centroid of cities - all cities of a map sheet """
+    distances = np.linalg.norm(cities.coords - cities.coords.mean(axis=0), axis=1)
+    return cities.subset(np.argsort(distances, kind='stable')[:number])
+
+
+def bench_match(size, folder):
+    """
+    size - number of reference cities. each engine gets detection and config it's meant to solve, detected with noise:
+    vectorized - north-up sheet of 20 cities (it compares azimuths), by reference windows; similarity_search - 11 of
+    the cities, rotated; geometric_hashing - 85% of a sheet of 60 cities, rotated. plus spurious detections
+    (outliers), or non uniform scale (scale_noise). scale of detected_cities is 1000
+    """
+    reference = synthetic.random_cities(size, seed=size)
+    north_up = _sheet(reference, min(20, size * 3 // 4))
+    north_up = synthetic.detected_cities(north_up, noise=1, seed=size)
+    sparse = synthetic.detected_cities(reference, rotation=2, noise=1, subset=min(11, size), seed=size)
+    sheet = _sheet(reference, min(60, size))
+    sheet = synthetic.detected_cities(sheet, rotation=2, noise=1, subset=int(len(sheet) * .85), seed=size)
+    engines = [
+        ('vectorized', north_up, {'threshold_azimuth': 1, 'scale_range': (950, 1050), 'ratio_threshold': 1.01,
+                                  'windows': True}),
+        ('similarity_search', sparse, {'scale_range': (700, 1400)}),
+        ('geometric_hashing', sheet, {}),
+    ]
+    for outliers, scale_noise in [(0, 0), (3, 0), (0, 0.005)]:
+        for engine, true_detected, engine_config in engines:
+            detected = synthetic.with_outliers(_stretched(true_detected, scale_noise), outliers, seed=size)
+            config = default_match_config()
+            config['engine'] = engine
+            config.update(engine_config)
+            params = {'engine': engine, 'outliers': outliers, 'scale_noise': scale_noise}
+            yield params, lambda: _match(detected, reference, config), \
+                lambda: _match_success(detected, reference, config)
+
+
+def bench_find_pink_blob(size, folder):
+    """ size - width and height of raster [pixels] """
+    img, discs = synthetic.pink_blob_raster(size, size, blobs=size // 200, seed=size)
+    path = synthetic.write_raster(img, os.path.join(folder, 'pink_%d.png' % size))
+    for pyramid_level in [0, 2]:
+        config = CityDetector.default_config()
+        config['pink_blob']['pyramid_level'] = pyramid_level
+        detector = CityDetector(config=config)
+        yield {'pyramid_level': pyramid_level}, lambda: detector.find_pink_blob(path)
+
+
+def bench_choose_largest_fartest_blobs(size, folder):
+    """ size - number of blobs """
+    rng = np.random.default_rng(size)
+    points, sizes = rng.uniform(0, 10000, (size, 2)), rng.uniform(5, 100, size)
+    blobs = [cv2.KeyPoint(float(x), float(y), float(s)) for (x, y), s in zip(points.tolist(), sizes.tolist())]
+    detector = CityDetector()
+    yield {}, lambda: detector.choose_largest_fartest_blobs(blobs)
+
+
+def bench_fit_affine(size, folder):
+    """ size - number of gcps """
+    rng = np.random.default_rng(size)
+    lons, lats = rng.uniform(34, 36, size), rng.uniform(30, 33, size)
+    gcps = [GCP(lon, lat, None, '', 1000 * (lon - 34), 1000 * (lat - 30)) for lon, lat in zip(lons, lats)]
+    yield {}, lambda: fit_affine(gcps)
+
+
+def bench_compose(size, folder):
+    """ size - width and height of mosaic [pixels], of 256 pixel tiles """
+    img, discs = synthetic.pink_blob_raster(size, size, blobs=4, seed=size)
+    tiles_folder = os.path.join(folder, 'tiles')
+    id = 'mosaic_%d' % size
+    synthetic.write_tiles(img, tiles_folder, id, tilesize=256)
+    for workers in [1, None]:
+        composer = ImageComposer(folder=tiles_folder, extension='png')
+        yield {'workers': workers}, lambda: composer.compose(id, workers=workers)
+
+
+# each yields (params, func) per case of size, or (params, func, check) - check() is True if func result is correct
+BENCHMARKS = {
+    'match': bench_match,
+    'find_pink_blob': bench_find_pink_blob,
+    'choose_largest_fartest_blobs': bench_choose_largest_fartest_blobs,
+    'fit_affine': bench_fit_affine,
+    'compose': bench_compose,
+}
+
+
+def measure(func, repeat):
+    """ returns [seconds] of repeat calls, after one warm-up call """
+    func()
+    times = []
+    for idx in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run(sizes=SIZES, repeat=5, names=None):
+    """
+    returns {'meta', 'results': [{'name', 'size', 'params', 'min', 'median', 'mean', 'repeat'[, 'success']}]}.
+    success is recorded for benchmarks with check. failed case isn't timed - its time would be of the failure path -
+    so its result is only {'name', 'size', 'params', 'success'}
+    """
+    random.seed(0)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name, bench in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            for size in sizes[name]:
+                for params, func, *check in bench(size, folder):
+                    result = {'name': name, 'size': size, 'params': params}
+                    if check:
+                        result['success'] = bool(check[0]())
+                    if not result.get('success', True):
+                        print('%-30s %8d %-72s %11s' % (name, size, json.dumps(params), 'FAILED'), flush=True)
+                        results.append(result)
+                        continue
+                    times = measure(func, repeat)
+                    result.update({'repeat': repeat, 'min': min(times), 'median': float(np.median(times)),
+                                   'mean': float(np.mean(times))})
+                    print('%-30s %8d %-72s %10.4fs' % (name, size, json.dumps(params), result['min']), flush=True)
+                    results.append(result)
+    meta = {'python': platform.python_version(), 'platform': platform.platform(), 'numpy': np.__version__,
+            'opencv': cv2.__version__, 'cpu_count': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'meta': meta, 'results': results}
+
+
+def _key(result):
+    return result['name'], result['size'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline, tolerance=1.25):
+    """
+    compares min times of benchmarks present in both runs. cases failed in either run aren't compared - they have no
+    time - and a case that failed only in this run is a regression.
+    :return: [(key, baseline min, min, ratio)] of benchmarks slower than tolerance * baseline, ratio None if failed
+    """
+    baseline = {_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        old = baseline.get(_key(result))
+        if old is None:
+            continue
+        success, old_success = result.get('success', True), old.get('success', True)
+        if not (success and old_success):
+            print('%-70s %s -> %s' % (_key(result), 'ok' if old_success else 'FAILED', 'ok' if success else 'FAILED'))
+            if old_success:
+                regressions.append((_key(result), old['min'], None, None))
+            continue
+        ratio = result['min'] / old['min']
+        print('%-70s %10.4fs -> %10.4fs  x%.2f' % (_key(result), old['min'], result['min'], ratio))
+        if ratio > tolerance:
+            regressions.append((_key(result), old['min'], result['min'], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark detection, matching and composition')
+    parser.add_argument('out', help='output json path')
+    parser.add_argument('--quick', action='store_true', help='only smaller sizes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS), help='run only these benchmarks')
+    parser.add_argument('--compare', default=None, help='baseline json of previous run')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='max allowed ratio of min time to baseline')
+    args = parser.parse_args()
+
+    results = run(QUICK_SIZES if args.quick else SIZES, args.repeat, args.only)
+    with open(args.out, 'w') as out:
+        json.dump(results, out, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for key, old, new, ratio in regressions:
+            if ratio is None:
+                print('REGRESSION %s: failed' % (key,))
+            else:
+                print('REGRESSION %s: %.4fs -> %.4fs (x%.2f)' % (key, old, new, ratio))
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
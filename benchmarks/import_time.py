@@ -0,0 +1,94 @@
+"""
+import time of cityfinder modules, each in fresh interpreters, and startup time of spawn-based pool whose workers
+import the pipeline - the cost every worker process and short CLI invocation pays before doing any work.
+heavy third party modules loaded by each import are listed too.
+
+usage: python benchmarks/import_time.py [out.json] [--repeat 5] [--workers 4] [--compare baseline.json]
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+
+MODULES = ['cityfinder.city_vector', 'cityfinder.city_detector', 'cityfinder.gazetteer', 'cityfinder.cache',
+           'cityfinder.pipeline']
+HEAVY = ['cv2', 'pyproj', 'shapely', 'PIL', 'rasterio']
+
+_CHILD = '''
+import sys, time, json
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps({'time': elapsed, 'heavy': [name for name in %r if name in sys.modules]}))
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module, repeat=5):
+    """ returns (min [s] of import of module in fresh interpreter, [heavy modules loaded by it]) """
+    times, heavy = [], []
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    for idx in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _CHILD % (module, HEAVY)], check=True, env=env,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        times.append(result['time'])
+        heavy = result['heavy']
+    return min(times), heavy
+
+
+def pool_startup(workers, module='cityfinder.pipeline', repeat=3):
+    """ returns min [s] of starting spawn pool of workers that import module, until all of them are ready """
+    context = multiprocessing.get_context('spawn')
+    times = []
+    for idx in range(repeat):
+        start = time.perf_counter()
+        with context.Pool(workers, initializer=importlib.import_module, initargs=(module,)) as pool:
+            pool.starmap(time.sleep, [(0.05,)] * workers, chunksize=1)  # every worker is up and initialized
+        times.append(time.perf_counter() - start - 0.05)
+    return min(times)
+
+
+def run(repeat=5, workers=4):
+    results = {}
+    for module in MODULES:
+        elapsed, heavy = import_time(module, repeat)
+        results[module] = {'time': elapsed, 'heavy': heavy}
+        print('%-30s %8.3fs  %s' % (module, elapsed, ', '.join(heavy) or '-'), flush=True)
+    if workers:
+        elapsed = pool_startup(workers)
+        results['spawn_pool_%d' % workers] = {'time': elapsed}
+        print('%-30s %8.3fs' % ('spawn pool of %d workers' % workers, elapsed), flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark import time of cityfinder')
+    parser.add_argument('out', nargs='?', default=None, help='output json path')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4, help='size of spawn pool to time, 0 - skip')
+    parser.add_argument('--compare', default=None, help='baseline json of previous run')
+    args = parser.parse_args()
+    sys.path.insert(0, ROOT)
+
+    results = run(args.repeat, args.workers)
+    if args.out is not None:
+        with open(args.out, 'w') as out:
+            json.dump(results, out, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for name, result in results.items():
+            if name in baseline:
+                ratio = result['time'] / baseline[name]['time']
+                print('%-30s %8.3fs -> %8.3fs  x%.2f' % (name, baseline[name]['time'], result['time'], ratio))
+
+
+if __name__ == '__main__':
+    main()
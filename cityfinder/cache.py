@@ -0,0 +1,191 @@
+"""
+persistent content-addressed cache of detection and matching results.
+detection is keyed by hash of image content and of detector's 'pink_blob' config, matching by hashes of detected and
+reference city vectors and of match config. so changing a matching threshold reuses cached detections, and an
+unchanged sheet costs one hash of its file. keys include package version, so a release invalidates them.
+"""
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+from affine import Affine
+
+from cityfinder.city_vector import match, default_match_config
+from cityfinder.version import __version__
+
+
+def _sha256():
+    return hashlib.sha256(__version__.encode())
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = _sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_bytes(data):
+    """ same as hash_file of file of data """
+    digest = _sha256()
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def hash_array(array):
+    digest = _sha256()
+    digest.update(str((array.shape, array.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+
+def hash_json(value):
+    return _sha256_of(json.dumps(value, sort_keys=True, default=str))
+
+
+def hash_cities(cities):
+    """ hash of names and coords of CityVector, in their order """
+    digest = _sha256()
+    digest.update(json.dumps(cities.names).encode())
+    digest.update(np.ascontiguousarray(cities.coords, dtype=np.float64).data)
+    return digest.hexdigest()
+
+
+def _sha256_of(text):
+    digest = _sha256()
+    digest.update(text.encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    json values in files folder/<namespace>/<key>.json, evicted least recently used first once total size exceeds
+    max_bytes. hits touch the file's mtime, which is the recency. writes are atomic, so the folder can be shared by
+    processes - each keeps its own size accounting, so with many processes the bound is approximate.
+    """
+    def __init__(self, folder, max_bytes=256 * 2 ** 20):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = {}  # path -> (mtime, size)
+        os.makedirs(folder, exist_ok=True)
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    self._entries[path] = (stat.st_mtime, stat.st_size)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return sum(size for mtime, size in self._entries.values())
+
+    def _path(self, namespace, key):
+        return os.path.join(self.folder, namespace, key + '.json')
+
+    def get(self, namespace, key, default=None):
+        path = self._path(namespace, key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+                self._entries.pop(path, None)
+            return default
+        stat = os.stat(path)
+        with self._lock:
+            self.hits += 1
+            self._entries[path] = (stat.st_mtime, stat.st_size)
+        return value
+
+    def put(self, namespace, key, value):
+        path = self._path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+        stat = os.stat(path)
+        with self._lock:
+            self._entries[path] = (stat.st_mtime, stat.st_size)
+            self._evict()
+
+    def memoize(self, namespace, key, func):
+        """ returns cached value of key, or computes func(), caches and returns it """
+        missing = object()
+        value = self.get(namespace, key, missing)
+        if value is missing:
+            value = func()
+            self.put(namespace, key, value)
+        return value
+
+    def _evict(self):
+        total = sum(size for mtime, size in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        for path, (mtime, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            del self._entries[path]
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            for path in self._entries:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._entries = {}
+
+
+def detection_key(detector, path=None, image=None, file_hash=None):
+    """
+    key of detection of sheet by detector's pink_blob config. sheet is identified by file_hash - hash_file of path,
+    computed if not given, so key of a prefetched sheet is same as of its path. image is hashed only if there's no path.
+    """
+    if file_hash is None:
+        file_hash = hash_file(path) if path is not None else hash_array(image)
+    return hash_json([file_hash, detector.plan.config['pink_blob']])
+
+
+def cached_find_pink_blob(cache, detector, path, image=None, file_hash=None, **kwargs):
+    """
+    detector.find_pink_blob of cached result. on hit the image isn't even decoded.
+    :param image: already decoded image of path, detected instead of reading path. path is still the key
+    :param file_hash: hash_file of path, if known (e.g. by ingest.read_image_hashed) - so path isn't read again
+    """
+    key = detection_key(detector, path, image, file_hash)
+    cities = cache.memoize('detection', key,
+                           lambda: detector.find_pink_blob(path if image is None else image, **kwargs))
+    return {name: tuple(xy) for name, xy in cities.items()}
+
+
+def matching_key(cities1, cities2, config):
+    return hash_json([hash_cities(cities1), hash_cities(cities2), config])
+
+
+def cached_match(cache, cities1, cities2, config=None, **kwargs):
+    """ city_vector.match of cached result """
+    config = config or default_match_config()
+
+    def compute():
+        result = match(cities1, cities2, config, **kwargs)
+        return [list(result[0])[:6], result[1]] if result else []
+    result = cache.memoize('match', matching_key(cities1, cities2, config), compute)
+    return (Affine(*result[0]), result[1]) if result else []
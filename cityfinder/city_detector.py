@@ -1,8 +1,14 @@
-import os
+import threading
+from copy import deepcopy
 
-import cv2
 import numpy as np
-import PIL
+
+from cityfinder.debug import DebugSink, NULL_SINK
+from cityfinder.instrumentation import NULL_PROFILER
+from cityfinder.image_retriever import VirtualMosaic
+from cityfinder.lazy import lazy_import
+
+cv2 = lazy_import('cv2')
 
 
 
@@ -23,126 +29,224 @@ city_indices = {
 
 class CityDetector:
     def __init__(self, config=None, debug_path=None):
+        """
+        :param config: compiled once to DetectionPlan, so later changes of config dict have no effect
+        :param debug_path: if given, diagnostics of all runs are written there. otherwise detector runs in
+            production mode - diagnostics are skipped, unless debug sink is passed per run.
+        """
         self.config = config or self.default_config()
+        self.plan = DetectionPlan(self.config)
         self.debug_path = debug_path
+        self.debug = DebugSink(folder=debug_path) if debug_path is not None else NULL_SINK
 
-    def find_circle_city(self, path, out_path=None, imshow=False):
-        img = cv2.imread(path, 0)
+    def _debug_sink(self, debug, out_folder=None, imshow=False):
+        if out_folder is not None or imshow:
+            return DebugSink(folder=out_folder, imshow=imshow)
+        return debug if debug is not None else self.debug
+
+    def find_circle_city(self, path, out_path=None, imshow=False, debug=None):
+        """ :param path: image path, or already loaded image array (BGR or grayscale) """
+        debug = self._debug_sink(debug, imshow=imshow)
+        img = imread(path, cv2.IMREAD_GRAYSCALE)
         # img = cv2.medianBlur(img, 5)
 
-        config = self.config['hough_circle']
-        circles = cv2.HoughCircles(img, **config)
+        circles = cv2.HoughCircles(img, **self.plan.hough_circle)
         if circles is None or circles[0] is None or len(circles[0]) == 0:
             return []
 
-        cimg = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
         circles = np.uint16(np.around(circles))
-        for i in circles[0, :]:
-            cv2.circle(cimg, (i[0], i[1]), i[2], (0, 255, 0), 2)  # draw the outer circle
-            cv2.circle(cimg, (i[0], i[1]), 2, (0, 0, 255), 3)  # draw the center of the circle
+        if debug.enabled or out_path is not None:
+            cimg = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            for i in circles[0, :]:
+                cv2.circle(cimg, (i[0], i[1]), i[2], (0, 255, 0), 2)  # draw the outer circle
+                cv2.circle(cimg, (i[0], i[1]), 2, (0, 0, 255), 3)  # draw the center of the circle
+            debug.image('detected_circles', cimg)
+            if out_path is not None:
+                cv2.imwrite(out_path, cimg)
+        return circles[0]
 
-        if imshow:
-            show_image('detected circles',cimg)
+    def find_pink_blob(self, path, out_folder=None, imshow=False, debug=None, profiler=NULL_PROFILER):
+        """
+        if config['pink_blob']['pyramid_level'] > 0, blobs are detected on image downsampled by 2**pyramid_level,
+        and their centroids are refined in small full-resolution windows. returned coordinates are always in
+        full-resolution pixels.
+        :param path: image path, or already loaded BGR image array
+        :param out_folder, imshow: shortcuts for debug=DebugSink(out_folder, imshow)
+        :param debug: diagnostics sink of this run, default - self.debug
+        :param profiler: instrumentation.Profiler to record stages of this run in, default - none are recorded
+        """
+        debug = self._debug_sink(debug, out_folder, imshow)
+        with profiler.stage('find_pink_blob'):
+            with profiler.stage('imread'):
+                img = imread(path, cv2.IMREAD_COLOR)
+            debug.image('1_rgb', img)
+            blobs, mask = self._pink_blobs(img, debug, profiler)
+            with profiler.stage('select_cities'):
+                return self._select_cities(blobs, img.shape, debug, mask, self.plan.factor)
 
-        if out_path is not None:
-            cv2.imwrite(out_path, cimg)
-        return circles[0]
+    def pink_blob_points(self, img):
+        """
+        pixel positions of blobs find_pink_blob would choose, without naming and conversion to cities coordinates.
+        :param img: BGR image array
+        :return: (n, 2) array of (x, y), largest blob first
+        """
+        blobs, _ = self._pink_blobs(img, NULL_SINK, NULL_PROFILER)
+        blobs = self.choose_largest_fartest_blobs(sorted(blobs, key=lambda k: k.size, reverse=True))
+        return np.array([blob.pt for blob in blobs], dtype=np.float64).reshape(-1, 2)
 
-    def find_pink_blob(self, path, out_folder=None, imshow=False):
-        img = cv2.imread(path)
-        if out_folder is not None:
-            cv2.imwrite(os.path.join(out_folder, '1_rgb.png'), img)
+    def _pink_blobs(self, img, debug, profiler):
+        """ returns ([cv2.KeyPoint] of all pink blobs in full-resolution pixels, closed (possibly downsampled) mask) """
+        plan = self.plan
+        factor = plan.factor
+        img_full = img
+        if factor > 1:
+            with profiler.stage('resize'):
+                img = cv2.resize(img, (img.shape[1] // factor, img.shape[0] // factor), interpolation=cv2.INTER_AREA)
 
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        os.makedirs(out_folder, exist_ok=True)
-        if imshow:
-            show_image('hsv', hsv)
-        if out_folder is not None:
-            cv2.imwrite(os.path.join(out_folder, '2_hsv.png'), hsv)
+        if debug.enabled:
+            debug.image('2_hsv', cv2.cvtColor(img, cv2.COLOR_BGR2HSV))
 
         # mask pink:
-        config = self.config['pink_blob']
-        mask = np.logical_and(config['h'][0] < hsv[:, :, :1], hsv[:, :, :1] < config['h'][1])  # TODO add threshold by config['s']
-        mask = 255 * mask.astype(np.uint8)
-        # mask = np.repeat(mask, 3, axis=2)
-        if imshow:
-            show_image('pink', mask)
-        if out_folder is not None:
-            cv2.imwrite(os.path.join(out_folder, '3_mask.png'), mask)
+        with profiler.stage('mask'):
+            mask = plan.pink_mask(img, cv2.COLOR_BGR2HSV)
+        debug.image('3_mask', mask)
 
         # morphology:
-        mask = cv2.medianBlur(mask, config['median_size'])
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((config['opening_radius'], config['opening_radius']), np.uint8))
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((config['closing_radius'], config['closing_radius']), np.uint8))
-        if out_folder is not None:
-            cv2.imwrite(os.path.join(out_folder, '4_mask_closed.png'), mask)
+        with profiler.stage('morphology'):
+            mask = plan.morphology(mask, factor)
+        debug.image('4_mask_closed', mask)
 
         # detect blobs in mask:
-        blob_params = cv2.SimpleBlobDetector_Params()  # https://docs.opencv.org/trunk/d8/da7/structcv_1_1SimpleBlobDetector_1_1Params.html
-        blob_params.filterByCircularity = False
-        blob_params.filterByConvexity = False
-        blob_params.filterByInertia = False
-        blob_params.minDistBetweenBlobs = 100  # todo config
-        blob_params.minArea = 200  # todo config
-        blob_params.maxArea = 1e10
-        # TODO adapt params, currently only finds small circular blobs: https://stackoverflow.com/questions/39083360/why-cant-i-do-blob-detection-on-this-binary-image
-        detector = cv2.SimpleBlobDetector_create(blob_params)
-        mask = cv2.bitwise_not(mask)
-        blobs = detector.detect(mask)
-        mask = cv2.bitwise_not(mask)
+        with profiler.stage('detect_blobs'):
+            blobs = plan.detect_blobs(mask, factor)
+        if factor > 1:
+            with profiler.stage('refine_blobs'):
+                blobs = self._refine_blobs(img_full, blobs, factor)
+        debug.log('detected_blobs', count=len(blobs))
+        return blobs, mask
+
+    def find_pink_blob_tiles(self, composer, id, window_tiles=4, debug=None, profiler=NULL_PROFILER):
+        """
+        same as find_pink_blob, but runs tile by tile directly on tiles of ImageComposer, without composing the mosaic.
+        each window of window_tiles x window_tiles tiles is read with halo sized to the morphology kernels, so mask of
+        window core is identical to mask of whole mosaic. pink components crossing window borders are merged.
+        memory is bounded by window size, plus one mosaic-wide row of labels and of decoded tiles (so that each tile is
+        decoded once).
+        blob size is the equivalent diameter of the component.
+        :param debug: diagnostics sink of this run, default - self.debug. no overlays are drawn in this mode.
+        :param profiler: instrumentation.Profiler to record stages of this run in. stages of windows are summed up
+        """
+        debug = debug if debug is not None else self.debug
+        plan = self.plan
+        with profiler.stage('find_pink_blob_tiles'):
+            mosaic = VirtualMosaic(composer, id)
+            h, w = mosaic.shape[:2]
+            core = window_tiles * mosaic.tilesize
+            halo = plan.halo
+            # tiles of halo are shared with next window and with next row of windows - keep tiles of a row of windows:
+            halo_tiles = -(-halo // mosaic.tilesize)
+            mosaic.cache_tiles = (-(-w // mosaic.tilesize) + 2 * halo_tiles) * (window_tiles + 4 * halo_tiles)
 
-        print('detected %d blobs' % len(blobs))
-        # for blob in blobs:
-        #     print(blob.pt, blob.size)
+            components = _TiledComponents(w)
+            for y0 in range(0, h, core):
+                left_column = None
+                for x0 in range(0, w, core):
+                    x1, y1 = min(x0 + core, w), min(y0 + core, h)
+                    hx0, hy0, hx1, hy1 = max(0, x0 - halo), max(0, y0 - halo), min(w, x1 + halo), min(h, y1 + halo)
+                    with profiler.stage('read'):
+                        window = mosaic.read(hx0, hy0, hx1 - hx0, hy1 - hy0)
+                    with profiler.stage('mask'):
+                        mask = plan.pink_mask(window, cv2.COLOR_RGB2HSV)
+                    with profiler.stage('morphology'):
+                        mask = plan.morphology(mask)
+                    mask = np.ascontiguousarray(mask[y0 - hy0: y1 - hy0, x0 - hx0: x1 - hx0])
+                    with profiler.stage('components'):
+                        left_column = components.add_window(mask, x0, y0, left_column)
+                components.next_row()
+            debug.log('windows', core=core, halo=halo, count=components.windows)
 
-        mask_with_blobs = cv2.drawKeypoints(mask, blobs, np.array([]), (0, 0, 255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
-        if imshow:
-            show_image('blobs', mask_with_blobs)
-        if out_folder is not None:
-            cv2.imwrite(os.path.join(out_folder, '5_blobs.png'), mask_with_blobs)
+            blobs = [cv2.KeyPoint(float(x), float(y), float(size)) for x, y, size in components.blobs(min_area=plan.min_area)]
+            debug.log('detected_blobs', count=len(blobs))
+            with profiler.stage('select_cities'):
+                return self._select_cities(blobs, mosaic.shape, debug)
+
+    def _select_cities(self, blobs, full_shape, debug, mask=None, factor=1):
+        """
+        chooses largest far apart blobs, names them and converts to cities coordinates.
+        :param mask: (possibly downsampled by factor) mask for debug overlays, None - no overlays
+        """
+        def mask_blobs(blobs):  # overlays are drawn on the (possibly downsampled) mask
+            if factor == 1:
+                return blobs
+            return [cv2.KeyPoint((b.pt[0] + 0.5) / factor - 0.5, (b.pt[1] + 0.5) / factor - 0.5, b.size / factor)
+                    for b in blobs]
+
+        overlays = debug.enabled and mask is not None
+        if overlays:
+            mask_with_blobs = cv2.drawKeypoints(mask, mask_blobs(blobs), np.array([]), (0, 0, 255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+            debug.image('5_blobs', mask_with_blobs)
 
         # choose largest blobs:
         blobs = sorted(blobs, key=lambda k: k.size, reverse=True)
         # largest_blobs = blobs[:config['num_blobs']]
         largest_blobs = self.choose_largest_fartest_blobs(blobs)
 
-        print('chose %d largest blobs' % len(largest_blobs))
-        mask_with_largest_blobs = cv2.drawKeypoints(mask, largest_blobs, np.array([]), (0, 0, 255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
-        w, h = mask.shape[:2]
-        print('w,h:', w, h)
-        largest_blobs = {city_indices[str(idx)]: (blob.pt[0], blob.pt[1]) for idx, blob in enumerate(largest_blobs)}
-        for idx, blob in largest_blobs.items():
-            print(str(idx))
-            print(blob)
-            x, y = blob
-            cv2.putText(mask_with_largest_blobs, str(idx), (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, 6, (0,255,0),2,cv2.LINE_AA)
-        if out_folder is not None:
-            cv2.imwrite(os.path.join(out_folder, '6_largest_blobs.png'), mask_with_largest_blobs)
+        w, h = full_shape[:2]
+        debug.log('chose_largest_blobs', count=len(largest_blobs), w=w, h=h)
+        if overlays:
+            mask_with_largest_blobs = cv2.drawKeypoints(mask, mask_blobs(largest_blobs), np.array([]), (0, 0, 255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+        largest_blobs = {city_indices.get(str(idx), str(idx)): (blob.pt[0], blob.pt[1])
+                         for idx, blob in enumerate(largest_blobs)}
+        if debug.enabled:
+            for idx, blob in largest_blobs.items():
+                debug.log('largest_blob', name=idx, pt=blob)
+                if overlays:
+                    x, y = blob
+                    cv2.putText(mask_with_largest_blobs, str(idx), (int(x / factor), int(y / factor)), cv2.FONT_HERSHEY_SIMPLEX, 6, (0,255,0),2,cv2.LINE_AA)
+            if overlays:
+                debug.image('6_largest_blobs', mask_with_largest_blobs)
 
         largest_blobs = {name: (correct_x(x, w), h - y) for name, (x, y) in largest_blobs.items()}
         return largest_blobs
 
-    def choose_largest_fartest_blobs(self, blobs):
-        def are_blobs_close(blob1, blob2):
-            dist = np.linalg.norm(np.asarray(blob1.pt) - np.asarray(blob2.pt))
-            print('dist:', dist)
-            return dist < self.config['pink_blob']['eliminate_closest_pix']
+    def _refine_blobs(self, img, blobs, factor):
+        """
+        moves blobs detected on image downsampled by factor to full-resolution img.
+        centroid of each blob is recomputed from pink mask of small full-resolution window around it.
+        """
+        plan = self.plan
+        margin = plan.closing_radius + plan.median_size + 2 * factor
+        refined = []
+        for blob in blobs:
+            x, y = (blob.pt[0] + 0.5) * factor - 0.5, (blob.pt[1] + 0.5) * factor - 0.5
+            size = blob.size * factor
+            radius = int(size / 2 + margin)
+            x0, y0 = max(0, int(x) - radius), max(0, int(y) - radius)
+            x1, y1 = min(img.shape[1], int(x) + radius + 1), min(img.shape[0], int(y) + radius + 1)
+            window = plan.morphology(plan.pink_mask(img[y0: y1, x0: x1]))
 
-        blobs = sorted(blobs, key=lambda k: k.size, reverse=True)
-        best = []
-        while len(blobs) > 0:
-            print('ITERATION')
-            best_candidate = blobs[0]
-            best.append(best_candidate)
-            blobs = [b for b in blobs if not are_blobs_close(b, best_candidate)]
-        return best
+            # take the connected component nearest to the coarse centre:
+            num, labels, stats, centroids = cv2.connectedComponentsWithStats(window)
+            if num > 1:
+                dists = np.linalg.norm(centroids[1:] - [x - x0, y - y0], axis=1)
+                label = 1 + np.argmin(dists)
+                x, y = centroids[label][0] + x0, centroids[label][1] + y0
+            refined.append(cv2.KeyPoint(float(x), float(y), float(size)))
+        return refined
+
+    def choose_largest_fartest_blobs(self, blobs):
+        """ greedy: takes largest blob, drops all blobs closer than eliminate_closest_pix to it, repeats. """
+        points = np.array([blob.pt for blob in blobs], dtype=np.float64).reshape(-1, 2)
+        sizes = np.array([blob.size for blob in blobs], dtype=np.float64)
+        chosen = suppress_close(points, sizes, self.plan.eliminate_closest_pix)
+        return [blobs[idx] for idx in chosen]
 
 
     @classmethod
     def default_config(cls):
         config = {
             'hough_circle': {
-                'method': cv2.HOUGH_GRADIENT,
+                'method': 3,  # cv2.HOUGH_GRADIENT, literal so that config doesn't import cv2
                 'dp': 1,
                 'minDist': 20,
                 'param1': 50,
@@ -152,23 +256,289 @@ class CityDetector:
             },
             'pink_blob': {
                 'h': [150, 180],
-                's': [50, 60],
+                's': [0, 255],  # inclusive saturation range. default - any
+                'mask_band_rows': 512,  # rows converted to hsv at once by fused masking
                 'median_size': 5,
                 'opening_radius': 3,
                 'closing_radius': 21,
                 'eliminate_closest_pix': 500,
+                'min_dist_between_blobs': 100,  # [pix] of SimpleBlobDetector
+                'min_area': 200,  # [pix^2] of blob
                 'num_blobs': 20,
+                'pyramid_level': 0,  # > 0 - detect on image downsampled by 2**pyramid_level, refine in full resolution
             }
         }
         return config
 
 
-def show_image(label, img):
-    cv2.imshow(label, img)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+class DetectionPlan:
+    """
+    config of CityDetector compiled once: validated parameters, morphology kernels and blob detector parameters per
+    pyramid factor. read-only after construction, so it's shared by threads - except cv2 blob detectors, which are
+    created once per thread. picklable (e.g. for worker processes) - detectors are recreated after unpickling.
+    """
+    def __init__(self, config):
+        self.config = deepcopy(config)
+        self.hough_circle = dict(config['hough_circle'])
+
+        pink = config['pink_blob']
+        self._validate(pink)
+        self.lower = np.array([pink['h'][0] + 1, pink['s'][0], 0], dtype=np.uint8)  # hue range is exclusive
+        self.upper = np.array([pink['h'][1] - 1, pink['s'][1], 255], dtype=np.uint8)
+        self.band_rows = pink.get('mask_band_rows', 512)
+        self.median_size = pink['median_size']
+        self.opening_radius = pink['opening_radius']
+        self.closing_radius = pink['closing_radius']
+        self.eliminate_closest_pix = pink['eliminate_closest_pix']
+        self.min_dist_between_blobs = pink.get('min_dist_between_blobs', 100)
+        self.min_area = pink.get('min_area', 200)
+        self.factor = 2 ** pink.get('pyramid_level', 0)
+        # halo of window in which mask of window core is identical to mask of whole image:
+        self.halo = self.median_size // 2 + 2 * (self.opening_radius // 2) + 2 * (self.closing_radius // 2) + 1
+
+        self._kernels = {factor: self._build_kernels(factor) for factor in {1, self.factor}}
+        self._detectors = threading.local()  # factor -> cv2.SimpleBlobDetector, per thread
+
+    @staticmethod
+    def _validate(pink):
+        for key in ['h', 's']:
+            low, high = pink[key]
+            if not 0 <= low <= high <= 255:
+                raise ValueError('pink_blob %s range must be 0 <= low <= high <= 255, got %s' % (key, pink[key]))
+        if pink['h'][1] - pink['h'][0] < 2:
+            raise ValueError('pink_blob h range %s is empty, hue is thresholded exclusively' % pink['h'])
+        for key in ['median_size', 'opening_radius', 'closing_radius', 'mask_band_rows']:
+            if key in pink and pink[key] < 1:
+                raise ValueError('pink_blob %s must be positive, got %s' % (key, pink[key]))
+        for key in ['eliminate_closest_pix', 'min_dist_between_blobs', 'min_area', 'pyramid_level']:
+            if key in pink and pink[key] < 0:
+                raise ValueError('pink_blob %s must be non-negative, got %s' % (key, pink[key]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_detectors']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._detectors = threading.local()
+
+    def _build_kernels(self, factor):
+        """ factor > 1 - for mask downsampled by factor, kernels are shrunk accordingly """
+        median_size = max(1, int(round(self.median_size / factor)) | 1)  # odd
+        opening_radius = max(1, int(round(self.opening_radius / factor)))
+        closing_radius = max(1, int(round(self.closing_radius / factor)))
+        return (median_size, np.ones((opening_radius, opening_radius), np.uint8),
+                np.ones((closing_radius, closing_radius), np.uint8))
+
+    def kernels(self, factor=1):
+        """ returns (median size, opening kernel, closing kernel) """
+        if factor not in self._kernels:
+            self._kernels[factor] = self._build_kernels(factor)
+        return self._kernels[factor]
+
+    def blob_params(self, factor=1):
+        """ factor > 1 - for mask downsampled by factor, area and distance limits are shrunk accordingly """
+        blob_params = cv2.SimpleBlobDetector_Params()  # https://docs.opencv.org/trunk/d8/da7/structcv_1_1SimpleBlobDetector_1_1Params.html
+        blob_params.filterByCircularity = False
+        blob_params.filterByConvexity = False
+        blob_params.filterByInertia = False
+        blob_params.minDistBetweenBlobs = self.min_dist_between_blobs / factor
+        blob_params.minArea = self.min_area / factor ** 2
+        blob_params.maxArea = 1e10
+        # TODO adapt params, currently only finds small circular blobs: https://stackoverflow.com/questions/39083360/why-cant-i-do-blob-detection-on-this-binary-image
+        return blob_params
+
+    def blob_detector(self, factor=1):
+        """ cv2.SimpleBlobDetector of this thread """
+        detectors = self._detectors.__dict__
+        if factor not in detectors:
+            detectors[factor] = cv2.SimpleBlobDetector_create(self.blob_params(factor))
+        return detectors[factor]
+
+    def pink_mask(self, img, code=None):
+        """
+        255 where h[0] < hue < h[1] and s[0] <= saturation <= s[1], 0 elsewhere.
+        fused: img is converted to hsv band of rows by band of rows into a reused buffer, and thresholded by inRange
+        directly into the mask, so the only full-size allocation is the mask. it's reused too - valid until next call
+        in the same thread.
+        :param img: (h, w, 3) uint8 image, converted to hsv by cv2 color conversion code, default - COLOR_BGR2HSV
+        """
+        code = cv2.COLOR_BGR2HSV if code is None else code
+        h, w = img.shape[:2]
+        band_rows = max(1, min(h, self.band_rows))
+        hsv = _buffer('hsv', (band_rows, w, 3))
+        mask = _buffer('mask', (h, w))
+        for y0 in range(0, h, band_rows):
+            y1 = min(y0 + band_rows, h)
+            band = hsv[:y1 - y0]
+            cv2.cvtColor(img[y0: y1], code, dst=band)
+            cv2.inRange(band, self.lower, self.upper, dst=mask[y0: y1])
+        return mask
+
+    def morphology(self, mask, factor=1):
+        """ factor > 1 - mask is downsampled by factor """
+        median_size, opening, closing = self.kernels(factor)
+        mask = cv2.medianBlur(mask, median_size)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, opening)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, closing)
+        return mask
+
+    def detect_blobs(self, mask, factor=1):
+        """ factor > 1 - mask is downsampled by factor """
+        return self.blob_detector(factor).detect(cv2.bitwise_not(mask))
+
+
+def imread(image, flags):
+    """ reads image path by cv2.imread flags, arrays are passed through (converted to grayscale if flags ask so) """
+    if isinstance(image, np.ndarray):
+        if flags == cv2.IMREAD_GRAYSCALE and image.ndim == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+    img = cv2.imread(image, flags)
+    if img is None:
+        raise IOError('failed to read image %s' % image)
+    return img
+
+
+def imdecode(data, flags, name):
+    """ decodes image file content (bytes) by cv2.imread flags, name is of error message """
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags) if len(data) else None
+    if img is None:
+        raise IOError('failed to read image %s' % name)
+    return img
+
+
+# per thread work buffers of masking, reused across calls: name -> flat uint8 array
+_buffers = threading.local()
+
+
+def _buffer(name, shape):
+    """ returns uint8 array of shape, view of a per thread buffer of name, which only grows """
+    size = int(np.prod(shape))
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or buffer.size < size:
+        buffer = np.empty(size, dtype=np.uint8)
+        setattr(_buffers, name, buffer)
+    return buffer[:size].reshape(shape)
+
+
+def suppress_close(points, sizes, radius):
+    """
+    greedy non-maximum suppression: largest first, drop anything closer than radius to it.
+    neighbours are looked up in grid hash of cell size radius, so each chosen point only checks 3x3 cells around it.
+    :param points: (n, 2) array
+    :param sizes: (n,) array, ties are kept in original order
+    :return: indices of chosen points, in descending order of size
+    """
+    order = np.argsort(-sizes, kind='stable')
+    if radius <= 0:
+        return order.tolist()
+    points = points[order]
+    cells = np.floor(points / radius).astype(np.int64)
+    unique_cells, cell_of_point = np.unique(cells, axis=0, return_inverse=True)
+    cell_of_point = cell_of_point.reshape(-1)
+    members = np.argsort(cell_of_point, kind='stable')  # points grouped by cell
+    bounds = np.searchsorted(cell_of_point[members], np.arange(len(unique_cells) + 1))
+    cell_ids = {(cx, cy): idx for idx, (cx, cy) in enumerate(unique_cells.tolist())}
+
+    suppressed = np.zeros(len(points), dtype=bool)
+    chosen = []
+    for idx in range(len(points)):
+        if suppressed[idx]:
+            continue
+        chosen.append(order[idx])
+        cx, cy = cells[idx]
+        neighbours = [members[bounds[cell]: bounds[cell + 1]]
+                      for cell in (cell_ids.get((cx + dx, cy + dy)) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+                      if cell is not None]
+        neighbours = np.concatenate(neighbours)
+        dists = np.sqrt(np.sum((points[neighbours] - points[idx]) ** 2, axis=1))
+        suppressed[neighbours[dists < radius]] = True
+    return chosen
 
 
 def correct_x(x, width):
     factor = 0.66
-    return width/2 + factor * (x - width/2)
\ No newline at end of file
+    return width/2 + factor * (x - width/2)
+
+
+class _TiledComponents:
+    """
+    connected components (8-connectivity) of a mask processed window by window in row-major order.
+    components of each window are labelled separately, and unioned with components of left and top neighbours
+    that touch them across the border. only stats (area, sum of x, sum of y) of components are kept.
+    """
+    def __init__(self, width):
+        self.bottom_row = np.zeros(width, dtype=np.int64)  # global labels of last row of previous row of windows
+        self.next_bottom_row = np.zeros(width, dtype=np.int64)
+        self.area, self.sum_x, self.sum_y = [np.zeros(1)], [np.zeros(1)], [np.zeros(1)]  # global label 0 - background
+        self.count = 1
+        self.pairs = []  # [(label, label)] to union
+        self.windows = 0
+
+    def add_window(self, mask, x0, y0, left_column):
+        """
+        :param left_column: global labels of last column of window to the left, None at start of row
+        :return: global labels of last column of this window
+        """
+        num, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        labels = labels.astype(np.int64)
+        labels[labels > 0] += self.count - 1
+        area = stats[1:, cv2.CC_STAT_AREA].astype(np.float64)
+        self.area.append(area)
+        self.sum_x.append(area * (centroids[1:, 0] + x0))
+        self.sum_y.append(area * (centroids[1:, 1] + y0))
+        self.count += num - 1
+        self.windows += 1
+
+        height, width = labels.shape
+        if left_column is not None:
+            self._connect(labels[:, 0], left_column)
+        if y0 > 0:
+            low, high = max(0, x0 - 1), min(len(self.bottom_row), x0 + width + 1)
+            padded = np.zeros(width + 2, dtype=np.int64)  # padded[1 + i] is above column x0 + i
+            padded[low - (x0 - 1): high - (x0 - 1)] = self.bottom_row[low: high]
+            for shift in (0, 1, 2):
+                self._pair(labels[0, :], padded[shift: shift + width])
+        self.next_bottom_row[x0: x0 + width] = labels[-1, :]
+        return labels[:, -1]
+
+    def _connect(self, column, left_column):
+        """ unions labels of column with 8-neighbours in left_column """
+        self._pair(column, left_column)
+        self._pair(column[1:], left_column[:-1])
+        self._pair(column[:-1], left_column[1:])
+
+    def _pair(self, labels1, labels2):
+        touching = (labels1 > 0) & (labels2 > 0)
+        if np.any(touching):
+            self.pairs.append(np.stack([labels1[touching], labels2[touching]], axis=1))
+
+    def next_row(self):
+        self.bottom_row, self.next_bottom_row = self.next_bottom_row, self.bottom_row
+
+    def blobs(self, min_area):
+        """ returns [(x, y, size)] of merged components of area >= min_area, size - equivalent diameter """
+        parent = np.arange(self.count)
+
+        def find(label):
+            while parent[label] != label:
+                parent[label] = parent[parent[label]]
+                label = parent[label]
+            return label
+
+        if self.pairs:
+            for label1, label2 in np.unique(np.concatenate(self.pairs), axis=0):
+                root1, root2 = find(label1), find(label2)
+                if root1 != root2:
+                    parent[max(root1, root2)] = min(root1, root2)
+        roots = np.array([find(label) for label in range(self.count)])
+
+        area = np.bincount(roots, weights=np.concatenate(self.area), minlength=self.count)
+        sum_x = np.bincount(roots, weights=np.concatenate(self.sum_x), minlength=self.count)
+        sum_y = np.bincount(roots, weights=np.concatenate(self.sum_y), minlength=self.count)
+        good = np.nonzero(area >= min_area)[0]
+        good = good[good > 0]
+        return [(sum_x[label] / area[label], sum_y[label] / area[label], 2 * np.sqrt(area[label] / np.pi))
+                for label in good]
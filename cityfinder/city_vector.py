@@ -1,47 +1,147 @@
 import itertools
-from copy import copy, deepcopy
+from types import MappingProxyType
 import operator
-import pyproj
-import shapely.geometry
-
-import cv2
-from affine import Affine
 from uuid import uuid4
 import random
 import numpy as np
 
-from cityfinder.geo import transform, p_geographic, p_utm, lonlat_to_utm, fit_affine, UTM
+from cityfinder.geo import transform_points, fit_affine, UTM, fit_affine_robust, affine_residuals, utm_proj, \
+    utm_of_gcps
+from cityfinder import geometric_hashing, similarity_search
+from cityfinder.debug import NULL_SINK
 from cityfinder.gcp import GCP
+from cityfinder.instrumentation import NULL_PROFILER
+from cityfinder.pair_index import PairIndex, expand_ranges
+from cityfinder.spatial_index import GridIndex, window_size
 
 
 class CityVector:
-    """ {city -> (x, y)}, where x,y are ideally lon,lat. in future consider radius. """
+    """
+    {city -> (x, y)}, where x,y are ideally lon,lat. in future consider radius.
+    besides the dict, keeps contiguous float64 coords array and city->index map. pairwise azimuth and distance
+    matrices are computed lazily on first use and cached until cities change (set_city / remove_city).
+    """
     def __init__(self, other=None):
         if other is not None:
             if isinstance(other, dict):
-                self.cities = other
+                cities = other
             elif isinstance(other, CityVector):
-                self.cities = other.cities
+                cities = other.cities
             else:
                 raise NotImplementedError
         else:
-            self.cities = {}
+            cities = {}
+        self._cities = dict(cities)
+        self._invalidate()
+
+    def _invalidate(self):
+        self._names = None
+        self._index = None
+        self._coords = None
+        self._azimuth_matrix = None
+        self._dist_matrix = None
+        self._pair_index = None
+        self._grid_indices = {}
+        self._triangle_indices = {}
+
+    @classmethod
+    def from_pair_index(cls, index):
+        """ CityVector of a prebuilt (e.g. loaded from disk) PairIndex, which is reused for matching. """
+        cities = cls({city: (x, y) for city, (x, y) in zip(index.names, index.coords.tolist())})
+        cities._pair_index = index
+        return cities
+
+    @property
+    def cities(self):
+        """ read-only view of {city -> (x, y)}, use set_city / remove_city to change. """
+        return MappingProxyType(self._cities)
+
+    def set_city(self, city, coords):
+        self._cities[city] = coords
+        self._invalidate()
+
+    def remove_city(self, city):
+        del self._cities[city]
+        self._invalidate()
+
+    @property
+    def names(self):
+        """ [city], in order of rows of coords """
+        if self._names is None:
+            self._names = list(self._cities)
+        return self._names
+
+    @property
+    def index(self):
+        """ {city -> row in coords} """
+        if self._index is None:
+            self._index = {city: idx for idx, city in enumerate(self.names)}
+        return self._index
+
+    @property
+    def coords(self):
+        """ (n, 2) float64 array of (x, y) """
+        if self._coords is None:
+            self._coords = np.array([self._cities[city] for city in self.names], dtype=np.float64).reshape(-1, 2)
+        return self._coords
+
+    @property
+    def azimuth_matrix(self):
+        """ (n, n) array, [i, j] is azimuth [deg] from city i to city j """
+        if self._azimuth_matrix is None:
+            self._calc_matrices()
+        return self._azimuth_matrix
+
+    @property
+    def dist_matrix(self):
+        """ (n, n) array, [i, j] is distance between city i and city j """
+        if self._dist_matrix is None:
+            self._calc_matrices()
+        return self._dist_matrix
+
+    @property
+    def pair_index(self):
+        """ PairIndex of all ordered pairs, sorted by azimuth. """
+        if self._pair_index is None:
+            self._pair_index = PairIndex.from_city_vector(self)
+        return self._pair_index
+
+    def grid_index(self, cell_size):
+        """ spatial_index.GridIndex of coords, cached per cell_size. """
+        if cell_size not in self._grid_indices:
+            self._grid_indices[cell_size] = GridIndex(self.coords, cell_size)
+        return self._grid_indices[cell_size]
+
+    def triangle_index(self, neighbours, bin_size):
+        """ geometric_hashing.TriangleHashIndex of triangles of nearest neighbours, cached per parameters. """
+        key = (neighbours, bin_size)
+        if key not in self._triangle_indices:
+            self._triangle_indices[key] = geometric_hashing.TriangleHashIndex(self, neighbours, bin_size)
+        return self._triangle_indices[key]
+
+    def subset(self, indices):
+        """ CityVector of cities of given rows of coords, in their order """
+        names = self.names
+        return CityVector({names[idx]: self._cities[names[idx]] for idx in indices})
+
+    def _calc_matrices(self):
+        x, y = self.coords[:, 0], self.coords[:, 1]
+        dx = x[np.newaxis, :] - x[:, np.newaxis]
+        dy = y[np.newaxis, :] - y[:, np.newaxis]
+        self._azimuth_matrix = np.rad2deg(np.arctan2(dy, dx))
+        self._dist_matrix = np.sqrt(dy * dy + dx * dx)
 
     def __iter__(self):
-        return iter(self.cities)
+        return iter(self._cities)
 
     def __len__(self):
-        return len(self.cities)
+        return len(self._cities)
 
     def azimuth(self, city1, city2):
-        x1, y1 = self.cities[city1]
-        x2, y2 = self.cities[city2]
-        return np.rad2deg(np.math.atan2(y2 - y1, x2 - x1))
+        return self.azimuth_matrix[self.index[city1], self.index[city2]]
 
     def dist(self, city1, city2):
-        x1, y1 = self.cities[city1]
-        x2, y2 = self.cities[city2]
-        return np.linalg.norm([y2 - y1, x2 - x1])
+        return self.dist_matrix[self.index[city1], self.index[city2]]
 
     def __getitem__(self, cities):
         """
@@ -49,74 +149,365 @@ class CityVector:
         :return: returns (azimuth, distance)
         """
         city1, city2 = cities
-        x1, y1 = self.cities[city1]
-        x2, y2 = self.cities[city2]
-        azimuth = np.rad2deg(np.math.atan2(y2 - y1, x2 - x1))
-        distance = np.linalg.norm([y2 - y1, x2 - x1])
-        return azimuth, distance
+        idx1, idx2 = self.index[city1], self.index[city2]
+        return self.azimuth_matrix[idx1, idx2], self.dist_matrix[idx1, idx2]
+
+    def transformed(self, src_crs, dst_crs):
+        """ returns CityVector with coords transformed from src_crs to dst_crs, in one vectorized call """
+        xs, ys = transform_points(self.coords[:, 0], self.coords[:, 1], src_crs, dst_crs)
+        return CityVector({city: (x, y) for city, x, y in zip(self.names, xs.tolist(), ys.tolist())})
 
     def _calc_azimuths(self):
         azimuths = {(city1, city2): self.azimuth(city1, city2)
                     for city1 in self.cities for city2 in self.cities if city1 != city2}
         return azimuths
 
-    def add_outliers(self, number):
-        cities = copy(self.cities)
+    def add_outliers(self, number, bounds=(0, 90, 0, 90), rng=random):
+        """
+        :param bounds: (x_min, x_max, y_min, y_max) of uniformly distributed outliers
+        :param rng: random.Random instance, for reproducible outliers. default - global random module
+        """
+        x_min, x_max, y_min, y_max = bounds
+        cities = dict(self.cities)
         for idx in range(number):
-            cities[str(uuid4())] = (random.uniform(0, 90), random.uniform(0, 90))
+            cities[str(uuid4())] = (rng.uniform(x_min, x_max), rng.uniform(y_min, y_max))
         return CityVector(cities)
 
 
-def match(cities1, cities2):
-    # TODO move to config:
-    THRESHOLD_AZIMUTH = 5  # [deg]
-    BINS_NUM = 20
-    RATIO_TEST_THRESHOLD = 1.5  # ratio_test above that is success (result is significant)
-    RATIO_THRESHOLD = 1.1  # keep only those that agree with best ratio up to this rel_tol
-    CANDIDATES_RATIO = 0.5
-
-    # find potential matches - those that agree on azimuth:
+def default_match_config():
+    config = {
+        'engine': 'vectorized',  # 'vectorized' - numpy arrays and sorted azimuth index, 'python' - pure python loops
+                                 # 'geometric_hashing' - voting by hashed triangles of neighbours, large references
+                                 # 'similarity_search' - similarity hypotheses of pairs verified by spatial hash, for
+                                 # sparse detections of dense references. needs scale_range
+        'threshold_azimuth': 5,  # [deg]
+        'bins_num': 20,
+        'ratio_test_threshold': 1.5,  # ratio_test above that is success (result is significant)
+        'ratio_threshold': 1.1,  # keep only those that agree with best ratio up to this rel_tol
+        'candidates_ratio': 0.5,
+        'affine_estimator': 'lstsq',  # 'lstsq' - on first 5 city matches, 'lmeds' / 'ransac' - robust, on all of them
+        'affine_threshold': None,  # max residual [m] of inlier gcp, needed by 'ransac', 'lmeds' derives it if None
+        'consensus': 'histogram',  # 'histogram' - of distance ratios of pairs agreeing on azimuth up to threshold_azimuth
+                                   # 'hough' - joint (rotation, log-scale) voting, supports rotated scans
+        'max_rotation': 180,  # [deg], hough: max rotation of scan wrt reference
+        'hough_rotation_bin': 2.5,  # [deg]
+        'hough_scale_bin': 0.05,  # [log of distance ratio]
+        'hash_neighbours': 6,  # geometric_hashing engine: triangles are formed by each city and 2 of its neighbours
+        'hash_bin': 0.03,  # geometric_hashing engine: quantization of triangle side ratios
+        'hash_rotation_bin': 5,  # geometric_hashing engine: [deg] bin of pose voting of triangle hits
+        'hash_scale_bin': 0.05,  # geometric_hashing engine: log-scale bin of pose voting of triangle hits
+        'hash_translation_bin': 0.05,  # geometric_hashing engine: translation bin of pose voting, relative to extent
+        'hash_candidates': 5,  # geometric_hashing engine: most voted poses verified
+        'search_bases': 10,  # similarity_search engine: max basis pairs of detected cities tried, longest first
+        'search_probes': 3,  # similarity_search engine: at least one of that many cities nearest to basis must fit
+        'similarity_tolerance': 0.005,  # geometric_hashing, similarity_search engines: max distance of inlier from its
+                                        # mapped position, relative to extent of detected cities. chance inliers grow
+                                        # with its square and reference density
+        'similarity_min_inliers': 4,  # geometric_hashing, similarity_search engines: min inliers of accepted match
+        'scale_range': None,  # (low, high) prior of distance ratio detected / reference, see scale_range_from_gsd.
+                              # pairs outside it are pruned before azimuth comparison. None - any scale
+        'windows': False,  # coarse-to-fine, for large references: match only windows of reference the sheet can
+                           # cover by its extent and scale_range, until one passes ratio test. needs scale_range
+        'window_min_cities': 3,  # windows of less reference cities are skipped
+        'window_min_matches': 5,  # window is accepted if it passes ratio test with at least that many city matches
+    }
+    return config
+
+
+def scale_range_from_gsd(gsd_low, gsd_high, meters_per_unit=111320.):
+    """
+    scale_range prior of match config from bounds of ground sample distance [m/pix] of scans.
+    :param meters_per_unit: [m] per unit of reference coords, default - degree of latitude. degree of longitude is
+        shorter by cos(lat), so for lon,lat reference the range should be widened accordingly
+    """
+    return meters_per_unit / gsd_high, meters_per_unit / gsd_low
+
+
+def _wrap_azimuth(azimuth):
+    """ to [-180, 180) """
+    return (azimuth + 180) % 360 - 180
+
+
+def _potential_matches_python(cities1, cities2, threshold, wrap=False, scale_range=None):
+    """
+    pure python enumeration of pairs that agree on azimuth up to threshold [deg].
+    :param wrap: compare azimuths modulo 360
+    :param scale_range: (low, high) - pairs with distance ratio outside it are skipped. None - no prior
+    :return: (pairs1, pairs2, ratios, rotations), pairs as indices, rotation - azimuth1 - azimuth2
+    """
+    index1, index2 = cities1.index, cities2.index
     potential_matches = []  # list of pairs, each pair being 2 cities: (('tlv', 'j-m'), ('tlv', 'j-m'))
+    rotations = []
     for pair1 in itertools.combinations(cities1, r=2):
         az1, dist1 = cities1[list(pair1)]
         # print(*pair1, az1, dist1)
         for pair2 in itertools.permutations(cities2, r=2):
             az2, dist2 = cities2[list(pair2)]
-            if abs(az1 - az2) < THRESHOLD_AZIMUTH:
+            if scale_range is not None and not scale_range[0] <= dist1 / dist2 <= scale_range[1]:
+                continue
+            rotation = _wrap_azimuth(az1 - az2) if wrap else az1 - az2
+            if abs(rotation) < threshold:
                 potential_matches.append((pair1, pair2))
-    print('\n\nfound %d potential matches:' % len(potential_matches))
-    print_per_line(potential_matches)
-
-    # collect distance ratios:
-    print('\n\ndistance ratios:')
-    ratios = [cities1.dist(*pair1) / cities2.dist(*pair2) for pair1, pair2 in potential_matches]
-    print_per_line(sorted(ratios))
-
+                rotations.append(rotation)
+
+    ratios = np.array([cities1.dist(*pair1) / cities2.dist(*pair2) for pair1, pair2 in potential_matches])
+    pairs1 = np.array([[index1[city] for city in pair1] for pair1, _ in potential_matches], dtype=np.intp).reshape(-1, 2)
+    pairs2 = np.array([[index2[city] for city in pair2] for _, pair2 in potential_matches], dtype=np.intp).reshape(-1, 2)
+    return pairs1, pairs2, ratios, np.array(rotations)
+
+
+def _pairs_azimuth_distance(cities, first, second):
+    """ vectorized CityVector.__getitem__ over index arrays. returns (azimuths [deg], distances). """
+    return cities.azimuth_matrix[first, second], cities.dist_matrix[first, second]
+
+
+def _potential_matches_vectorized(cities1, cities2, threshold, wrap=False, scale_range=None):
+    """
+    same as _potential_matches_python, but pairwise azimuths and distances are computed as arrays,
+    and azimuth-compatible pairs are found by range lookups in cities2.pair_index.
+    with scale_range, each pair1 also gets the range of distance-compatible pairs in the distance sorted view of the
+    index, and only the narrower of its two ranges is enumerated.
+    order of returned matches is identical to the python enumeration.
+    """
+    index = cities2.pair_index
+    first1, second1 = np.triu_indices(len(cities1), k=1)  # same order as itertools.combinations
+    az1, dist1 = _pairs_azimuth_distance(cities1, first1, second1)
+
+    # range lookup of each az1 in index. bounds are slightly widened, exact test is applied below:
+    if wrap and threshold >= 180:
+        shifts = [None]  # all pairs
+    else:
+        shifts = [0, -360, 360] if wrap else [0]  # with wrap, ranges of shifted az1 are disjoint for threshold < 180
+    azimuth_ranges = []
+    for shift in shifts:
+        if shift is None:
+            azimuth_ranges.append((np.zeros(len(az1), dtype=np.intp), np.full(len(az1), len(index), dtype=np.intp)))
+        else:
+            azimuth_ranges.append(index.azimuth_range(az1 + shift - threshold - 1e-9, az1 + shift + threshold + 1e-9))
+
+    by_azimuth = np.ones(len(az1), dtype=bool)
+    rows, cols = [], []
+    if scale_range is not None:
+        low, high = index.distance_range(dist1 / scale_range[1] * (1 - 1e-9), dist1 / scale_range[0] * (1 + 1e-9))
+        by_azimuth = sum(high - low for low, high in azimuth_ranges) <= high - low
+        distance_rows, positions = expand_ranges(low[~by_azimuth], high[~by_azimuth])
+        rows.append(np.flatnonzero(~by_azimuth)[distance_rows])
+        cols.append(index.distance_order[positions])
+    azimuth_rows = np.flatnonzero(by_azimuth)
+    for low, high in azimuth_ranges:
+        shift_rows, shift_cols = expand_ranges(low[by_azimuth], high[by_azimuth])
+        rows.append(azimuth_rows[shift_rows])
+        cols.append(shift_cols)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+    rotations = az1[rows] - index.azimuths[cols]
+    if wrap:
+        rotations = _wrap_azimuth(rotations)
+    good = np.abs(rotations) < threshold
+    if scale_range is not None:
+        ratios = dist1[rows] / index.distances[cols]
+        good &= (scale_range[0] <= ratios) & (ratios <= scale_range[1])
+    rows, cols, rotations = rows[good], cols[good], rotations[good]
+    sort = np.lexsort((index.pair_ids[cols], rows))  # python enumeration order: by pair1, then by pair2
+    rows, cols, rotations = rows[sort], cols[sort], rotations[sort]
+
+    pairs1 = np.stack([first1[rows], second1[rows]], axis=1)
+    pairs2 = np.stack([index.first[cols], index.second[cols]], axis=1)
+    ratios = dist1[rows] / index.distances[cols]
+    return pairs1, pairs2, ratios, rotations
+
+
+_ENGINES = {
+    'python': _potential_matches_python,
+    'vectorized': _potential_matches_vectorized,
+}
+
+
+def _consensus_histogram(pairs1, pairs2, ratios, rotations, config, debug):
+    """
+    histogram of log distance ratios. returns mask of matches agreeing with the densest bin, None if not significant.
+    """
     # choose cluster. currently primitive - find largest bin, validate by comparing to 3rd largest bin
-    print('\n\nfinding most dense cluster of ratios:')
-    ratios = sorted(ratios)
-    ratios = np.log(ratios)
-    min, max = np.min(ratios), np.max(ratios)
-    hist = np.histogram(ratios, bins=BINS_NUM, range=(min, max))
+    log_ratios = np.log(np.sort(ratios))
+    min, max = np.min(log_ratios), np.max(log_ratios)
+    hist = np.histogram(log_ratios, bins=config['bins_num'], range=(min, max))
     hist = {hist[1][idx]: hist[0][idx] for idx in range(len(hist[0]))}  # convert to {value->bin_size}
     hist = sorted(hist.items(), key=operator.itemgetter(1), reverse=True)
-    print_per_line(hist)
+    debug.log('ratios_histogram', hist=hist)
     ratio_test = hist[0][1] / hist[2][1]  # checking vs. 3rd and not 2nd, since peak could be split between 2 bins.
-    ratio_test_success = ratio_test > RATIO_TEST_THRESHOLD
-    print('\nratio_test: %f, success=%s' % (ratio_test, ratio_test_success))
+    ratio_test_success = ratio_test > config['ratio_test_threshold']
+    debug.log('ratio_test', ratio_test=ratio_test, success=ratio_test_success)
     if not ratio_test_success:
-        return []
+        return None
     best_ratio = np.exp(hist[0][0])
-    print('best_ratio:', best_ratio)
+    debug.log('best_ratio', best_ratio=best_ratio)
 
     # filter potential matches, keeping only those with ratio close to best ratio:
-    def ratio_good(pair1, pair2):
-        ratio = cities1.dist(*pair1) / cities2.dist(*pair2)
-        return best_ratio / RATIO_THRESHOLD < ratio < best_ratio * RATIO_THRESHOLD
-
-    matches = [p for p in potential_matches if ratio_good(*p)]
-    print('\n\nafter filtering by ratio, remained %d pairs (out of %d):' % (len(matches), len(potential_matches)))
-    print_per_line(matches)
+    return (best_ratio / config['ratio_threshold'] < ratios) & (ratios < best_ratio * config['ratio_threshold'])
+
+
+def _consensus_hough(pairs1, pairs2, ratios, rotations, config, debug):
+    """
+    joint (rotation, log-scale) voting in one pass over matches. votes are summed over 3x3 cells (peak may be split).
+    pairs vote equally for rotation and rotation + 180 (reversed reference pair), so of the peak block and its
+    antipodal block, the one whose matches assign cities more consistently is taken. it is validated by comparing to
+    best 3x3 block overlapping neither. candidates are kept per cell, so the matches of the block are read directly.
+    returns mask of them, None if not significant.
+    """
+    rotation_bin, scale_bin = config['hough_rotation_bin'], config['hough_scale_bin']
+    log_ratios = np.log(ratios)
+    rotation_cells = int(np.ceil(360 / rotation_bin))
+    rotation_idx = np.floor((rotations + 180) / rotation_bin).astype(np.intp) % rotation_cells
+    scale_idx = np.floor((log_ratios - np.min(log_ratios)) / scale_bin).astype(np.intp)
+    scale_cells = np.max(scale_idx) + 1
+    cells = rotation_idx * scale_cells + scale_idx
+
+    # accumulator, and candidates of each cell (sorted by cell, cell c is members[bounds[c]: bounds[c + 1]]):
+    votes = np.bincount(cells, minlength=rotation_cells * scale_cells).reshape(rotation_cells, scale_cells)
+    members = np.argsort(cells, kind='stable')
+    bounds = np.searchsorted(cells[members], np.arange(rotation_cells * scale_cells + 1))
+
+    padded = np.pad(np.pad(votes, ((1, 1), (0, 0)), mode='wrap'), ((0, 0), (1, 1)))  # rotation wraps around
+    block_votes = sum(padded[1 + dr: 1 + dr + rotation_cells, 1 + ds: 1 + ds + scale_cells]
+                      for dr in (-1, 0, 1) for ds in (-1, 0, 1))
+    peak_rotation, peak_scale = np.unravel_index(np.argmax(block_votes), block_votes.shape)
+    antipodal_rotation = (peak_rotation + int(round(180 / rotation_bin))) % rotation_cells
+
+    def block_matches(rotation):
+        good = np.zeros(len(ratios), dtype=bool)
+        for dr in (-1, 0, 1):
+            for ds in (-1, 0, 1):
+                if 0 <= peak_scale + ds < scale_cells:
+                    cell = ((rotation + dr) % rotation_cells) * scale_cells + peak_scale + ds
+                    good[members[bounds[cell]: bounds[cell + 1]]] = True
+        return good
+
+    def consistency(good):
+        """ sum over cities1 of votes for their most voted city2 """
+        num_cities2 = np.max(pairs2) + 1
+        assignments = (pairs1[good] * num_cities2 + pairs2[good]).ravel()
+        assignments, counts = np.unique(assignments, return_counts=True)
+        city1 = assignments // num_cities2
+        starts = np.flatnonzero(np.r_[True, city1[1:] != city1[:-1]])
+        return np.sum(np.maximum.reduceat(counts, starts)) if len(counts) else 0
+
+    good, antipodal = block_matches(peak_rotation), block_matches(antipodal_rotation)
+    if consistency(antipodal) > consistency(good):
+        good = antipodal
+
+    # best block overlapping neither peak block nor antipodal one:
+    def near(rotation):
+        rotation_dist = np.abs(np.arange(rotation_cells) - rotation)
+        rotation_dist = np.minimum(rotation_dist, rotation_cells - rotation_dist)
+        return (rotation_dist[:, np.newaxis] <= 2) & (np.abs(np.arange(scale_cells) - peak_scale)[np.newaxis, :] <= 2)
+
+    far = ~(near(peak_rotation) | near(antipodal_rotation))
+    second = np.max(block_votes[far]) if np.any(far) else 0
+    ratio_test = block_votes[peak_rotation, peak_scale] / second if second > 0 else np.inf
+    ratio_test_success = ratio_test > config['ratio_test_threshold']
+    debug.log('ratio_test', ratio_test=ratio_test, success=ratio_test_success)
+    if not ratio_test_success:
+        return None
+    debug.log('best_rotation_ratio', rotation=np.median(rotations[good]), best_ratio=np.exp(np.median(log_ratios[good])))
+    return good
+
+
+_CONSENSUS = {
+    'histogram': _consensus_histogram,
+    'hough': _consensus_hough,
+}
+
+
+def find_gcps(cities1, cities2, config=None, debug=NULL_SINK, profiler=NULL_PROFILER):
+    """
+    matches detected cities1 [pix] to reference cities2 [lon, lat].
+    :param debug: DebugSink to collect diagnostics in, default - none are computed
+    :param profiler: instrumentation.Profiler to record stages in, default - none are recorded
+    :return: [GCP] of robust city matches, None if ratio test failed
+    """
+    config = config or default_match_config()
+    with profiler.stage('find_gcps'):
+        if config.get('windows') and config.get('scale_range') is not None:
+            return _find_gcps_windowed(cities1, cities2, config, debug, profiler)
+        city_matches = _find_engine_matches(cities1, cities2, config, debug, profiler)
+        if city_matches is None:
+            return None
+        return _city_matches_to_gcps(cities1, cities2, city_matches, config)
+
+
+_SIMILARITY_ENGINES = {
+    'geometric_hashing': geometric_hashing.find_city_matches,
+    'similarity_search': similarity_search.find_city_matches,
+}
+
+
+def _find_engine_matches(cities1, cities2, config, debug, profiler):
+    if config['engine'] in _SIMILARITY_ENGINES:
+        with profiler.stage(config['engine']):
+            return _SIMILARITY_ENGINES[config['engine']](cities1, cities2, config, debug)
+    return _find_city_matches(cities1, cities2, config, debug, profiler)
+
+
+def reference_windows(cities1, cities2, scale_range, min_cities=3):
+    """
+    coarse stage: windows of reference cities2 that can contain the area of detected cities1, by extent of cities1
+    and scale_range prior. grid of cities2 is cached, its cell is extent rounded down to power of 2.
+    :return: [(bounds, CityVector of cities2 in bounds)], most populated first
+    """
+    if len(cities1) < 2 or len(cities2) == 0:
+        return []
+    size = window_size(cities1.coords, scale_range)
+    if not size > 0:
+        return []
+    grid = cities2.grid_index(2. ** np.floor(np.log2(size)))
+    return [(bounds, cities2.subset(indices)) for bounds, indices in grid.windows(size, min_cities)]
+
+
+def _find_gcps_windowed(cities1, cities2, config, debug, profiler):
+    """
+    find_gcps against reference_windows in turn. returns gcps of first window that passes ratio test with at least
+    window_min_matches city matches - a small window passes ratio test by chance more often than whole reference.
+    """
+    with profiler.stage('reference_windows'):
+        windows = reference_windows(cities1, cities2, config['scale_range'], config['window_min_cities'])
+    debug.log('reference_windows', count=len(windows))
+    for idx, (bounds, window) in enumerate(windows):
+        city_matches = _find_engine_matches(cities1, window, config, debug, profiler)
+        success = city_matches is not None and len(city_matches) >= config['window_min_matches']
+        debug.log('reference_window', idx=idx, bounds=bounds, cities=len(window), success=success)
+        if success:
+            return _city_matches_to_gcps(cities1, window, city_matches, config)
+    return None
+
+
+def _find_city_matches(cities1, cities2, config, debug, profiler=NULL_PROFILER):
+    """ pairwise matching: returns {city1 -> city2} of robust matches, None if ratio test failed """
+    if config['engine'] not in _ENGINES:
+        raise NotImplementedError('unknown engine %s' % config['engine'])
+    if config['consensus'] not in _CONSENSUS:
+        raise NotImplementedError('unknown consensus %s' % config['consensus'])
+    names1, names2 = cities1.names, cities2.names
+
+    # find potential matches - those that agree on azimuth (up to rotation, for hough):
+    if config['consensus'] == 'hough':
+        threshold, wrap = config['max_rotation'], True
+    else:
+        threshold, wrap = config['threshold_azimuth'], False
+    with profiler.stage('potential_matches'):
+        engine = _ENGINES[config['engine']]
+        pairs1, pairs2, ratios, rotations = engine(cities1, cities2, threshold, wrap, config.get('scale_range'))
+    if debug.enabled:
+        debug.log('potential_matches', count=len(ratios), matches=_pair_names(names1, names2, pairs1, pairs2))
+        debug.log('distance_ratios', ratios=sorted(ratios))
+    if len(ratios) == 0:
+        return None
+
+    with profiler.stage('consensus'):
+        good = _CONSENSUS[config['consensus']](pairs1, pairs2, ratios, rotations, config, debug)
+    if good is None:
+        return None
+    matches = _pair_names(names1, names2, pairs1[good], pairs2[good])
+    debug.log('ratio_filtered_matches', count=len(matches), out_of=len(ratios), matches=matches)
 
     # for each city, collect candidate matches:
     city_matches = {}  # city->[matching cities]
@@ -124,8 +515,7 @@ def match(cities1, cities2):
         for idx in [0, 1]:
             city_matches.setdefault(pair1[idx], [])
             city_matches[pair1[idx]].append(pair2[idx])
-    print('\n\ncity matches:')
-    print_per_line(city_matches.items())
+    debug.log('city_matches', city_matches=city_matches)
 
     # filter city matches - only leave those, where most candidate matches are identical:
     def is_city_match_robust(candidates):
@@ -133,20 +523,21 @@ def match(cities1, cities2):
         argsort = np.argsort(-counts)  # minus in order to argsort reverse (descending)
         cities = cities[argsort]
         counts = counts[argsort]
-        return cities[0] if counts[0] > CANDIDATES_RATIO * len(candidates) else None  # robust
+        return cities[0] if counts[0] > config['candidates_ratio'] * len(candidates) else None  # robust
 
     city_matches = {city: is_city_match_robust(candidates) for city, candidates in city_matches.items()}
     city_matches = {city: match for city, match in city_matches.items() if match is not None}
-    print('\n\nfinal matches:')
-    print_per_line(city_matches.items())
+    debug.log('final_matches', city_matches=city_matches)
+    return city_matches
+
 
+def _city_matches_to_gcps(cities1, cities2, city_matches, config):
     def correct_x_back(x, width):
         factor = 1 / 0.66
         return width / 2 + factor * (x - width / 2)
     # find affine:
-    # print('before hack:', city_matches)
-    city_matches = {k: v for idx, (k, v) in enumerate(list(city_matches.items())) if idx in [0, 1, 2, 3, 4]}
-    # print('after hack:', city_matches)
+    if config['affine_estimator'] == 'lstsq':  # robust estimators deal with outliers themselves
+        city_matches = {k: v for idx, (k, v) in enumerate(list(city_matches.items())) if idx in [0, 1, 2, 3, 4]}
     src = np.array([[cities2.cities[m][0] for m in city_matches.values()], [cities2.cities[m][1] for m in city_matches.values()]])
     dst = np.array([[correct_x_back(cities1.cities[m][0], 4147) for m in city_matches.keys()], [cities1.cities[m][1] for m in city_matches.keys()], [1] * len(city_matches.values())])
 
@@ -158,35 +549,48 @@ def match(cities1, cities2):
         lonlat = cities2.cities[city2]
         gcps.append(GCP(*lonlat, None, '', correct_x_back(pix[0], width=width), height - pix[1]))
 
-    # affine, _ = fit_affine(gcps, p_geographic)
-    # print('geographic:', affine)
+    return gcps
 
-    affine, _ = fit_affine(gcps, p_utm)
-    print('utm:', affine)
 
-    return affine, UTM
+def fit_gcps(gcps, config=None, proj=None):
+    """
+    fits UTM affine of gcps by config['affine_estimator'].
+    :param proj: pyproj.Proj of UTM zone, default - zone of gcps centroid (see geo.utm_of_gcps)
+    :return: (affine, residuals [m] of each gcp, inliers bool mask)
+    """
+    config = config or default_match_config()
+    proj = proj or (utm_of_gcps(gcps)[0] if gcps else utm_proj(36))
+    if config['affine_estimator'] == 'lstsq':
+        affine, _ = fit_affine(gcps, proj)
+        return affine, affine_residuals(affine, gcps, proj), np.ones(len(gcps), dtype=bool)
+    return fit_affine_robust(gcps, proj, method=config['affine_estimator'], threshold=config['affine_threshold'],
+                             seed=0)
+
+
+def match(cities1, cities2, config=None, debug=NULL_SINK, profiler=NULL_PROFILER):
+    """ returns (affine, crs) of cities1 pixels, crs - UTM zone of matched cities. [] if match failed """
+    gcps = find_gcps(cities1, cities2, config, debug, profiler)
+    if gcps is None:
+        return []
+
+    with profiler.stage('fit_gcps'):
+        proj, crs = utm_of_gcps(gcps) if gcps else (utm_proj(36), UTM)
+        affine, residuals, inliers = fit_gcps(gcps, config, proj)
+    debug.log('affine', crs=crs, affine=affine, residuals=residuals, inliers=inliers)
 
+    return affine, crs
 
-israel = CityVector({
-                     'tlv': (34.777303, 32.076025),
-                     'j-m': (35.207415, 31.768136),
-                     'haifa': (34.997550, 32.804523),
-                     'tiberias': (35.533599, 32.793664),
-                     # 'beersheba': (34.790372, 31.249257),
-                     'nazareth': (35.297864, 32.701897),
-                     'gaza': (34.462414, 31.506374),
-                     # 'hebron': (35.101843, 31.532422),
-                     'aman': (35.927025, 31.962766),
-                     'nablus': (35.251627, 32.226124),
-                     'kiryat shmona': (35.570337, 33.210001),
-                     'kiryat gat': (34.771532, 31.609439),
-                     'netania': (34.850431, 32.311543),
-                     # 'eilat': (34.945825, 29.553369)
-                     })
 
-israel_utm = CityVector({city: lonlat_to_utm(*coords) for city, coords in israel.cities.items()})
+def __getattr__(name):
+    """ israel, israel_utm - built-in gazetteer of israel (lon,lat / its UTM zone), loaded on first use """
+    from cityfinder import gazetteer  # it imports CityVector from here
+    if name == 'israel':
+        return gazetteer.get('israel').cities
+    if name == 'israel_utm':
+        return gazetteer.get('israel').projected
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
-def print_per_line(arr):
-    print('\n'.join([str(m) for m in arr]))
-    
+def _pair_names(names1, names2, pairs1, pairs2):
+    """ converts index pairs back to [((city1, city2), (city1, city2))] """
+    return [((names1[a1], names1[b1]), (names2[a2], names2[b2])) for (a1, b1), (a2, b2) in zip(pairs1, pairs2)]
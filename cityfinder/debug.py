@@ -0,0 +1,55 @@
+import logging
+import os
+
+from cityfinder.lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+
+
+logger = logging.getLogger('cityfinder')
+
+
+class DebugSink:
+    """
+    diagnostics of a single run: intermediate images are written to folder (and/or shown),
+    events are kept as structured records and logged to 'cityfinder' logger at debug level.
+    code building diagnostics should check `enabled` first, so that with NULL_SINK nothing is computed.
+    """
+    enabled = True
+
+    def __init__(self, folder=None, imshow=False):
+        self.folder = folder
+        self.imshow = imshow
+        self.events = []  # [{'event': name, **fields}]
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    def image(self, name, img):
+        if self.imshow:
+            show_image(name, img)
+        if self.folder is not None:
+            cv2.imwrite(os.path.join(self.folder, name + '.png'), img)
+
+    def log(self, event, **fields):
+        self.events.append(dict(event=event, **fields))
+        logger.debug('%s: %s', event, fields)
+
+
+class NullSink:
+    """ production mode - diagnostics are skipped. """
+    enabled = False
+
+    def image(self, name, img):
+        pass
+
+    def log(self, event, **fields):
+        pass
+
+
+NULL_SINK = NullSink()
+
+
+def show_image(label, img):
+    cv2.imshow(label, img)
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
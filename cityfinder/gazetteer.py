@@ -0,0 +1,128 @@
+"""
+registry of reference gazetteers - CityVectors of cities [lon, lat] per region, loaded from csv (name,lon,lat) on
+first use. built-in ones are listed in gazetteers/index.json of the package, others are added by register().
+each region is projected to its own UTM zone, projected vectors are cached too.
+"""
+import csv
+import json
+import os
+
+from cityfinder.city_vector import CityVector
+from cityfinder.geo import geographic_proj, utm_zone, utm_proj, utm_crs
+
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteers')
+
+
+class Gazetteer:
+    def __init__(self, name, path, bounds=None):
+        """
+        :param path: csv with header name,lon,lat
+        :param bounds: (lon_min, lon_max, lat_min, lat_max), for region lookup without loading. default - of cities
+        """
+        self.name = name
+        self.path = path
+        self._bounds = tuple(bounds) if bounds is not None else None
+        self._cities = None
+        self._projected = None
+
+    def __repr__(self):
+        return 'Gazetteer(%r, %r)' % (self.name, self.path)
+
+    @property
+    def cities(self):
+        """ CityVector of {city -> (lon, lat)} """
+        if self._cities is None:
+            with open(self.path, newline='') as f:
+                self._cities = CityVector({row['name']: (float(row['lon']), float(row['lat']))
+                                           for row in csv.DictReader(f)})
+        return self._cities
+
+    @property
+    def bounds(self):
+        """ (lon_min, lon_max, lat_min, lat_max) """
+        if self._bounds is None:
+            (lon_min, lat_min), (lon_max, lat_max) = self.cities.coords.min(axis=0), self.cities.coords.max(axis=0)
+            self._bounds = (float(lon_min), float(lon_max), float(lat_min), float(lat_max))
+        return self._bounds
+
+    @property
+    def zone(self):
+        """ (zone number, north) of UTM zone of centre of bounds """
+        lon_min, lon_max, lat_min, lat_max = self.bounds
+        return utm_zone((lon_min + lon_max) / 2, (lat_min + lat_max) / 2)
+
+    @property
+    def proj(self):
+        return utm_proj(*self.zone)
+
+    @property
+    def crs(self):
+        return utm_crs(*self.zone)
+
+    @property
+    def projected(self):
+        """ CityVector of {city -> (x, y)} in UTM zone of the region """
+        if self._projected is None:
+            self._projected = self.cities.transformed(geographic_proj(), self.proj)
+        return self._projected
+
+    def intersects(self, bounds, margin=0.):
+        """ :param bounds: (lon_min, lon_max, lat_min, lat_max), margin [deg] is added around region """
+        lon_min, lon_max, lat_min, lat_max = self.bounds
+        return (bounds[0] <= lon_max + margin and lon_min - margin <= bounds[1] and
+                bounds[2] <= lat_max + margin and lat_min - margin <= bounds[3])
+
+
+_registry = {}  # name -> Gazetteer
+_builtins_loaded = False
+
+
+def _load_builtins():
+    global _builtins_loaded
+    if _builtins_loaded:
+        return
+    _builtins_loaded = True
+    with open(os.path.join(DATA_FOLDER, 'index.json')) as f:
+        index = json.load(f)
+    for name, entry in index.items():
+        _registry.setdefault(name, Gazetteer(name, os.path.join(DATA_FOLDER, entry['file']), entry.get('bounds')))
+
+
+def register(name, path, bounds=None):
+    """ adds (or replaces) gazetteer of region name, see Gazetteer. returns it """
+    _load_builtins()
+    _registry[name] = Gazetteer(name, path, bounds)
+    return _registry[name]
+
+
+def get(name):
+    _load_builtins()
+    if name not in _registry:
+        raise KeyError('unknown gazetteer %s, registered: %s' % (name, ', '.join(sorted(_registry))))
+    return _registry[name]
+
+
+def regions():
+    """ names of registered gazetteers """
+    _load_builtins()
+    return list(_registry)
+
+
+def candidates(hint=None, margin=1.):
+    """
+    gazetteers relevant for a sheet, by coarse hint of its location. only bounds are checked, nothing is loaded.
+    :param hint: None - all, region name or [names], (lon, lat) point, or (lon_min, lon_max, lat_min, lat_max)
+    :param margin: [deg] around regions, for point and bounds hints
+    :return: [Gazetteer]
+    """
+    _load_builtins()
+    if hint is None:
+        return list(_registry.values())
+    if isinstance(hint, str):
+        return [get(hint)]
+    if all(isinstance(name, str) for name in hint):
+        return [get(name) for name in hint]
+    if len(hint) == 2:
+        hint = (hint[0], hint[0], hint[1], hint[1])
+    return [gazetteer for gazetteer in _registry.values() if gazetteer.intersects(hint, margin)]
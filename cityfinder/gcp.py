@@ -3,8 +3,6 @@ import json
 
 from affine import Affine
 
-import shapely.geometry
-
 
 class GCPError(Exception):
     pass
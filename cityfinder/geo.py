@@ -1,50 +1,124 @@
-import shapely
-import shapely.ops, shapely.geometry
-import pyproj
+import functools
+import itertools
+
 from affine import Affine
 
 import numpy as np
 
+from cityfinder.lazy import lazy_import
+
+pyproj = lazy_import('pyproj')
+shapely_geometry = lazy_import('shapely.geometry')
+shapely_ops = lazy_import('shapely.ops')
+
 
-p_geographic = pyproj.Proj(proj='latlong', datum='WGS84')
-p_utm = pyproj.Proj(proj='utm', zone=36, datum='WGS84')
 GEOGRAPHIC = {'init': 'EPSG:4326'}
 UTM = {'init': 'EPSG:32636'}
 
 
+def __getattr__(name):
+    """ p_geographic, p_utm (default zone, of israel. see utm_zone for others) - pyproj.Proj, created on first use """
+    if name == 'p_geographic':
+        return geographic_proj()
+    if name == 'p_utm':
+        return utm_proj(36, True)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+@functools.lru_cache(maxsize=None)
+def geographic_proj():
+    """ returns cached pyproj.Proj of WGS84 lon, lat """
+    return pyproj.Proj(proj='latlong', datum='WGS84')
+
+
+def utm_zone(lon, lat):
+    """ returns (zone number, north) of UTM zone of lon, lat [deg]. norway and svalbard exceptions are ignored. """
+    return int((lon + 180) // 6) % 60 + 1, lat >= 0
+
+
+_utm_projs = {}  # (zone, north) -> pyproj.Proj
+
+
+def utm_proj(zone, north=True):
+    """ returns cached pyproj.Proj of UTM zone """
+    if (zone, north) not in _utm_projs:
+        _utm_projs[zone, north] = pyproj.Proj(proj='utm', zone=zone, south=not north, datum='WGS84')
+    return _utm_projs[zone, north]
+
+
+def utm_crs(zone, north=True):
+    """ returns crs dict of UTM zone, e.g. {'init': 'EPSG:32636'} """
+    return {'init': 'EPSG:%d' % ((32600 if north else 32700) + zone)}
+
+
+def utm_of_gcps(gcps):
+    """ returns (pyproj.Proj, crs dict) of UTM zone of centroid of gcps lon, lat """
+    zone, north = utm_zone(np.mean([gcp.lon for gcp in gcps]), np.mean([gcp.lat for gcp in gcps]))
+    return utm_proj(zone, north), utm_crs(zone, north)
+
+
+_transformers = {}  # (src key, dst key) -> pyproj.Transformer
+
+
+def _crs_key(crs):
+    """ hashable key of crs given as pyproj.Proj, dict, string, epsg code or pyproj.CRS """
+    if isinstance(crs, pyproj.Proj):
+        return 'proj', crs.srs
+    if isinstance(crs, dict):
+        return 'dict', tuple(sorted(crs.items()))
+    return 'crs', crs
+
+
+def get_transformer(src_crs, dst_crs):
+    """ returns cached pyproj.Transformer from src_crs to dst_crs, axis order is always x,y (lon,lat) """
+    key = (_crs_key(src_crs), _crs_key(dst_crs))
+    if key not in _transformers:
+        src = src_crs.crs if isinstance(src_crs, pyproj.Proj) else pyproj.CRS.from_user_input(src_crs)
+        dst = dst_crs.crs if isinstance(dst_crs, pyproj.Proj) else pyproj.CRS.from_user_input(dst_crs)
+        _transformers[key] = pyproj.Transformer.from_crs(src, dst, always_xy=True)
+    return _transformers[key]
+
+
+def transform_points(xs, ys, src_crs, dst_crs):
+    """ transforms N points in one vectorized call. returns (xs, ys) arrays. """
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    if _crs_key(src_crs) == _crs_key(dst_crs):
+        return xs.copy(), ys.copy()
+    return get_transformer(src_crs, dst_crs).transform(xs, ys)
+
+
 def transform(geom, src_crs, dest_crs, src_affine=None, dst_affine=None):
     """
     Transform a shapely geometry from src_crs to dest_crs.
     If affine is not None, also move to pixel coordinates.
     """
     if src_affine is not None:
-        geom = shapely.ops.transform(lambda r, q: ~src_affine * (r, q), geom)
+        geom = shapely_ops.transform(lambda r, q: ~src_affine * (r, q), geom)
 
     if src_crs != dest_crs:
-        original = src_crs if isinstance(src_crs, pyproj.Proj) else pyproj.Proj(src_crs)
-        destination = dest_crs if isinstance(dest_crs, pyproj.Proj) else pyproj.Proj(dest_crs)
-
-        projected = shapely.ops.transform(lambda r, q: pyproj.transform(original, destination, r, q), geom)
+        projected = shapely_ops.transform(get_transformer(src_crs, dest_crs).transform, geom)
     else:
         projected = geom
 
     if dst_affine is not None:
         if projected.type == 'Point':  # for some reason shapely.ops.transform below doesn't work for Point
             p = dst_affine * (projected.x, projected.y)
-            projected = shapely.geometry.Point(p[0], p[1])
+            projected = shapely_geometry.Point(p[0], p[1])
         else:
-            projected = shapely.ops.transform(lambda r, q: dst_affine * (r, q), projected)
+            projected = shapely_ops.transform(lambda r, q: dst_affine * (r, q), projected)
 
     return projected
 
 
-def fit_affine(gcps, crs=p_geographic):
+def fit_affine(gcps, crs=None):
+    """ :param crs: of affine, default - lon, lat """
     if len(gcps) < 3:
         raise np.linalg.linalg.LinAlgError('Too few gcps, eq.system underdetermined. ')
 
-    pts = [transform(shapely.geometry.Point(gcp.lon, gcp.lat), p_geographic, crs) for gcp in gcps]
+    crs = crs or geographic_proj()
+    xs, ys = transform_points([gcp.lon for gcp in gcps], [gcp.lat for gcp in gcps], geographic_proj(), crs)
 
-    points_world = np.array([[pt.x for pt in pts], [pt.y for pt in pts]])
+    points_world = np.array([xs, ys])
     points_image = np.array([[gcp.x for gcp in gcps], [gcp.y for gcp in gcps], [1] * len(gcps)])
     affine = np.linalg.lstsq(points_image.transpose(), points_world.transpose())
     error = np.linalg.norm(affine[1]) if affine[1] is not None else 0
@@ -53,7 +127,94 @@ def fit_affine(gcps, crs=p_geographic):
     return affine, error
 
 
+def _gcp_arrays(gcps, crs):
+    """ returns (image points (n, 3) of [x, y, 1], world points (n, 2) in crs) """
+    crs = crs or geographic_proj()
+    xs, ys = transform_points([gcp.lon for gcp in gcps], [gcp.lat for gcp in gcps], geographic_proj(), crs)
+    points_image = np.array([[gcp.x for gcp in gcps], [gcp.y for gcp in gcps], [1] * len(gcps)], dtype=np.float64).T
+    return points_image, np.stack([xs, ys], axis=1)
+
+
+def affine_residuals(affine, gcps, crs=None):
+    """ returns residual [crs units] of each gcp: distance between affine * (x, y) and its lon,lat in crs """
+    points_image, points_world = _gcp_arrays(gcps, crs)
+    matrix = np.array([[affine.a, affine.d], [affine.b, affine.e], [affine.c, affine.f]])
+    return np.linalg.norm(points_image @ matrix - points_world, axis=1)
+
+
+def fit_affine_robust(gcps, crs=None, method='lmeds', threshold=None, confidence=0.99, max_iterations=2000,
+                      batch=200, seed=None):
+    """
+    robust affine fit: hypotheses from gcp triples are scored together (vectorized), by inliers count (ransac)
+    or by median squared residual (lmeds), then affine is refitted by least squares on inliers of the best one.
+    if all triples fit in max_iterations, all are tried, otherwise random batches until confidence is reached.
+    :param method: 'ransac' - needs threshold, 'lmeds' - threshold defaults to 2.5 robust standard deviations
+    :param threshold: max residual [crs units] of inlier
+    :return: (affine, residuals [crs units] of all gcps wrt refitted affine, inliers bool mask)
+    """
+    if len(gcps) < 3:
+        raise np.linalg.linalg.LinAlgError('Too few gcps, eq.system underdetermined. ')
+    if method not in ('ransac', 'lmeds'):
+        raise NotImplementedError('unknown method %s' % method)
+    if method == 'ransac' and threshold is None:
+        raise ValueError('ransac needs threshold')
+
+    points_image, points_world = _gcp_arrays(gcps, crs)
+    n = len(gcps)
+    rng = np.random.RandomState(seed)
+    exhaustive = n * (n - 1) * (n - 2) // 6 <= max_iterations
+
+    best_score, best_model = None, None
+    required, done = max_iterations, 0
+    while done < required:
+        if exhaustive:
+            triples = np.array(list(itertools.combinations(range(n), 3)))
+            required = len(triples)
+        else:
+            triples = np.argpartition(rng.rand(batch, n), 3, axis=1)[:, :3]
+        done += len(triples)
+
+        # solve all 3x3 systems at once, skipping degenerate (collinear) triples:
+        systems = points_image[triples]
+        good = np.abs(np.linalg.det(systems)) > 1e-9
+        if not np.any(good):
+            continue
+        models = np.linalg.solve(systems[good], points_world[triples[good]])  # (k, 3, 2)
+        residuals = np.linalg.norm(np.einsum('nj,kjd->knd', points_image, models) - points_world, axis=2)  # (k, n)
+
+        if method == 'ransac':
+            scores = -np.sum(residuals < threshold, axis=1)  # lower is better
+        else:
+            scores = np.median(residuals ** 2, axis=1)
+        idx = np.argmin(scores)
+        if best_score is None or scores[idx] < best_score:
+            best_score, best_model = scores[idx], models[idx]
+
+        if not exhaustive:  # early termination: iterations needed to draw all-inliers triple with given confidence
+            inlier_ratio = -best_score / n if method == 'ransac' else 0.5
+            if inlier_ratio >= 1:
+                break
+            if inlier_ratio > 0:
+                required = min(max_iterations, int(np.ceil(np.log(1 - confidence) / np.log(1 - inlier_ratio ** 3))))
+
+    if best_model is None:
+        raise np.linalg.linalg.LinAlgError('All gcp triples are degenerate. ')
+
+    residuals = np.linalg.norm(points_image @ best_model - points_world, axis=1)
+    if threshold is None:  # lmeds robust standard deviation, Rousseeuw & Leroy
+        sigma = 1.4826 * (1 + 5 / max(n - 3, 1)) * np.sqrt(best_score)
+        # zero sigma - at least half of gcps fit exactly, they are the inliers (up to rounding of world coords):
+        threshold = 2.5 * max(sigma, 1e-9 * np.max(np.abs(points_world)))
+    inliers = residuals <= threshold
+
+    # refit on inliers:
+    model = np.linalg.lstsq(points_image[inliers], points_world[inliers], rcond=None)[0]
+    residuals = np.linalg.norm(points_image @ model - points_world, axis=1)
+    affine = Affine(*np.ravel(model.T))
+    return affine, residuals, inliers
+
+
 def lonlat_to_utm(lon, lat):
-    x, y = pyproj.transform(p_geographic, p_utm, lon, lat)
+    """ lon, lat - scalars or arrays """
+    x, y = get_transformer(geographic_proj(), utm_proj(36, True)).transform(lon, lat)
     return x, y
-
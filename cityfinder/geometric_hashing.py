@@ -0,0 +1,221 @@
+"""
+geometric hashing matcher, for large gazetteers: triangles of each reference city and 2 of its nearest neighbours are
+hashed once per reference (TriangleHashIndex, cached by CityVector.triangle_index) by similarity invariant descriptor -
+ratios of their sides and orientation. a query hashes triangles of detected cities the same way, and each lookup
+returns the reference triangles of same shape from a table of descriptor bins, whatever the size of the reference.
+every hit implies a similarity of detected to reference cities. hits vote in bins of (log scale, rotation,
+translation), and the most voted poses are refitted on their vertex correspondences and verified on all detected
+cities (similarity_search.verify).
+triangles of detected cities are found in the reference only if the detection includes most cities around them - for
+a sparse detection of a dense reference see similarity_search.
+"""
+import itertools
+
+import numpy as np
+
+from cityfinder.pair_index import expand_ranges
+from cityfinder.similarity_search import to_complex, extent, fit_similarity, verify, refine_matches
+
+_PERMUTATIONS = np.array(list(itertools.permutations(range(3))), dtype=np.intp)
+
+
+def nearest_neighbours(cities, number):
+    """
+    (n, number) indices of nearest other cities of each city, nearest first. found in grid, by radius doubled for
+    cities of less than number cities within it. number must be less than number of cities
+    """
+    coords, n = cities.coords, len(cities)
+    sides = np.ptp(coords, axis=0)
+    area = max(sides[0] * sides[1], np.max(sides) ** 2 / n)
+    radius = 2 * np.sqrt(area * number / n) or 1.  # all cities at one point - any radius
+    neighbours = np.zeros((n, number), dtype=np.intp)
+    rows = np.arange(n)
+    while len(rows):
+        grid = cities.grid_index(2. ** np.ceil(np.log2(radius)))
+        found, indices, distances = grid.within(coords[rows], radius)
+        other = rows[found] != indices
+        found, indices, distances = found[other], indices[other], distances[other]
+        order = np.lexsort((distances, found))
+        found, indices = found[order], indices[order]
+        counts = np.bincount(found, minlength=len(rows))
+        complete = np.flatnonzero(counts >= number)
+        starts = np.cumsum(counts) - counts
+        neighbours[rows[complete]] = indices[starts[complete, np.newaxis] + np.arange(number)]
+        rows = np.delete(rows, complete)
+        radius *= 2
+    return neighbours
+
+
+def triangles(cities, neighbours):
+    """ (m, 3) distinct triangles of each city and 2 of its nearest neighbours, vertices in ascending order """
+    n, number = len(cities), min(neighbours, len(cities) - 1)
+    if number < 2:
+        return np.zeros((0, 3), dtype=np.intp)
+    near = nearest_neighbours(cities, number)
+    second, third = np.triu_indices(number, k=1)
+    result = np.stack([np.repeat(np.arange(n), len(second)), near[:, second].ravel(), near[:, third].ravel()], axis=1)
+    return np.unique(np.sort(result, axis=1), axis=0)
+
+
+def describe(points, triangles):
+    """
+    descriptor of triangles (m, 3) of complex points, with vertices in that order - a, b, c sides opposite to them:
+    (a / c, b / c, counterclockwise, height over c / c)
+    """
+    first, second, third = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+    a, b, c = np.abs(second - third), np.abs(first - third), np.abs(first - second)
+    cross = np.imag(np.conj(second - first) * (third - first))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return a / c, b / c, cross > 0, np.abs(cross) / c ** 2
+
+
+def canonical(points, triangles):
+    """ triangles with vertices ordered by ascending length of opposite side """
+    first, second, third = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+    opposite = np.stack([np.abs(second - third), np.abs(first - third), np.abs(first - second)], axis=1)
+    return np.take_along_axis(triangles, np.argsort(opposite, axis=1, kind='stable'), axis=1)
+
+
+def labellings(points, triangles, slack):
+    """
+    vertex orders of triangles that are canonical up to slack (relative to longest side) - near ties of sides may be
+    ordered either way in the reference.
+    :return: (rows of triangles, (k, 3) triangles in those orders)
+    """
+    first, second, third = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+    opposite = np.stack([np.abs(second - third), np.abs(first - third), np.abs(first - second)], axis=1)
+    rows, result = [], []
+    for permutation in _PERMUTATIONS:
+        a, b, c = opposite[:, permutation].T
+        near = np.flatnonzero((a <= b + slack * c) & (b <= c + slack * c))
+        rows.append(near)
+        result.append(triangles[near][:, permutation])
+    return np.concatenate(rows), np.concatenate(result)
+
+
+class TriangleHashIndex:
+    """
+    canonical triangles of reference cities, sorted by bin of their descriptor (describe). triangles of bin key are
+    triangles[starts[key]: starts[key + 1]], so a lookup costs the same for any number of cities.
+    built once per reference and parameters - see CityVector.triangle_index.
+    """
+    def __init__(self, cities, neighbours=6, bin_size=0.03, min_height=0.1):
+        """
+        :param neighbours: triangles are formed by each city and 2 of that many nearest neighbours
+        :param bin_size: of side ratios
+        :param min_height: triangles of lower height over longest side (relative to it) aren't hashed - their
+            orientation and ratios are unstable
+        """
+        self.bin_size = bin_size
+        self.min_height = min_height
+        self.bins = int(np.ceil(1 / bin_size)) + 1  # per ratio
+        points = to_complex(cities.coords)
+        found = canonical(points, triangles(cities, neighbours))
+        x, y, ccw, height = describe(points, found)
+        stable = height >= min_height
+        found, keys = found[stable], self._keys(np.floor(x[stable] / bin_size), np.floor(y[stable] / bin_size),
+                                                ccw[stable])
+        order = np.argsort(keys, kind='stable')
+        self.triangles = found[order]
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(keys, minlength=2 * self.bins ** 2))])
+
+    def _keys(self, x_bins, y_bins, ccw):
+        return (x_bins.astype(np.intp) * self.bins + y_bins.astype(np.intp)) * 2 + ccw
+
+    def __len__(self):
+        return len(self.triangles)
+
+    def query(self, x, y, ccw):
+        """
+        reference triangles of descriptors near (x, y, ccw) arrays - of their bin and of bins next to it towards nearer
+        sides, so that a descriptor off by up to half a bin is found.
+        :return: (rows of queries, (k, 3) triangles hit)
+        """
+        x, y = x / self.bin_size, y / self.bin_size
+        x_bins, y_bins = np.floor(x), np.floor(y)
+        x_sides, y_sides = np.where(x - x_bins < 0.5, -1, 1), np.where(y - y_bins < 0.5, -1, 1)
+        rows, keys = [], []
+        for dx, dy in [(0, 0), (x_sides, 0), (0, y_sides), (x_sides, y_sides)]:
+            x_near, y_near = x_bins + dx, y_bins + dy
+            valid = np.flatnonzero((0 <= x_near) & (x_near < self.bins) & (0 <= y_near) & (y_near < self.bins))
+            rows.append(valid)
+            keys.append(self._keys(x_near[valid], y_near[valid], ccw[valid]))
+        rows, keys = np.concatenate(rows), np.concatenate(keys)
+        query_rows, positions = expand_ranges(self.starts[keys], self.starts[keys + 1])
+        return rows[query_rows], self.triangles[positions]
+
+
+def find_city_matches(cities1, cities2, config, debug):
+    """
+    looks up triangles of cities1 in cities2.triangle_index. each hit whose third vertex agrees with the similarity of
+    its longest side (and with scale_range, if given) votes for bin of the pose of cities1. hash_candidates most voted
+    poses (by distinct triangles of cities1) are refitted on correspondences of their hits - the most frequent
+    reference city of each city1 - and verified. city of cities1 is an inlier if reference city is within
+    similarity_tolerance (relative to extent of cities1) of its mapped position. best pose is refined by
+    similarity_search.refine_matches.
+    :return: {city1 -> city2}, None if best pose has less than similarity_min_inliers inliers
+    """
+    n1 = len(cities1)
+    if n1 < 3 or len(cities2) < 3:
+        return None
+    bin_size = config['hash_bin']
+    index = cities2.triangle_index(config['hash_neighbours'], bin_size)
+    detected, reference = to_complex(cities1.coords), to_complex(cities2.coords)
+    canonical_triangles = canonical(detected, triangles(cities1, config['hash_neighbours']))
+    sources, queries = labellings(detected, canonical_triangles, bin_size)
+    x, y, ccw, height = describe(detected, queries)
+    stable = np.flatnonzero(height >= index.min_height)
+    rows, hits = index.query(x[stable], y[stable], ccw[stable])
+    sources, queries = sources[stable][rows], queries[stable][rows]
+
+    # similarity of each hit, from its longest side, must map its third vertex too:
+    longest_side = reference[hits[:, 1]] - reference[hits[:, 0]]
+    scale_rotation = longest_side / (detected[queries[:, 1]] - detected[queries[:, 0]])
+    translation = reference[hits[:, 0]] - scale_rotation * detected[queries[:, 0]]
+    good = np.abs(scale_rotation * detected[queries[:, 2]] + translation - reference[hits[:, 2]]) <= \
+        2 * bin_size * np.abs(longest_side)
+    if config.get('scale_range') is not None:
+        ratio = 1 / np.abs(scale_rotation)
+        good &= (config['scale_range'][0] <= ratio) & (ratio <= config['scale_range'][1])
+    sources, queries, hits = sources[good], queries[good], hits[good]
+    scale_rotation, translation = scale_rotation[good], translation[good]
+    if not len(hits):
+        debug.log('hash_votes', hits=0)
+        return None
+
+    # vote for poses, by bins of log scale, rotation and mapped centroid of cities1:
+    longest = extent(cities1.coords)
+    scale_bins = np.floor(np.log(np.abs(scale_rotation)) / config['hash_scale_bin'])
+    rotation_bins = np.floor(np.degrees(np.angle(scale_rotation)) % 360 / config['hash_rotation_bin'])
+    cell = config['hash_translation_bin'] * longest * np.exp((scale_bins + 0.5) * config['hash_scale_bin'])
+    centroid = scale_rotation * detected.mean() + translation
+    poses = np.stack([scale_bins, rotation_bins, np.floor(centroid.real / cell), np.floor(centroid.imag / cell)],
+                     axis=1)
+    poses, pose_of_hit = np.unique(poses, axis=0, return_inverse=True)
+    pose_of_hit = pose_of_hit.ravel()
+    voters = np.unique(np.stack([pose_of_hit, sources], axis=1), axis=0)  # each triangle of cities1 votes once
+    votes = np.bincount(voters[:, 0], minlength=len(poses))
+    candidates = np.argsort(-votes, kind='stable')[:config['hash_candidates']]
+
+    # refit each candidate on correspondences of its hits, and verify it:
+    scale_rotations, translations = [], []
+    for pose in candidates:
+        in_pose = pose_of_hit == pose
+        pairs, counts = np.unique(np.stack([queries[in_pose].ravel(), hits[in_pose].ravel()], axis=1), axis=0,
+                                  return_counts=True)
+        pairs = pairs[np.lexsort((-counts, pairs[:, 0]))]
+        pairs = pairs[np.concatenate([[True], pairs[1:, 0] != pairs[:-1, 0]])]  # most frequent of each city1
+        fitted = fit_similarity(detected[pairs[:, 0]], reference[pairs[:, 1]])
+        scale_rotations.append(fitted[0])
+        translations.append(fitted[1])
+    scale_rotations, translations = np.array(scale_rotations), np.array(translations)
+    tolerances = config['similarity_tolerance'] * np.abs(scale_rotations) * longest
+    keep, inliers, residuals = verify(cities2, detected, scale_rotations, translations, tolerances, np.arange(n1))
+    best = np.lexsort((residuals, -inliers))[0]
+    debug.log('hash_votes', hits=len(hits), poses=len(poses), votes=votes[candidates].tolist(),
+              best_inliers=int(inliers[best]))
+    min_inliers = max(3, config['similarity_min_inliers'])
+    if inliers[best] < min_inliers:
+        return None
+    return refine_matches(cities1, cities2, scale_rotations[keep[best]], translations[keep[best]],
+                          tolerances[keep[best]], min_inliers, debug)
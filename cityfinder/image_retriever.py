@@ -1,14 +1,22 @@
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from glob import glob
 import os
+import threading
 
 import numpy as np
-from PIL import Image
+
+from cityfinder.debug import logger
+from cityfinder.lazy import lazy_import
+
+Image = lazy_import('PIL.Image')
 
 
 class ImageComposer:
     def __init__(self, folder, extension='jpg'):
         self.folder = folder
         self.extension = extension
+        self._tiles = {}  # id -> {(x, y) -> path}, folder is scanned once per id
 
     def scan_folder(self, id):
         """ returns iterator to image paths """
@@ -18,27 +26,175 @@ class ImageComposer:
         parts = path[:-(1+len(self.extension))].split('_')  # from smth like 'foo/bar_x_y.jpg' extracts x, y
         return int(parts[-2]), int(parts[-1])
 
+    def tiles(self, id, refresh=False):
+        """ returns {(x, y) -> path}, cached. refresh - rescan the folder. """
+        if refresh or id not in self._tiles:
+            self._tiles[id] = {self.tile_index(path): path for path in self.scan_folder(id)}
+        return self._tiles[id]
+
     def get_size(self, id, tilesize):
         """ returns size of raster based on max{x, y} and tilesize """
-        paths = list(self.scan_folder(id))
-        max_x = np.max([self.tile_index(path)[0] for path in paths])
-        max_y = np.max([self.tile_index(path)[1] for path in paths])
+        tiles = self.tiles(id)
+        max_x = np.max([x for x, _ in tiles])
+        max_y = np.max([y for _, y in tiles])
         return max_x + tilesize, max_y + tilesize
 
-    def compose(self, id):
-        paths = list(self.scan_folder(id))
-        tile_w, tile_h = Image.open(paths[0]).size
+    def compose(self, id, workers=None, processes=False):
+        """
+        tiles are decoded in parallel and placed as they complete.
+        :param workers: pool size, default - executor's default, 1 - decode serially
+        :param processes: decode in process pool instead of thread pool
+        """
+        tiles = self.tiles(id)
+        tile_w, tile_h = Image.open(next(iter(tiles.values()))).size
         assert tile_w == tile_h
         tilesize = tile_w
-        
+
         image_w, image_h = self.get_size(id, tilesize)
-        print('w=%d, h=%d' % (image_w, image_h))
-        img = np.zeros((image_w, image_h, 3), dtype=np.uint8)
-        for path in paths:
-            tile = Image.open(path)
-            if tile.size[0] != tilesize or tile.size[1] != tilesize:
+        logger.debug('composing %s: w=%d, h=%d', id, image_w, image_h)
+        img = np.zeros((image_h, image_w, 3), dtype=np.uint8)
+        if workers == 1:
+            decoded = (((x, y), _decode_tile(path, tilesize)) for (x, y), path in tiles.items())
+            for (x, y), tile in decoded:
+                if tile is not None:
+                    img[y: y + tilesize, x: x + tilesize, :] = tile
+        else:
+            executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            with executor(workers) as pool:
+                futures = {pool.submit(_decode_tile, path, tilesize): xy for xy, path in tiles.items()}
+                for future in as_completed(futures):
+                    tile = future.result()
+                    if tile is None:
+                        continue
+                    x, y = futures[future]
+                    img[y: y + tilesize, x: x + tilesize, :] = tile
+        return Image.fromarray(img)
+
+    def compose_to_file(self, id, out_path, workers=4):
+        """
+        streaming compose: tiles are written directly into out_path in row-major strips,
+        full image is never held in memory.
+        :param out_path: '.npy' - memory-mapped (h, w, 3) uint8 array, '.tif'/'.tiff' - tiled geotiff (needs rasterio)
+        :param workers: number of threads decoding tiles ahead of the writer
+        """
+        mosaic = VirtualMosaic(self, id)
+        tilesize = mosaic.tilesize
+        ext = os.path.splitext(out_path)[1].lower()
+        if ext == '.npy':
+            out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=mosaic.shape)
+            for (x, y), tile in mosaic.iter_tiles(workers):
+                out[y: y + tilesize, x: x + tilesize, :] = tile
+            out.flush()
+            del out
+        elif ext in ('.tif', '.tiff'):
+            import rasterio
+            from rasterio.windows import Window
+            h, w = mosaic.shape[:2]
+            with rasterio.open(out_path, 'w', driver='GTiff', width=w, height=h, count=3, dtype=rasterio.uint8,
+                               tiled=True, blockxsize=256, blockysize=256) as dst:
+                for (x, y), tile in mosaic.iter_tiles(workers):
+                    dst.write(tile.transpose((2, 0, 1)), window=Window(x, y, tilesize, tilesize))
+        else:
+            raise NotImplementedError('unsupported output format %s' % ext)
+
+
+class VirtualMosaic:
+    """
+    lazy mosaic of tiles of ImageComposer folder: serves arbitrary windows, reading only tiles that overlap them.
+    pixels not covered by tiles are 0.
+    """
+    def __init__(self, composer, id, cache_tiles=16):
+        """
+        :param cache_tiles: number of decoded tiles kept for read, least recently used are dropped - overlapping
+            windows (e.g. with halo) don't decode shared tiles again
+        """
+        self.composer = composer
+        self.id = id
+        self.cache_tiles = cache_tiles
+        self._cache = OrderedDict()  # (x, y) -> tile, least recently used first
+        self._lock = threading.Lock()
+        self.tiles = composer.tiles(id)  # {(x, y) -> path}
+        tile_w, tile_h = Image.open(next(iter(self.tiles.values()))).size
+        assert tile_w == tile_h
+        self.tilesize = tile_w
+        w = max(x for x, _ in self.tiles) + self.tilesize
+        h = max(y for _, y in self.tiles) + self.tilesize
+        self.shape = (h, w, 3)
+        self.aligned = all(x % self.tilesize == 0 and y % self.tilesize == 0 for x, y in self.tiles)
+
+    def read_tile(self, x, y):
+        """ returns (tilesize, tilesize, 3) uint8 array of tile at (x, y), None if missing or of wrong size """
+        path = self.tiles.get((x, y))
+        if path is None:
+            return None
+        return _decode_tile(path, self.tilesize)
+
+    def _cached_tile(self, x, y):
+        """ read_tile through LRU cache of cache_tiles tiles """
+        with self._lock:
+            if (x, y) in self._cache:
+                self._cache.move_to_end((x, y))
+                return self._cache[x, y]
+        tile = self.read_tile(x, y)
+        with self._lock:
+            self._cache[x, y] = tile
+            while len(self._cache) > self.cache_tiles:
+                self._cache.popitem(last=False)
+        return tile
+
+    def iter_tiles(self, workers=1):
+        """
+        yields ((x, y), tile) in row-major order.
+        :param workers: > 1 - decode ahead in thread pool, at most 2 * workers tiles are held in memory
+        """
+        positions = sorted(self.tiles, key=lambda xy: (xy[1], xy[0]))
+        if workers == 1:
+            decoded = ((xy, self.read_tile(*xy)) for xy in positions)
+        else:
+            decoded = self._decode_ahead(positions, workers)
+        for xy, tile in decoded:
+            if tile is not None:
+                yield xy, tile
+
+    def _decode_ahead(self, positions, workers):
+        with ThreadPoolExecutor(workers) as pool:
+            pending = deque()
+            for xy in positions:
+                pending.append((xy, pool.submit(self.read_tile, *xy)))
+                if len(pending) >= 2 * workers:
+                    xy_done, future = pending.popleft()
+                    yield xy_done, future.result()
+            while pending:
+                xy_done, future = pending.popleft()
+                yield xy_done, future.result()
+
+    def overlapping_tiles(self, x, y, width, height):
+        """ returns [(x, y)] of tiles overlapping the window """
+        tilesize = self.tilesize
+        if self.aligned:  # direct lookup of the grid cells, no scan of all tiles
+            xs = range(max(0, x) // tilesize * tilesize, x + width, tilesize)
+            ys = range(max(0, y) // tilesize * tilesize, y + height, tilesize)
+            return [(tx, ty) for ty in ys for tx in xs if (tx, ty) in self.tiles]
+        return [(tx, ty) for tx, ty in self.tiles
+                if tx < x + width and tx + tilesize > x and ty < y + height and ty + tilesize > y]
+
+    def read(self, x, y, width, height):
+        """ returns (height, width, 3) uint8 window with top-left corner at pixel (x, y) """
+        window = np.zeros((height, width, 3), dtype=np.uint8)
+        tilesize = self.tilesize
+        for tx, ty in self.overlapping_tiles(x, y, width, height):
+            tile = self._cached_tile(tx, ty)
+            if tile is None:
                 continue
-            # assert tile.size[0] == tilesize and tile.size[1] == tilesize
-            x, y = self.tile_index(path)
-            img[x: x + tilesize, y: y + tilesize, :] = np.asarray(tile, dtype=np.uint8).transpose((1, 0, 2))
-        return Image.fromarray(img.transpose((1, 0, 2)))
\ No newline at end of file
+            x0, y0 = max(x, tx), max(y, ty)
+            x1, y1 = min(x + width, tx + tilesize), min(y + height, ty + tilesize)
+            window[y0 - y: y1 - y, x0 - x: x1 - x] = tile[y0 - ty: y1 - ty, x0 - tx: x1 - tx]
+        return window
+
+
+def _decode_tile(path, tilesize):
+    """ returns (tilesize, tilesize, 3) uint8 array, None if tile is of wrong size """
+    tile = Image.open(path)
+    if tile.size[0] != tilesize or tile.size[1] != tilesize:
+        return None
+    return np.asarray(tile.convert('RGB'), dtype=np.uint8)
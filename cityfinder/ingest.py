@@ -0,0 +1,72 @@
+"""
+streaming ingestion of scans: next images are read and decoded in background threads while current one is
+processed, so I/O overlaps compute. at most `prefetch` decoded images are held ahead of the consumer.
+
+    for path, img, error in prefetch_images(paths, prefetch=4):
+        cities = detector.find_pink_blob(img)
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from cityfinder.cache import hash_bytes
+from cityfinder.city_detector import imread, imdecode
+
+IMREAD_COLOR = 1  # cv2.IMREAD_COLOR, literal so that importing doesn't import cv2
+
+
+def read_image(path, flags=IMREAD_COLOR):
+    """ returns (path, image array, None), or (path, None, exception) if it can't be read """
+    try:
+        return path, imread(path, flags), None
+    except Exception as e:
+        return path, None, e
+
+
+def read_image_hashed(path, flags=IMREAD_COLOR):
+    """
+    read_image, and cache.hash_file of path from the same read of its file: returns (path, image array, None, hash),
+    or (path, None, exception, None) if it can't be read
+    """
+    try:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            raise IOError('failed to read image %s' % path)
+        return path, imdecode(data, flags, path), None, hash_bytes(data)
+    except Exception as e:
+        return path, None, e, None
+
+
+def prefetch_images(paths, prefetch=4, workers=2, flags=IMREAD_COLOR, reader=read_image):
+    """
+    yields (path, image, error) in order of paths, see read_image. unreadable image doesn't stop the stream.
+    :param paths: iterable of paths, consumed lazily
+    :param prefetch: max number of images read ahead of the consumer (memory bound)
+    :param workers: number of reading threads. cv2 releases GIL while decoding, so they overlap with compute
+    :param reader: reader(path, flags) of what's yielded - read_image_hashed also yields hash of file
+    """
+    prefetch = max(1, prefetch)
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(reader, path, flags))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+async def aprefetch_images(paths, prefetch=4, workers=2, flags=IMREAD_COLOR, reader=read_image):
+    """ async version of prefetch_images: async generator of (path, image, error), reading in executor threads """
+    prefetch = max(1, prefetch)
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(loop.run_in_executor(pool, reader, path, flags))
+            if len(pending) > prefetch:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
@@ -0,0 +1,168 @@
+"""
+per-stage instrumentation: wall time, cpu time and peak allocation of named stages of a run.
+
+    profiler = Profiler()
+    detector.find_pink_blob(path, profiler=profiler)
+    profiler.report.to_dict()
+
+NULL_PROFILER (default everywhere) records nothing, its stages cost a method call and an empty context.
+"""
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class StageRecord:
+    """ single run of a stage. name of nested stage is prefixed by its parents, e.g. 'find_pink_blob/morphology' """
+    __slots__ = ('name', 'wall', 'cpu', 'peak_bytes')
+
+    def __init__(self, name, wall, cpu, peak_bytes=None):
+        """
+        :param wall, cpu: [s]
+        :param peak_bytes: peak traced allocation during the stage, above allocation at its start. None - not traced
+        """
+        self.name = name
+        self.wall = wall
+        self.cpu = cpu
+        self.peak_bytes = peak_bytes
+
+    def to_dict(self):
+        return {'name': self.name, 'wall': self.wall, 'cpu': self.cpu, 'peak_bytes': self.peak_bytes}
+
+    def __repr__(self):
+        return 'StageRecord(%r, wall=%.4f, cpu=%.4f, peak_bytes=%r)' % (self.name, self.wall, self.cpu, self.peak_bytes)
+
+
+class RunReport:
+    """ stages of a single run, in order of completion (nested stages before their parent). """
+    def __init__(self, stages=None):
+        self.stages = stages if stages is not None else []
+
+    def __getitem__(self, name):
+        """ returns StageRecord of last run of stage name """
+        for stage in reversed(self.stages):
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return any(stage.name == name for stage in self.stages)
+
+    def totals(self):
+        """ {name -> total wall time [s]}, stages run several times are summed """
+        totals = {}
+        for stage in self.stages:
+            totals[stage.name] = totals.get(stage.name, 0) + stage.wall
+        return totals
+
+    def to_dict(self):
+        return {'stages': [stage.to_dict() for stage in self.stages]}
+
+
+class Profiler:
+    """
+    collects RunReport of stages entered by `with profiler.stage(name):`.
+    :param memory: trace peak allocation of each stage by tracemalloc (numpy and opencv arrays included). it slows
+        down allocation-heavy code, so it's off by default. tracing is started if not running, and stopped on close().
+    """
+    enabled = True
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.report = RunReport()
+        self._stack = []  # [[name, peak so far]] of open stages
+        self._started_tracing = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        if self._stack:
+            name = self._stack[-1][0] + '/' + name
+        frame = [name, 0]
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self._flush_peak(peak)
+            tracemalloc.reset_peak()
+            frame.append(current)
+        self._stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self._stack.pop()
+            peak_bytes = None
+            if self.memory:
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                self._flush_peak(peak)
+                tracemalloc.reset_peak()
+                peak_bytes = peak - frame[2]
+            self.report.stages.append(StageRecord(name, wall, cpu, peak_bytes))
+
+    def _flush_peak(self, peak):
+        """ peak since last reset counts for the parent stage too, before peak is reset for a child """
+        if self._stack:
+            self._stack[-1][1] = max(self._stack[-1][1], peak)
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullProfiler:
+    """ production mode - nothing is recorded. """
+    enabled = False
+    report = RunReport(stages=())
+
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def close(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class BatchStats:
+    """ aggregates RunReports of many runs (e.g. sheets of a batch) to per-stage counters. """
+    def __init__(self):
+        self._values = {}  # name -> {'wall': [], 'cpu': [], 'peak_bytes': []}
+
+    def add(self, report):
+        """ :param report: RunReport, or its to_dict() (e.g. as returned by worker process) """
+        stages = report['stages'] if isinstance(report, dict) else [stage.to_dict() for stage in report.stages]
+        for stage in stages:
+            values = self._values.setdefault(stage['name'], {'wall': [], 'cpu': [], 'peak_bytes': []})
+            for field in ['wall', 'cpu', 'peak_bytes']:
+                if stage[field] is not None:
+                    values[field].append(stage[field])
+
+    def summary(self, percentiles=(50, 95)):
+        """ returns {stage -> {'count', 'wall': {'total', 'p50', 'p95', 'max'}, 'cpu': {...}, 'peak_bytes': {...}}} """
+        summary = {}
+        for name, values in self._values.items():
+            summary[name] = {'count': len(values['wall'])}
+            for field, field_values in values.items():
+                if not field_values:
+                    continue
+                stats = {'total': float(np.sum(field_values)), 'max': float(np.max(field_values))}
+                for percentile, value in zip(percentiles, np.percentile(field_values, percentiles)):
+                    stats['p%d' % percentile] = float(value)
+                summary[name][field] = stats
+        return summary
@@ -0,0 +1,31 @@
+"""
+lazy imports of heavy dependencies (cv2, pyproj, shapely, PIL): module is imported on first attribute access, so
+importing cityfinder - in each worker of a spawn-based pool, or for a short CLI invocation - doesn't pay for the ones
+it doesn't use.
+
+    cv2 = lazy_import('cv2')
+
+attributes must not be accessed at import time (e.g. in default arguments), or the dependency is imported anyway.
+"""
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """ placeholder of module, imports it on first attribute access and takes over its namespace """
+    def __getattr__(self, attr):
+        # called only for attributes missing in __dict__, i.e. until module is loaded:
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self.__name__
+
+
+def lazy_import(name):
+    """ returns module name if already imported, LazyModule of it otherwise """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+
+_ARRAYS = ('coords', 'first', 'second', 'pair_ids', 'azimuths', 'distances', 'log_distances', 'distance_order',
+           'sorted_distances')
+
+
+class PairIndex:
+    """
+    build-once index of all ordered pairs (city1, city2) of a reference CityVector, for matching.
+    pairs are sorted by azimuth, so a query only needs range lookups on the azimuth axis. distance_order is a second,
+    distance sorted view, for range lookups on distance.
+    distances and log-distances are precomputed. can be saved to / loaded from folder of .npy files, memory mapped.
+    """
+    def __init__(self, names, coords, first, second, pair_ids, azimuths, distances, log_distances,
+                 distance_order=None, sorted_distances=None):
+        """
+        :param names: [city], rows of coords
+        :param coords: (n, 2) float64
+        :param first, second: indices of cities of each pair, sorted by azimuth
+        :param pair_ids: rank of each pair in itertools.permutations(names, r=2) order
+        :param azimuths: [deg], ascending
+        :param distances, log_distances: of each pair
+        :param distance_order: positions of pairs sorted by distance, default - computed
+        :param sorted_distances: distances[distance_order], default - computed
+        """
+        self.names = list(names)
+        self.coords = coords
+        self.first = first
+        self.second = second
+        self.pair_ids = pair_ids
+        self.azimuths = azimuths
+        self.distances = distances
+        self.log_distances = log_distances
+        self.distance_order = distance_order if distance_order is not None else np.argsort(distances, kind='stable')
+        self.sorted_distances = sorted_distances if sorted_distances is not None else distances[self.distance_order]
+
+    def __len__(self):
+        return len(self.azimuths)
+
+    @classmethod
+    def from_city_vector(cls, cities):
+        first, second = np.nonzero(~np.eye(len(cities), dtype=bool))  # same order as itertools.permutations
+        azimuths = cities.azimuth_matrix[first, second]
+        distances = cities.dist_matrix[first, second]
+        order = np.argsort(azimuths, kind='stable')
+        return cls(cities.names, cities.coords, first[order], second[order], order, azimuths[order],
+                   distances[order], np.log(distances[order]))
+
+    def azimuth_range(self, low, high):
+        """
+        :param low, high: scalars or arrays of azimuth bounds [deg]
+        :return: (start, stop) - positions of pairs with low <= azimuth <= high are start:stop
+        """
+        return np.searchsorted(self.azimuths, low, side='left'), np.searchsorted(self.azimuths, high, side='right')
+
+    def distance_range(self, low, high):
+        """
+        :param low, high: scalars or arrays of distance bounds
+        :return: (start, stop) - positions of pairs with low <= distance <= high are distance_order[start:stop]
+        """
+        return (np.searchsorted(self.sorted_distances, low, side='left'),
+                np.searchsorted(self.sorted_distances, high, side='right'))
+
+    def save(self, path):
+        """ saves to folder path, array per .npy file, so that load can memory map them """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'names.npy'), np.array(self.names, dtype=str))
+        for name in _ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        loads PairIndex saved to folder path. O(n^2) arrays are memory mapped (read-only by default), so only pages
+        that queries touch are read from disk. .npz file of older versions is read to memory.
+        """
+        if not os.path.isdir(path):
+            with np.load(path) as npz:
+                return cls(npz['names'].tolist(), npz['coords'], npz['first'], npz['second'], npz['pair_ids'],
+                           npz['azimuths'], npz['distances'], npz['log_distances'],
+                           npz['distance_order'] if 'distance_order' in npz.files else None)
+        names = np.load(os.path.join(path, 'names.npy')).tolist()
+        return cls(names, *(np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in _ARRAYS))
+
+
+def expand_ranges(low, high):
+    """ returns (rows, positions) of all positions low[row] <= position < high[row] """
+    counts = high - low
+    rows = np.repeat(np.arange(len(low)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(low, counts)
+    return rows, positions
@@ -0,0 +1,231 @@
+"""
+batch georeferencing: detection + matching of many scanned map sheets in a process pool.
+results are streamed to jsonl, one line per sheet, as soon as the sheet is done.
+
+usage: python -m cityfinder.pipeline <folder or manifest> <out.jsonl> [--processes N]
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import traceback
+
+import numpy as np
+
+from cityfinder.cache import ResultCache, cached_find_pink_blob, matching_key
+from cityfinder.city_detector import CityDetector
+from cityfinder import gazetteer
+from cityfinder.city_vector import CityVector, default_match_config, find_gcps, fit_gcps
+from cityfinder.debug import DebugSink, NULL_SINK
+from cityfinder.geo import utm_of_gcps
+from cityfinder.ingest import prefetch_images, read_image_hashed
+from cityfinder.instrumentation import BatchStats, Profiler, NULL_PROFILER
+
+
+EXTENSIONS = ('png', 'jpg', 'jpeg', 'tif', 'tiff')
+
+
+def list_sheets(source, extensions=EXTENSIONS):
+    """
+    :param source: folder of scans, or manifest - text file with path per line (empty lines and # comments skipped)
+    :return: [path]
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().rsplit('.', 1)[-1] in extensions)
+    with open(source) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def georeference_sheet(path, detector, reference, match_config=None, debug=NULL_SINK, profiler=NULL_PROFILER,
+                       image=None, cache=None, file_hash=None):
+    """
+    returns dict of affine, crs, matched gcps, their residuals [m] and inliers mask, and residual - rms of inliers.
+    :param reference: CityVector [lon, lat], or [(region name, CityVector)] - sheet is matched against each, and the
+        match of most inlier gcps is returned, with its 'region' - of lowest residual among equal ones. residual alone
+        would prefer a wrong region that happens to fit a few cities tightly
+    :param image: already decoded BGR image of path, default - path is read
+    :param cache: ResultCache of detections and matchings. detection is reused while image and detector's pink_blob
+        config are unchanged, matching - while detected cities, reference and match config are unchanged. matching
+        that fails (ValueError) is cached too, and raises again on hit
+    :param file_hash: cache.hash_file of path, if known - so path isn't read again only to be hashed
+    """
+    references = [(None, reference)] if isinstance(reference, CityVector) else reference
+    if cache is None:
+        cities = CityVector(detector.find_pink_blob(path if image is None else image, debug=debug, profiler=profiler))
+    else:
+        with profiler.stage('cache'):
+            cities = CityVector(cached_find_pink_blob(cache, detector, path, image, file_hash, debug=debug,
+                                                      profiler=profiler))
+    best, error = None, None
+    for region, cities2 in references:
+        try:
+            if cache is None:
+                result = _georeference_cities(cities, cities2, match_config, debug, profiler)
+            else:
+                key = matching_key(cities, cities2, match_config or default_match_config())
+                result = cache.memoize('georeference', key,
+                                       lambda: _failure_as_result(_georeference_cities, cities, cities2, match_config,
+                                                                  debug, profiler))
+                if 'error' in result:
+                    raise ValueError(result['error'])
+        except ValueError as e:
+            error = e
+            continue
+        if region is not None:
+            result['region'] = region
+        if best is None or _rank(result) > _rank(best):
+            best = result
+    if best is None:
+        raise error or ValueError('no reference to match')
+    return dict(path=path, **best)
+
+
+def _failure_as_result(func, *args):
+    """ func(*args), or {'error': message} if it raises ValueError - no match, which is as worth caching as a match """
+    try:
+        return func(*args)
+    except ValueError as e:
+        return {'error': str(e)}
+
+
+def _rank(result):
+    """ region choice order of georeference_sheet result, higher is better """
+    return sum(result['inliers']), -result['residual']
+
+
+def _georeference_cities(cities, reference, match_config, debug, profiler):
+    gcps = find_gcps(cities, reference, match_config, debug, profiler)
+    if gcps is None:
+        raise ValueError('ratio test failed, no significant match')
+    with profiler.stage('fit_gcps'):
+        proj, crs = utm_of_gcps(gcps)
+        affine, residuals, inliers = fit_gcps(gcps, match_config, proj)
+    return {
+        'affine': list(affine)[:6],
+        'crs': crs,
+        'gcps': [gcp.to_dict() for gcp in gcps],
+        'residuals': residuals.tolist(),
+        'inliers': inliers.tolist(),
+        'residual': float(np.sqrt(np.mean(residuals[inliers] ** 2))),
+    }
+
+
+# per worker process state, set once by _init_worker instead of pickling it with every sheet:
+_worker = {}
+
+
+def _worker_state(detector_config, match_config, reference, debug_folder, profile, cache_folder):
+    return {'detector': CityDetector(config=detector_config), 'match_config': match_config, 'reference': reference,
+            'debug_folder': debug_folder, 'profile': profile,
+            'cache': ResultCache(cache_folder) if cache_folder is not None else None}
+
+
+def _init_worker(*args):
+    _worker.update(_worker_state(*args))
+
+
+def _process_sheet(path, image=None, state=None, file_hash=None):
+    """
+    :param state: as of _worker_state, default - state of this worker process
+    :param file_hash: cache.hash_file of path, if known
+    """
+    state = state if state is not None else _worker
+    debug = NULL_SINK
+    if state['debug_folder'] is not None:
+        debug = DebugSink(folder=os.path.join(state['debug_folder'], os.path.splitext(os.path.basename(path))[0]))
+    profiler = Profiler(memory=True) if state['profile'] else NULL_PROFILER
+    try:
+        if isinstance(image, Exception):
+            raise image
+        result = georeference_sheet(path, state['detector'], state['reference'], state['match_config'], debug,
+                                    profiler, image, state['cache'], file_hash)
+    except Exception as e:
+        result = {'path': path, 'error': repr(e), 'traceback': traceback.format_exc()}
+    finally:
+        profiler.close()
+    if profiler.enabled:
+        result['profile'] = profiler.report.to_dict()
+    return result
+
+
+def _stream_sheets(paths, state, prefetch):
+    """
+    in-process: yields results of sheets, while next ones are read and decoded in background threads. with cache,
+    files are hashed there too, from the same read
+    """
+    if state['cache'] is None:
+        for path, image, error in prefetch_images(paths, prefetch=prefetch):
+            yield _process_sheet(path, error if error is not None else image, state)
+        return
+    for path, image, error, file_hash in prefetch_images(paths, prefetch=prefetch, reader=read_image_hashed):
+        yield _process_sheet(path, error if error is not None else image, state, file_hash)
+
+
+def run_batch(source, out_path, processes=None, detector_config=None, match_config=None, reference=None,
+              debug_folder=None, profile_path=None, prefetch=4, cache_folder=None, regions=None):
+    """
+    georeferences all sheets of source (see list_sheets) in pool of processes (default - cpu count).
+    with processes=1 sheets are processed in this process, and next prefetch sheets are read and decoded in background
+    threads meanwhile, so disk I/O overlaps compute.
+    failure of a sheet is written as {'path', 'error', 'traceback'} line and doesn't stop the batch.
+    :param debug_folder: if given, diagnostics of each sheet are written to its subfolder. default - production mode
+    :param profile_path: if given, stages of each sheet are profiled, and written as 'profile' of its line.
+        per-stage summary of the batch (BatchStats.summary) is written there as json
+    :param cache_folder: if given, detections and matchings are cached there (see georeference_sheet), so rerun
+        after a config change only recomputes the affected stage
+    :param reference: CityVector [lon, lat] of all sheets. default - registered gazetteers of regions
+    :param regions: hint of sheets location for gazetteer.candidates - region name(s), (lon, lat) or bounds.
+        default - all registered gazetteers
+    :return: (number of succeeded sheets, number of failed sheets)
+    """
+    paths = source if isinstance(source, (list, tuple)) else list_sheets(source)
+    if reference is None:
+        reference = [(region.name, region.cities) for region in gazetteer.candidates(regions)]
+    succeeded, failed = 0, 0
+    stats = BatchStats()
+    init_args = (detector_config, match_config, reference, debug_folder, profile_path is not None, cache_folder)
+    with contextlib.ExitStack() as stack:
+        out = stack.enter_context(open(out_path, 'w'))
+        if processes == 1:
+            results = _stream_sheets(paths, _worker_state(*init_args), prefetch)
+        else:
+            pool = stack.enter_context(multiprocessing.Pool(processes, initializer=_init_worker, initargs=init_args))
+            results = pool.imap_unordered(_process_sheet, paths)
+        for result in results:
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            if 'profile' in result:
+                stats.add(result['profile'])
+            if 'error' in result:
+                failed += 1
+            else:
+                succeeded += 1
+    if profile_path is not None:
+        with open(profile_path, 'w') as out:
+            json.dump(stats.summary(), out, indent=2)
+    return succeeded, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='georeference scanned map sheets')
+    parser.add_argument('source', help='folder of scans or manifest file with path per line')
+    parser.add_argument('out', help='output jsonl path')
+    parser.add_argument('--processes', type=int, default=None, help='pool size, default - cpu count')
+    parser.add_argument('--debug-folder', default=None, help='write per-sheet diagnostics there')
+    parser.add_argument('--profile', default=None, help='profile stages, write per-stage summary json there')
+    parser.add_argument('--prefetch', type=int, default=4, help='with --processes 1: sheets decoded ahead')
+    parser.add_argument('--cache-folder', default=None, help='cache detections and matchings there')
+    parser.add_argument('--regions', nargs='+', default=None, choices=gazetteer.regions(),
+                        help='gazetteers to match against, default - all')
+    args = parser.parse_args()
+    succeeded, failed = run_batch(args.source, args.out, processes=args.processes, debug_folder=args.debug_folder,
+                                  profile_path=args.profile, prefetch=args.prefetch, cache_folder=args.cache_folder,
+                                  regions=args.regions)
+    print('done: %d succeeded, %d failed' % (succeeded, failed))
+
+
+if __name__ == '__main__':
+    main()
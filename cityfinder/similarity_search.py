@@ -0,0 +1,170 @@
+"""
+similarity search matcher, for sparse detections (e.g. only major cities) of dense gazetteers: detected cities are
+aligned to reference by similarity hypotheses, verified by lookups in a spatial hash of reference cities
+(spatial_index.GridIndex).
+each hypothesis maps a basis pair of detected cities onto a pair of reference cities whose distance fits the
+scale_range prior. it's verified by mapping other detected cities by it and looking them up in the hash. basis cities
+needn't be neighbours in the reference - that's what geometric_hashing needs, and what a sparse detection lacks. cost
+grows with the number of reference pairs within the prior, so the prior is required.
+also shared helpers of similarity matchers: lookup of mapped points, similarity fit and final one to one matching.
+"""
+import itertools
+
+import numpy as np
+
+
+def to_complex(coords):
+    return coords[..., 0] + 1j * coords[..., 1]
+
+
+def extent(coords):
+    """ longest distance between coords (n, 2) - in O(n) as diagonal of bounding box, an upper bound """
+    return float(np.linalg.norm(np.ptp(coords, axis=0))) if len(coords) else 0.
+
+
+def bases(coords, number):
+    """ returns (k, 2) index pairs of up to number longest distinct pairs of coords, longest first """
+    pairs = np.array(list(itertools.combinations(range(len(coords)), 2)), dtype=np.intp).reshape(-1, 2)
+    lengths = np.linalg.norm(coords[pairs[:, 1]] - coords[pairs[:, 0]], axis=1)
+    order = np.argsort(-lengths, kind='stable')
+    order = order[lengths[order] > 0]
+    return pairs[order[:number]]
+
+
+def reference_pairs(cities, low, high, chunk_pairs=2 ** 20):
+    """
+    yields (first, second) index arrays of ordered pairs of distinct cities at distance low..high, chunk by chunk.
+    pairs are found by a grid of cell about high.
+    """
+    coords, n = cities.coords, len(cities)
+    grid = cities.grid_index(2. ** np.ceil(np.log2(high)))
+    x_min, x_max, y_min, y_max = grid.bounds
+    neighbours = n * np.pi * high ** 2 / max((x_max - x_min) * (y_max - y_min), np.pi * high ** 2)  # expected
+    chunk = max(1, int(chunk_pairs // max(1., neighbours)))
+    for start in range(0, n, chunk):
+        first = np.arange(start, min(start + chunk, n))
+        rows, second, distances = grid.within(coords[first], high)
+        first = first[rows]
+        good = (first != second) & (distances >= low) & (distances > 0)
+        yield first[good], second[good]
+
+
+def lookup(cities, points, radius):
+    """
+    nearest city of each of complex points within radius (array), or -1. points are grouped by diameter to power of 2,
+    each group is looked up in cached grid of that cell size - so only 4 cells around a point are scanned.
+    :return: (indices, distances)
+    """
+    indices, distances = np.full(len(points), -1, dtype=np.intp), np.full(len(points), np.inf)
+    finite = np.isfinite(points) & (radius > 0)
+    bands = np.full(len(points), np.iinfo(np.int64).min)
+    bands[finite] = np.ceil(np.log2(2 * radius[finite])).astype(np.int64)
+    for band in np.unique(bands[finite]):
+        rows = np.flatnonzero(bands == band)
+        grid = cities.grid_index(2. ** band)
+        indices[rows], distances[rows] = grid.nearest(np.stack([points[rows].real, points[rows].imag], axis=1),
+                                                      radius[rows])
+    return indices, distances
+
+
+def fit_similarity(src, dst):
+    """ least squares similarity dst ~ scale_rotation * src + translation, of complex points """
+    src_mean, dst_mean = src.mean(), dst.mean()
+    src_centered = src - src_mean
+    scale_rotation = np.sum(np.conj(src_centered) * (dst - dst_mean)) / np.sum(np.abs(src_centered) ** 2)
+    return scale_rotation, dst_mean - scale_rotation * src_mean
+
+
+def verify(cities2, detected, scale_rotation, translation, tolerances, points, needed=0, probes=0):
+    """
+    counts hits of hypotheses over detected[points], one point at a time. hypothesis is dropped as soon as it can't
+    reach needed hits, or hits of best of them so far, or if none of first probes points hit.
+    :return: (rows of remaining hypotheses, their hits, sums of residuals of hits)
+    """
+    rows = np.arange(len(tolerances))
+    inliers, residuals = np.zeros(len(tolerances), dtype=np.int64), np.zeros(len(tolerances))
+    for done, point in enumerate(points, 1):
+        indices, distances = lookup(cities2, scale_rotation[rows] * detected[point] + translation[rows],
+                                    tolerances[rows])
+        hit = indices >= 0
+        inliers[rows[hit]] += 1
+        residuals[rows[hit]] += distances[hit]
+        hits = inliers[rows]
+        rows = rows[(hits + len(points) - done >= max(needed, hits.max())) & ((hits > 0) | (done != probes))]
+        if not len(rows):
+            break
+    return rows, inliers[rows], residuals[rows]
+
+
+def refine_matches(cities1, cities2, scale_rotation, translation, tolerance, min_inliers, debug):
+    """
+    refits similarity on its inliers (cities1 within tolerance of a reference city once mapped), then matches each
+    inlier to its nearest reference city, closest first and one to one.
+    :return: {city1 -> city2}, None if less than min_inliers
+    """
+    detected, reference = to_complex(cities1.coords), to_complex(cities2.coords)
+    for iteration in range(2):
+        indices, distances = lookup(cities2, scale_rotation * detected + translation,
+                                    np.full(len(detected), tolerance))
+        matched = np.flatnonzero(indices >= 0)
+        if len(matched) < 3:
+            return None
+        scale_rotation, translation = fit_similarity(detected[matched], reference[indices[matched]])
+    order = matched[np.argsort(distances[matched], kind='stable')]
+    city_matches, used = {}, set()
+    for idx in order:
+        if indices[idx] not in used:
+            used.add(indices[idx])
+            city_matches[cities1.names[idx]] = cities2.names[indices[idx]]
+    debug.log('final_matches', city_matches=city_matches)
+    if len(city_matches) < min_inliers:
+        return None
+    return city_matches
+
+
+def find_city_matches(cities1, cities2, config, debug):
+    """
+    tries basis pairs of cities1, longest first, up to search_bases of them, against reference pairs within
+    scale_range. hypotheses of each basis are verified on other cities, nearest to basis first - at least one of first
+    search_probes of them must hit, and hypotheses that can't beat the best one are dropped early. city of cities1 is
+    an inlier if reference city is within similarity_tolerance (relative to extent of cities1) of its mapped position.
+    search stops at hypothesis of at least half of cities1 inliers, which is refined by refine_matches.
+    :return: {city1 -> city2}, None if best hypothesis has less than similarity_min_inliers inliers
+    """
+    scale_range = config.get('scale_range')
+    if scale_range is None:
+        raise ValueError('similarity_search engine needs scale_range prior')
+    n1 = len(cities1)
+    if n1 < 3 or len(cities2) < 3:
+        return None
+    detected, reference = to_complex(cities1.coords), to_complex(cities2.coords)
+    longest = extent(cities1.coords)
+    min_inliers = max(3, config['similarity_min_inliers'])
+    enough = max(min_inliers, int(np.ceil(n1 / 2)))
+    best = (0, np.inf, None, None, None)  # (inliers, residual, scale_rotation, translation, tolerance)
+    hypotheses = 0
+    for a, b in bases(cities1.coords, config['search_bases']):
+        others = np.array([idx for idx in range(n1) if idx not in (a, b)], dtype=np.intp)
+        midpoint = (detected[a] + detected[b]) / 2
+        others = others[np.argsort(np.abs(detected[others] - midpoint), kind='stable')]  # nearest - least error
+        basis = detected[b] - detected[a]
+        for first, second in reference_pairs(cities2, np.abs(basis) / scale_range[1], np.abs(basis) / scale_range[0]):
+            scale_rotation = (reference[second] - reference[first]) / basis
+            translation = reference[first] - scale_rotation * detected[a]
+            tolerances = config['similarity_tolerance'] * np.abs(scale_rotation) * longest
+            hypotheses += len(first)
+            needed = max(min_inliers, best[0]) - 2  # basis cities are inliers
+            keep, inliers, residuals = verify(cities2, detected, scale_rotation, translation, tolerances, others,
+                                              needed, config['search_probes'])
+            if not len(keep):
+                continue
+            idx = np.lexsort((residuals, -inliers))[0]
+            if (inliers[idx] + 2, -residuals[idx]) > (best[0], -best[1]):
+                best = (inliers[idx] + 2, residuals[idx], scale_rotation[keep[idx]], translation[keep[idx]],
+                        tolerances[keep[idx]])
+        if best[0] >= enough:
+            break
+    debug.log('search_hypotheses', hypotheses=hypotheses, best_inliers=int(best[0]))
+    if best[0] < min_inliers:
+        return None
+    return refine_matches(cities1, cities2, *best[2:], min_inliers, debug)
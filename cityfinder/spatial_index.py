@@ -0,0 +1,150 @@
+import itertools
+
+import numpy as np
+
+from cityfinder.pair_index import expand_ranges
+
+
+class GridIndex:
+    """
+    uniform grid over points of a reference CityVector, for window queries. points are sorted by cell (row major), so
+    cells of a grid row that intersect a window are a single contiguous slice.
+    """
+    def __init__(self, coords, cell_size):
+        """
+        :param coords: (n, 2) float64 of (x, y)
+        :param cell_size: side of square cell, in units of coords
+        """
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+        self.origin = self.coords.min(axis=0) if len(self.coords) else np.zeros(2)
+        cells = np.floor((self.coords - self.origin) / self.cell_size).astype(np.intp)
+        self.shape = tuple(cells.max(axis=0) + 1) if len(cells) else (0, 0)  # (columns, rows)
+        keys = cells[:, 1] * self.shape[0] + cells[:, 0]
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+        # hash table of cells, for point queries - O(1) instead of binary search, whatever number of cells.
+        # points of cells of same bucket are contiguous in bucket_order:
+        self.buckets = 1 << int(2 * len(keys)).bit_length()
+        buckets = keys & (self.buckets - 1)
+        self.bucket_order = np.argsort(buckets, kind='stable')
+        self.bucket_keys = keys[self.bucket_order]
+        self.bucket_starts = np.concatenate([[0], np.cumsum(np.bincount(buckets, minlength=self.buckets))])
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def bounds(self):
+        """ (x_min, x_max, y_min, y_max) of points """
+        (x_min, y_min), (x_max, y_max) = self.coords.min(axis=0), self.coords.max(axis=0)
+        return x_min, x_max, y_min, y_max
+
+    def query(self, bounds):
+        """
+        :param bounds: (x_min, x_max, y_min, y_max), inclusive
+        :return: ascending indices of points inside bounds
+        """
+        if not len(self.coords):
+            return np.zeros(0, dtype=np.intp)
+        x_min, x_max, y_min, y_max = bounds
+        columns, rows = self.shape
+        (column_min, row_min), (column_max, row_max) = \
+            np.floor((np.array([[x_min, y_min], [x_max, y_max]]) - self.origin) / self.cell_size).astype(np.intp)
+        column_min, column_max = max(column_min, 0), min(column_max, columns - 1)
+        row_min, row_max = max(row_min, 0), min(row_max, rows - 1)
+        if column_min > column_max or row_min > row_max:
+            return np.zeros(0, dtype=np.intp)
+        row_keys = np.arange(row_min, row_max + 1) * columns
+        starts = np.searchsorted(self.sorted_keys, row_keys + column_min, side='left')
+        stops = np.searchsorted(self.sorted_keys, row_keys + column_max, side='right')
+        candidates = np.concatenate([self.order[start: stop] for start, stop in zip(starts, stops)])
+        x, y = self.coords[candidates, 0], self.coords[candidates, 1]
+        inside = (x_min <= x) & (x <= x_max) & (y_min <= y) & (y <= y_max)
+        return np.sort(candidates[inside])
+
+    def within(self, points, radius):
+        """
+        all pairs of query point and indexed point at most radius apart, vectorized over points.
+        :param points: (k, 2) query points
+        :param radius: scalar or (k,) array. cells up to max radius away are scanned, so it should be about cell_size
+        :return: (rows of points, indices of indexed points, distances)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(points),))
+        if not len(self.coords) or not len(points):
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+        columns, rows = self.shape
+        cells = np.floor((points - self.origin) / self.cell_size)
+        inside = np.all((cells >= -1 - radius[:, np.newaxis] / self.cell_size) &
+                        (cells <= np.array([columns, rows]) + radius[:, np.newaxis] / self.cell_size), axis=1)
+        candidates = np.flatnonzero(inside)  # far from all cells - no pairs, and cells may not fit intp
+        cells = cells[candidates].astype(np.intp)
+        if 2 * np.max(radius) <= self.cell_size:
+            # cell and its neighbours towards nearer sides of it:
+            sides = np.where((points[candidates] - self.origin) / self.cell_size - cells < 0.5, -1, 1)
+            offsets = [(0, 0), (sides[:, 0], 0), (0, sides[:, 1]), (sides[:, 0], sides[:, 1])]
+        else:
+            span = int(np.ceil(np.max(radius) / self.cell_size))
+            offsets = itertools.product(range(-span, span + 1), repeat=2)
+        result_rows, result_indices = [], []
+        for dx, dy in offsets:
+            column, row = cells[:, 0] + dx, cells[:, 1] + dy
+            valid = np.flatnonzero((0 <= column) & (column < columns) & (0 <= row) & (row < rows))
+            keys = row[valid] * columns + column[valid]
+            buckets = keys & (self.buckets - 1)
+            query_rows, positions = expand_ranges(self.bucket_starts[buckets], self.bucket_starts[buckets + 1])
+            same = self.bucket_keys[positions] == keys[query_rows]  # not other cell of bucket
+            result_rows.append(candidates[valid[query_rows[same]]])
+            result_indices.append(self.bucket_order[positions[same]])
+        result_rows, result_indices = np.concatenate(result_rows), np.concatenate(result_indices)
+        distances = np.linalg.norm(self.coords[result_indices] - points[result_rows], axis=1)
+        close = distances <= radius[result_rows]
+        return result_rows[close], result_indices[close], distances[close]
+
+    def nearest(self, points, radius):
+        """
+        nearest indexed point of each of points, if within radius, see within.
+        :return: (indices (k,) - -1 where none, distances (k,) - inf where none)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        indices, distances = np.full(len(points), -1, dtype=np.intp), np.full(len(points), np.inf)
+        rows, found, found_distances = self.within(points, radius)
+        order = np.lexsort((found_distances, rows))
+        rows, first = np.unique(rows[order], return_index=True)
+        indices[rows], distances[rows] = found[order][first], found_distances[order][first]
+        return indices, distances
+
+    def windows(self, size, min_points=3):
+        """
+        square windows of side 2 * size, with stride size, over the points - any set of points of extent up to size
+        (in x and in y) lies entirely in one of them.
+        windows of less than min_points points, or of same points as an earlier window, are skipped.
+        :return: [(bounds, indices)], most populated first
+        """
+        if not len(self.coords):
+            return []
+        x_min, x_max, y_min, y_max = self.bounds
+        windows, seen = [], set()
+        for y in y_min + size * np.arange(max(1, int(np.ceil((y_max - y_min) / size)))):
+            for x in x_min + size * np.arange(max(1, int(np.ceil((x_max - x_min) / size)))):
+                bounds = (x, x + 2 * size, y, y + 2 * size)
+                indices = self.query(bounds)
+                key = indices.tobytes()
+                if len(indices) < min_points or key in seen:
+                    continue
+                seen.add(key)
+                windows.append((bounds, indices))
+        windows.sort(key=lambda window: -len(window[1]))  # stable, so ties stay in grid order
+        return windows
+
+
+def window_size(coords, scale_range):
+    """
+    side [reference units] of window that certainly contains reference of detected cities, any rotation.
+    :param coords: (n, 2) detected pixel coords
+    :param scale_range: (low, high) prior of distance ratio detected / reference
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    extent = np.linalg.norm(coords.max(axis=0) - coords.min(axis=0))  # diagonal, so rotation can't exceed it
+    return extent / scale_range[0]
@@ -0,0 +1,170 @@
+"""
+parameter sweeps for detector tuning: image is loaded once, configurations are evaluated in parallel workers,
+results are returned as table (list of rows), nothing is written to disk.
+
+    space = {'pink_blob.closing_radius': [11, 21, 31], 'pink_blob.h': [[140, 180], [150, 180]]}
+    rows = sweep('sheet.png', grid(space), ground_truth=[(x, y), ...])
+"""
+import itertools
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from copy import deepcopy
+
+import numpy as np
+
+from cityfinder.city_detector import CityDetector, imread
+from cityfinder.lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+
+
+def grid(space):
+    """
+    all combinations of parameter values.
+    :param space: {'section.key' -> [values]}, e.g. {'hough_circle.dp': [1, 1.5, 2]}
+    :return: [{'section.key' -> value}]
+    """
+    keys = list(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*(space[key] for key in keys))]
+
+
+def random_search(space, samples, seed=0):
+    """
+    random configurations.
+    :param space: {'section.key' -> [values] to choose from, or (low, high) to sample uniformly - ints if both ints}
+    :return: [{'section.key' -> value}] of length samples
+    """
+    rng = random.Random(seed)
+
+    def sample(values):
+        if isinstance(values, tuple):
+            low, high = values
+            return rng.randint(low, high) if isinstance(low, int) and isinstance(high, int) else rng.uniform(low, high)
+        return rng.choice(values)
+    return [{key: sample(values) for key, values in space.items()} for idx in range(samples)]
+
+
+def apply_params(config, params):
+    """ returns copy of detector config with {'section.key' -> value} set """
+    config = deepcopy(config)
+    for name, value in params.items():
+        section, key = name.split('.', 1)
+        if key not in config[section]:
+            raise KeyError('unknown parameter %s' % name)
+        config[section][key] = value
+    return config
+
+
+def score(detected, ground_truth, tolerance):
+    """
+    one-to-one matching of detections to ground truth positions, closest pairs first, up to tolerance [pix].
+    :return: {'detected', 'matched', 'precision', 'recall', 'f1', 'mean_error'}
+    """
+    detected = np.asarray(detected, dtype=np.float64).reshape(-1, 2)
+    ground_truth = np.asarray(ground_truth, dtype=np.float64).reshape(-1, 2)
+    dists = np.linalg.norm(detected[:, np.newaxis] - ground_truth[np.newaxis], axis=2)
+    used_detected, used_truth, errors = set(), set(), []
+    for flat in np.argsort(dists, axis=None):
+        row, col = np.unravel_index(flat, dists.shape)
+        if dists[row, col] > tolerance:
+            break
+        if row not in used_detected and col not in used_truth:
+            used_detected.add(row)
+            used_truth.add(col)
+            errors.append(dists[row, col])
+    matched = len(errors)
+    precision = matched / len(detected) if len(detected) else 0.
+    recall = matched / len(ground_truth) if len(ground_truth) else 0.
+    return {
+        'detected': len(detected),
+        'matched': matched,
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall) if matched else 0.,
+        'mean_error': float(np.mean(errors)) if errors else None,
+    }
+
+
+def detect(img, config, method='pink_blob'):
+    """ returns (n, 2) pixel positions detected by method of CityDetector with config """
+    detector = CityDetector(config=config)
+    if method == 'pink_blob':
+        return detector.pink_blob_points(img)
+    if method == 'hough_circle':
+        circles = detector.find_circle_city(img)
+        return np.asarray(circles, dtype=np.float64).reshape(-1, 3)[:, :2]
+    raise NotImplementedError('unknown method %s' % method)
+
+
+def evaluate(img, params, base_config=None, method='pink_blob', ground_truth=None, tolerance=20):
+    """ returns row of results table: params, 'detected', 'time' [s], scores if ground_truth, or 'error' """
+    row = dict(params)
+    start = time.perf_counter()
+    try:
+        points = detect(img, apply_params(base_config or CityDetector.default_config(), params), method)
+    except (ValueError, KeyError, cv2.error) as e:
+        row['error'] = repr(e)
+        return row
+    row['time'] = time.perf_counter() - start
+    if ground_truth is not None:
+        row.update(score(points, ground_truth, tolerance))
+    else:
+        row['detected'] = len(points)
+    return row
+
+
+# per worker process image, set once by _init_worker instead of pickling it with every configuration:
+_worker = {}
+
+
+def _init_worker(img):
+    _worker['img'] = img
+
+
+def _evaluate_in_worker(args):
+    return evaluate(_worker['img'], *args)
+
+
+def sweep(image, configurations, base_config=None, method='pink_blob', ground_truth=None, tolerance=20,
+          workers=None, processes=False):
+    """
+    evaluates detector configurations on a single image.
+    :param image: path or loaded BGR array, read once
+    :param configurations: [{'section.key' -> value}], e.g. of grid / random_search
+    :param base_config: detector config the params are applied to, default - CityDetector.default_config()
+    :param method: 'pink_blob' or 'hough_circle'
+    :param ground_truth: [(x, y)] pixel positions of cities. if given, rows are scored, and sorted by f1, then error
+    :param tolerance: [pix] max distance of detection from its ground truth position
+    :param workers: pool size, default - executor's default, 1 - serially
+    :param processes: evaluate in process pool (image is sent once per process) instead of thread pool
+    :return: [row], row - {'section.key' -> value, 'detected', 'time', scores...}, or 'error' if config is invalid
+    """
+    img = imread(image, cv2.IMREAD_COLOR)
+    args = [(params, base_config, method, ground_truth, tolerance) for params in configurations]
+    if workers == 1:
+        rows = [evaluate(img, *arg) for arg in args]
+    elif processes:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(img,)) as pool:
+            rows = list(pool.map(_evaluate_in_worker, args))
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            rows = list(pool.map(lambda arg: evaluate(img, *arg), args))
+    if ground_truth is not None:
+        rows.sort(key=_score_order)
+    return rows
+
+
+def _score_order(row):
+    """ sort key of scored rows: best f1 first, then least mean_error. no error (nothing matched) is last """
+    return -row.get('f1', -1), np.inf if row.get('mean_error') is None else row['mean_error']
+
+
+def format_table(rows, columns=None):
+    """ returns rows as aligned text table """
+    columns = columns or list(dict.fromkeys(key for row in rows for key in row))
+    cells = [[str(column) for column in columns]]
+    for row in rows:
+        cells.append(['%.4g' % row[c] if isinstance(row.get(c), float) else str(row.get(c, '')) for c in columns])
+    widths = [max(len(line[idx]) for line in cells) for idx in range(len(columns))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(line, widths)) for line in cells)
@@ -0,0 +1,98 @@
+"""
+synthetic inputs for tests and benchmarks: random reference/detected city vectors, pink blob rasters, tile folders.
+all generators take a seed, so runs are reproducible.
+"""
+import os
+import random
+
+import numpy as np
+
+from cityfinder.city_vector import CityVector
+from cityfinder.lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+
+
+PINK_BGR = (180, 60, 230)
+
+
+def random_cities(number, bounds=(34, 36, 29, 33), seed=0):
+    """ CityVector of number cities uniformly distributed in bounds (x_min, x_max, y_min, y_max), named 'c<idx>' """
+    rng = np.random.default_rng(seed)
+    x_min, x_max, y_min, y_max = bounds
+    xs, ys = rng.uniform(x_min, x_max, number), rng.uniform(y_min, y_max, number)
+    return CityVector({'c%d' % idx: (x, y) for idx, (x, y) in enumerate(zip(xs.tolist(), ys.tolist()))})
+
+
+def with_outliers(cities, number, bounds=None, seed=0):
+    """ cities plus number uniformly distributed outliers, default bounds - bounding box of cities """
+    if bounds is None:
+        (x_min, y_min), (x_max, y_max) = cities.coords.min(axis=0), cities.coords.max(axis=0)
+        bounds = (x_min, x_max, y_min, y_max)
+    return cities.add_outliers(number, bounds=bounds, rng=random.Random(seed))
+
+
+def detected_cities(cities, rotation=0, scale=1000, offset=(2000, 2000), noise=0, subset=None, seed=0):
+    """
+    simulates detection of cities on a scan: similarity transform of cities around their centroid, plus gaussian
+    noise [pixels].
+    :param rotation: [deg], counterclockwise
+    :param scale: pixels per unit of cities coords
+    :param subset: number of cities detected, random subset. default - all
+    """
+    rng = np.random.default_rng(seed)
+    angle = np.deg2rad(rotation)
+    matrix = scale * np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    pixels = (cities.coords - cities.coords.mean(axis=0)) @ matrix.T + offset
+    pixels += rng.normal(0, noise, pixels.shape) if noise > 0 else 0
+    rows = np.arange(len(cities))
+    if subset is not None:
+        rows = np.sort(rng.choice(rows, size=subset, replace=False))
+    return CityVector({cities.names[row]: tuple(pixels[row].tolist()) for row in rows})
+
+
+def pink_blob_raster(width, height, blobs=10, radius=(30, 60), min_distance=500, seed=0):
+    """
+    white BGR raster with pink discs.
+    :param min_distance: [pixels] between centres of discs, default - eliminate_closest_pix of default detector config.
+        if blobs discs can't be placed that far apart, less discs are drawn
+    :return: (raster (height, width, 3) uint8, [(x, y, radius)])
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 255, np.uint8)
+    discs = []
+    for attempt in range(100 * blobs):
+        if len(discs) == blobs:
+            break
+        r = int(rng.integers(radius[0], radius[1] + 1))
+        x, y = int(rng.integers(r, width - r)), int(rng.integers(r, height - r))
+        if all((x - x2) ** 2 + (y - y2) ** 2 > max(min_distance, r + r2 + 50) ** 2 for x2, y2, r2 in discs):
+            discs.append((x, y, r))
+    for x, y, r in discs:
+        cv2.circle(img, (x, y), r, PINK_BGR, -1)
+    return img, discs
+
+
+def write_raster(img, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    cv2.imwrite(path, img)
+    return path
+
+
+def write_tiles(img, folder, id, tilesize=256, extension='png'):
+    """
+    splits BGR raster into tiles of ImageComposer layout: folder/id/id_<x>_<y>.<extension>.
+    partial tiles on right and bottom borders are padded with white.
+    :return: number of tiles
+    """
+    os.makedirs(os.path.join(folder, id), exist_ok=True)
+    h, w = img.shape[:2]
+    count = 0
+    for y in range(0, h, tilesize):
+        for x in range(0, w, tilesize):
+            tile = np.full((tilesize, tilesize, 3), 255, np.uint8)
+            part = img[y: y + tilesize, x: x + tilesize]
+            tile[:part.shape[0], :part.shape[1]] = part
+            cv2.imwrite(os.path.join(folder, id, '%s_%d_%d.%s' % (id, x, y, extension)), tile)
+            count += 1
+    return count
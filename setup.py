@@ -17,6 +17,7 @@ setup(
     description='',
     long_description=open('README.md').read(),
     packages=find_packages(exclude=["tests"]),
+    package_data={'cityfinder': ['gazetteers/*.csv', 'gazetteers/*.json']},
     license="GPLv3",
     classifiers=[
         'Development Status :: 4 - Beta',
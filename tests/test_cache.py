@@ -0,0 +1,66 @@
+import os
+import random
+import shutil
+import unittest
+
+from cityfinder import synthetic
+from cityfinder.cache import ResultCache, cached_find_pink_blob, cached_match
+from cityfinder.city_detector import CityDetector
+from cityfinder.city_vector import CityVector, israel, match
+
+
+class CountingDetector(CityDetector):
+    calls = 0
+
+    def find_pink_blob(self, path, **kwargs):
+        self.calls += 1
+        return super().find_pink_blob(path, **kwargs)
+
+
+class TestCache(unittest.TestCase):
+    out_folder = 'out/cache'
+
+    def setUp(self):
+        shutil.rmtree(self.out_folder, ignore_errors=True)
+
+    def test_lru_eviction(self):
+        for idx in range(5):
+            ResultCache(self.out_folder).put('values', str(idx), 'x' * 900)
+            path = os.path.join(self.out_folder, 'values', '%d.json' % idx)
+            os.utime(path, (idx, idx))  # recency in order of idx
+        cache = ResultCache(self.out_folder, max_bytes=3000)
+        cache.get('values', '0')  # most recent now
+        cache.put('values', '5', 'x' * 900)
+        self.assertLessEqual(cache.size, 3000)
+        self.assertEqual(cache.get('values', '0'), 'x' * 900)
+        self.assertIsNone(cache.get('values', '1'))
+        self.assertEqual(len(ResultCache(self.out_folder)), len(cache))
+
+    def test_cached_detection_and_match(self):
+        img, discs = synthetic.pink_blob_raster(2000, 1500, blobs=4, seed=5)
+        path = synthetic.write_raster(img, os.path.join(self.out_folder, 'sheet.png'))
+        cache = ResultCache(os.path.join(self.out_folder, 'cache'))
+        detector = CountingDetector()
+        cities = cached_find_pink_blob(cache, detector, path)
+        detector2 = CountingDetector()
+        self.assertEqual(cached_find_pink_blob(cache, detector2, path), cities)
+        self.assertEqual(cached_find_pink_blob(cache, detector2, path, image=img), cities)  # prefetched - same key
+        self.assertEqual(detector2.calls, 0)
+        self.assertEqual(cities, detector.find_pink_blob(path))
+        self.assertEqual(detector.calls, 2)  # first cached call and the direct one
+
+        config = CityDetector.default_config()
+        config['pink_blob']['closing_radius'] = 11
+        detector = CountingDetector(config=config)
+        cached_find_pink_blob(cache, detector, path)
+        self.assertEqual(detector.calls, 1)  # config changed
+
+        random.seed(0)
+        reference = israel.add_outliers(5)
+        detected = CityVector({city: (1000 * (x - 34), 1000 * (y - 31)) for city, (x, y) in israel.cities.items()})
+        expected = match(detected, reference)
+        for idx in range(2):
+            affine, crs = cached_match(cache, detected, reference)
+            self.assertEqual(crs, expected[1])
+            self.assertAlmostEqual(affine.c, expected[0].c)
+        self.assertEqual(cache.hits, 3)  # 2 detections, 1 match
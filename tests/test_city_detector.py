@@ -1,12 +1,19 @@
 import os
 import itertools
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
+import cv2
 import rasterio
 from PIL import Image
 import numpy as np
 import unittest
-from cityfinder.city_detector import CityDetector
+from cityfinder.city_detector import CityDetector, DetectionPlan, suppress_close
+from cityfinder import sweep, synthetic
 from cityfinder.city_vector import CityVector, israel, israel_utm, match
+from cityfinder.debug import DebugSink
+from cityfinder.image_retriever import ImageComposer, VirtualMosaic
 
 
 GEOGRAPHIC = {'init': 'EPSG:4326'}
@@ -23,15 +30,28 @@ class TestCityDetector(unittest.TestCase):
 
     def test_optimize_params(self):
         name = 'tulkarm'
-
-        config = CityDetector.default_config()
-        for config['hough_circle']['dp'] in np.arange(.5, 2.5, .5):
-            for config['hough_circle']['maxRadius'] in range(5, 40, 5):
-                config_text = '_maxRadius=%0.2f_dp=%0.2f' % (config['hough_circle']['maxRadius'], config['hough_circle']['dp'])
-                out_path = os.path.join(self.out_folder, name + config_text + '.png')
-                detector = CityDetector(config=config)
-                circles = detector.find_circle_city(self._path(name), out_path=out_path, imshow=False)
-                print('config: %s. Detected %d circles' % (config_text, len(circles)))
+        space = {'hough_circle.dp': np.arange(.5, 2.5, .5).tolist(), 'hough_circle.maxRadius': list(range(5, 40, 5))}
+        rows = sweep.sweep(self._path(name), sweep.grid(space), method='hough_circle')
+        self.assertEqual(len(rows), 4 * 7)
+        print(sweep.format_table(rows))
+
+    def test_sweep_ground_truth(self):
+        img, discs = synthetic.pink_blob_raster(2000, 1500, blobs=6, seed=4)
+        space = {'pink_blob.closing_radius': [11, 21], 'pink_blob.h': [[150, 180], [0, 10]], 'pink_blob.min_area': [-1]}
+        rows = sweep.sweep(img, sweep.grid(space), ground_truth=[(x, y) for x, y, r in discs], workers=2)
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(all('error' in row for row in rows))  # min_area must be non-negative
+
+        space['pink_blob.min_area'] = [200]
+        rows = sweep.sweep(img, sweep.random_search(space, 6, seed=0), ground_truth=[(x, y) for x, y, r in discs],
+                           processes=True, workers=2)
+        self.assertEqual(rows[0]['pink_blob.h'], [150, 180])
+        self.assertEqual(rows[0]['f1'], 1)
+        self.assertLess(rows[0]['mean_error'], 1)
+        self.assertEqual(rows[-1]['f1'], 0)  # hue of red
+
+        rows = [{'f1': 1, 'mean_error': 0.5}, {'f1': 1, 'mean_error': None}, {'f1': 1, 'mean_error': 0.}, {'f1': 0.5}]
+        self.assertEqual(sorted(rows, key=sweep._score_order), [rows[2], rows[0], rows[1], rows[3]])
 
     def test_radii_histogram(self):
         name = 'tulkarm'
@@ -87,3 +107,96 @@ class TestCityDetector(unittest.TestCase):
         #     az1, d1 = cities[pair]
         #     az2, d2 = israel_utm[pair]
         #     print(*pair, az1 - az2, 100 * d1 / d2)
+
+    def _synthetic_pink_path(self):
+        img = np.full((3000, 3000, 3), 255, np.uint8)
+        for x, y, radius in [(400, 500, 60), (1500, 700, 50), (2500, 2500, 40), (800, 2200, 45)]:
+            cv2.circle(img, (x, y), radius, (180, 60, 230), -1)  # pink
+        os.makedirs(self.out_folder, exist_ok=True)
+        path = os.path.join(self.out_folder, 'synthetic_pink.png')
+        cv2.imwrite(path, img)
+        return path
+
+    def test_find_pink_blob_pyramid(self):
+        path = self._synthetic_pink_path()
+        cities = CityDetector().find_pink_blob(path)
+        config = CityDetector.default_config()
+        config['pink_blob']['pyramid_level'] = 2
+        cities_pyramid = CityDetector(config=config).find_pink_blob(path)
+        self.assertEqual(len(cities), 4)
+        self.assertEqual(cities.keys(), cities_pyramid.keys())
+        for city in cities:
+            np.testing.assert_allclose(cities[city], cities_pyramid[city], atol=1)
+
+    def test_find_pink_blob_debug_sink(self):
+        path = self._synthetic_pink_path()
+        debug = DebugSink(folder=os.path.join(self.debug_folder, 'synthetic_pink'))
+        cities = CityDetector().find_pink_blob(path, debug=debug)
+        self.assertEqual(cities, CityDetector().find_pink_blob(path))
+        self.assertIn({'event': 'detected_blobs', 'count': 4}, debug.events)
+        self.assertTrue(os.path.exists(os.path.join(debug.folder, '6_largest_blobs.png')))
+
+    def test_find_pink_blob_tiles(self):
+        img = np.full((1000, 1400, 3), 255, np.uint8)
+        for x, y, radius in [(200, 200, 70), (600, 400, 55), (1000, 800, 45), (1210, 190, 40), (390, 800, 35)]:
+            cv2.circle(img, (x, y), radius, (180, 60, 230), -1)  # pink, most cross tile borders
+        tiles_folder = os.path.join(self.out_folder, 'tiles')
+        os.makedirs(os.path.join(tiles_folder, 'synthetic'), exist_ok=True)
+        for y in range(0, img.shape[0], 200):
+            for x in range(0, img.shape[1], 200):
+                tile_path = os.path.join(tiles_folder, 'synthetic', 'synthetic_%d_%d.png' % (x, y))
+                cv2.imwrite(tile_path, img[y: y + 200, x: x + 200])
+        path = os.path.join(self.out_folder, 'synthetic_tiles_composed.png')
+        cv2.imwrite(path, img)
+
+        detector = CityDetector()
+        cities = detector.find_pink_blob(path)
+        composer = ImageComposer(folder=tiles_folder, extension='png')
+        for window_tiles in [1, 3]:
+            with mock.patch.object(VirtualMosaic, 'read_tile', autospec=True,
+                                   side_effect=VirtualMosaic.read_tile) as read_tile:
+                cities_tiles = detector.find_pink_blob_tiles(composer, 'synthetic', window_tiles=window_tiles)
+            self.assertEqual(read_tile.call_count, 5 * 7)  # each tile decoded once, though windows overlap by halo
+            self.assertEqual(cities.keys(), cities_tiles.keys())
+            for city in cities:
+                np.testing.assert_allclose(cities[city], cities_tiles[city], atol=1)
+
+    def test_suppress_close(self):
+        rng = np.random.RandomState(0)
+        points = rng.uniform(0, 5000, size=(3000, 2))
+        sizes = rng.randint(1, 50, size=3000).astype(float)
+
+        # brute force greedy:
+        remaining = sorted(range(len(points)), key=lambda idx: sizes[idx], reverse=True)
+        expected = []
+        while remaining:
+            best = remaining[0]
+            expected.append(best)
+            remaining = [idx for idx in remaining if np.linalg.norm(points[idx] - points[best]) >= 300]
+        self.assertEqual([int(idx) for idx in suppress_close(points, sizes, 300)], expected)
+
+    def test_pink_mask_fused(self):
+        img = np.random.RandomState(0).randint(0, 256, size=(1037, 777, 3)).astype(np.uint8)
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        config = CityDetector.default_config()
+        pink = config['pink_blob']
+        pink['s'] = [100, 200]
+        expected = (pink['h'][0] < hsv[:, :, 0]) & (hsv[:, :, 0] < pink['h'][1]) & \
+                   (100 <= hsv[:, :, 1]) & (hsv[:, :, 1] <= 200)
+        for pink['mask_band_rows'] in [1, 100, 512, 5000]:
+            np.testing.assert_array_equal(DetectionPlan(config).pink_mask(img), 255 * expected.astype(np.uint8))
+
+    def test_detection_plan_shared(self):
+        path = self._synthetic_pink_path()
+        config = CityDetector.default_config()
+        config['pink_blob']['pyramid_level'] = 1
+        detector = CityDetector(config=config)
+        expected = detector.find_pink_blob(path)
+        detector.plan = pickle.loads(pickle.dumps(detector.plan))
+        with ThreadPoolExecutor(4) as pool:
+            for cities in pool.map(detector.find_pink_blob, [path] * 4):
+                self.assertEqual(cities, expected)
+
+        config['pink_blob']['h'] = [150, 151]
+        with self.assertRaises(ValueError):
+            CityDetector(config=config)
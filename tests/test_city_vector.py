@@ -1,11 +1,19 @@
 import os
+import itertools
+import random
 
 import numpy as np
 import unittest
-from cityfinder.city_vector import CityVector, israel, match
+from cityfinder import geometric_hashing, similarity_search, synthetic
+from cityfinder.city_vector import CityVector, israel, match, default_match_config, find_gcps, fit_gcps, \
+    scale_range_from_gsd, _find_city_matches, _potential_matches_python, _potential_matches_vectorized
+from cityfinder.debug import DebugSink, NULL_SINK
+from cityfinder.pair_index import PairIndex
 
 
 class TestCityVector(unittest.TestCase):
+    out_folder = 'out'
+
     def test_azimuths(self):
         print(israel['tlv', 'j-m'])
         
@@ -15,3 +23,138 @@ class TestCityVector(unittest.TestCase):
     def test_match(self):
         israel_with_outliers = israel.add_outliers(0)
         match(israel, israel_with_outliers)
+
+    def test_match_engines_agree(self):
+        random.seed(0)
+        reference = israel.add_outliers(5)
+        detected = CityVector({city: (1000 * (x - 34), 1000 * (y - 31)) for city, (x, y) in israel.cities.items()})
+
+        results = []
+        for engine in ['python', 'vectorized']:
+            config = default_match_config()
+            config['engine'] = engine
+            results.append(match(detected, reference, config))
+        aff_python, crs_python = results[0]
+        aff_vectorized, crs_vectorized = results[1]
+        self.assertEqual(crs_python, crs_vectorized)
+        np.testing.assert_allclose(tuple(aff_python), tuple(aff_vectorized))
+
+    def test_matrices_invalidated(self):
+        cities = CityVector({'a': (0, 0), 'b': (1, 1)})
+        self.assertAlmostEqual(cities.azimuth('a', 'b'), 45)
+        self.assertAlmostEqual(cities.dist('a', 'b'), np.sqrt(2))
+
+        cities.set_city('b', (0, 2))
+        cities.set_city('c', (-3, 0))
+        self.assertEqual(cities.coords.shape, (3, 2))
+        self.assertAlmostEqual(cities.azimuth('a', 'b'), 90)
+        self.assertAlmostEqual(cities['b', 'c'][1], np.sqrt(13))
+
+        cities.remove_city('a')
+        self.assertEqual(cities.names, ['b', 'c'])
+        self.assertEqual(cities.dist_matrix.shape, (2, 2))
+
+    def test_pair_index_save_load(self):
+        path = os.path.join(self.out_folder, 'israel_pairs')
+        israel.pair_index.save(path)
+        loaded = CityVector.from_pair_index(PairIndex.load(path))
+        self.assertEqual(loaded.names, israel.names)
+        self.assertIsInstance(loaded.pair_index.azimuths, np.memmap)
+        np.testing.assert_array_equal(loaded.pair_index.azimuths, israel.pair_index.azimuths)
+        np.testing.assert_array_equal(loaded.pair_index.sorted_distances, israel.pair_index.sorted_distances)
+        self.assertTrue(np.all(np.diff(loaded.pair_index.azimuths) >= 0))
+
+        start, stop = loaded.pair_index.azimuth_range(-5, 5)
+        expected = [pair for pair in itertools.permutations(israel, r=2) if -5 <= israel.azimuth(*pair) <= 5]
+        self.assertEqual(stop - start, len(expected))
+
+    def test_match_hough_rotated(self):
+        random.seed(0)
+        reference = israel.add_outliers(3)
+        for degrees in [30, -150]:
+            angle = np.deg2rad(degrees)
+            rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            pixels = (israel.coords - israel.coords.mean(axis=0)) @ rotation.T * 1000 + 2000
+            detected = CityVector({city: tuple(pix) for city, pix in zip(israel.names, pixels.tolist())})
+
+            config = default_match_config()
+            self.assertIsNone(find_gcps(detected, reference, config))  # outside of threshold_azimuth
+            config['consensus'] = 'hough'
+            config['affine_estimator'] = 'lmeds'
+            for engine in ['python', 'vectorized']:
+                config['engine'] = engine
+                gcps = find_gcps(detected, reference, config)
+                self.assertEqual(len(gcps), len(israel))
+                affine, residuals, inliers = fit_gcps(gcps, config)
+                self.assertLess(np.max(residuals), 1000)  # [m], pixels are linear in lon,lat, not in utm
+
+    def test_match_geometric_hashing(self):
+        # sheet of large reference - detection includes most cities of a window, and a few false ones:
+        reference = synthetic.random_cities(3000, bounds=(0, 50, 0, 50), seed=2)
+        coords = reference.coords
+        sheet = reference.subset(np.flatnonzero((20 < coords[:, 0]) & (coords[:, 0] < 23) &
+                                                (30 < coords[:, 1]) & (coords[:, 1] < 33)))
+        detected = synthetic.detected_cities(sheet, rotation=70, scale=1000, noise=1, subset=int(len(sheet) * .85),
+                                             seed=1)
+        detected = synthetic.with_outliers(detected, 3, seed=1)
+        config = default_match_config()
+        config['engine'] = 'geometric_hashing'
+        debug = DebugSink()
+        city_matches = geometric_hashing.find_city_matches(detected, reference, config, debug)
+        self.assertEqual(city_matches, {city: city for city in detected.names if city in sheet.names})
+        self.assertIs(reference.triangle_index(config['hash_neighbours'], config['hash_bin']),
+                      reference.triangle_index(config['hash_neighbours'], config['hash_bin']))
+        self.assertEqual(debug.events[0]['event'], 'hash_votes')
+
+        config['affine_estimator'] = 'lmeds'
+        gcps = find_gcps(detected, reference, config)
+        self.assertGreater(len(gcps), len(sheet) / 2)
+        self.assertTrue(all((gcp.lon, gcp.lat) in sheet.cities.values() for gcp in gcps))
+
+    def test_match_similarity_search(self):
+        reference = israel.add_outliers(500, bounds=(34, 36, 29, 33), rng=random.Random(0))  # dense, same area
+        angle = np.deg2rad(70)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        pixels = (israel.coords - israel.coords.mean(axis=0)) @ rotation.T * 1000 + 2000
+        detected = CityVector({city: tuple(pix) for city, pix in zip(israel.names, pixels.tolist())})
+
+        config = default_match_config()
+        config['engine'] = 'similarity_search'
+        config['affine_estimator'] = 'lmeds'
+        with self.assertRaises(ValueError):
+            find_gcps(detected, reference, config)
+        config['scale_range'] = (700, 1400)
+        gcps = find_gcps(detected, reference, config)
+        self.assertEqual(len(gcps), len(israel))
+        self.assertTrue(all((gcp.lon, gcp.lat) in israel.cities.values() for gcp in gcps))
+        affine, residuals, inliers = fit_gcps(gcps, config)
+        self.assertLess(np.median(residuals), 1000)
+
+        # sparse detection (e.g. major cities only) of dense reference, basis cities aren't neighbours:
+        config['similarity_min_inliers'] = 6
+        for size in [30, 1000]:
+            reference = synthetic.random_cities(size, seed=1)
+            detected = synthetic.detected_cities(reference, rotation=37, noise=1, subset=11, seed=1)
+            city_matches = similarity_search.find_city_matches(detected, reference, config, NULL_SINK)
+            self.assertEqual(city_matches, {city: city for city in detected.names})
+
+    def test_scale_prior_pruning(self):
+        reference = synthetic.random_cities(40, seed=1)
+        detected = synthetic.detected_cities(reference, rotation=1, scale=1000, subset=11, seed=1)
+        scale_range = (800, 1250)
+        python = _potential_matches_python(detected, reference, 5, scale_range=scale_range)
+        vectorized = _potential_matches_vectorized(detected, reference, 5, scale_range=scale_range)
+        for a, b in zip(python, vectorized):
+            np.testing.assert_allclose(a, b)
+        unpruned = _potential_matches_vectorized(detected, reference, 5)
+        self.assertLess(len(vectorized[2]) * 3, len(unpruned[2]))
+
+        reference = synthetic.random_cities(20, seed=1)
+        detected = synthetic.detected_cities(reference, rotation=1, scale=1000, subset=11, seed=1)
+        config = default_match_config()
+        config['threshold_azimuth'] = 2
+        self.assertLess(len(_find_city_matches(detected, reference, config, NULL_SINK)), 3)
+        config['scale_range'] = (900, 1100)
+        city_matches = _find_city_matches(detected, reference, config, NULL_SINK)
+        self.assertEqual(city_matches, {city: city for city in detected.names})
+        self.assertEqual(scale_range_from_gsd(1, 2, meters_per_unit=1000), (500, 1000))
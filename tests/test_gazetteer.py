@@ -0,0 +1,52 @@
+import os
+import unittest
+
+import numpy as np
+
+from cityfinder import gazetteer, synthetic
+from cityfinder.city_vector import CityVector, israel, match
+from cityfinder.debug import DebugSink
+from cityfinder.geo import utm_zone, utm_crs
+
+
+class TestGazetteer(unittest.TestCase):
+    out_folder = 'out'
+
+    def test_utm_zone(self):
+        self.assertEqual(utm_zone(34.78, 32.08), (36, True))  # tlv
+        self.assertEqual(utm_zone(2.35, 48.86), (31, True))  # paris
+        self.assertEqual(utm_zone(-58.38, -34.6), (21, False))  # buenos aires
+        self.assertEqual(utm_crs(21, False), {'init': 'EPSG:32721'})
+
+    def test_israel(self):
+        region = gazetteer.get('israel')
+        self.assertIs(israel, region.cities)
+        self.assertEqual(region.crs, {'init': 'EPSG:32636'})
+        self.assertIs(region.projected, region.projected)
+        self.assertEqual(len(israel), 11)
+
+    def test_candidates(self):
+        os.makedirs(self.out_folder, exist_ok=True)
+        path = os.path.join(self.out_folder, 'gazetteer_pampas.csv')
+        cities = synthetic.random_cities(15, bounds=(-59, -55, -36, -33), seed=0)
+        with open(path, 'w') as f:
+            f.write('name,lon,lat\n')
+            f.writelines('%s,%f,%f\n' % (name, lon, lat) for name, (lon, lat) in cities.cities.items())
+        pampas = gazetteer.register('pampas', path)
+        try:
+            self.assertEqual(pampas.zone, (21, False))
+            self.assertEqual([g.name for g in gazetteer.candidates((35, 32))], ['israel'])
+            self.assertEqual([g.name for g in gazetteer.candidates((-60, -40, -50, -30))], ['pampas'])
+            self.assertEqual(len(gazetteer.candidates()), 2)
+
+            detected = CityVector({city: (1000 * (x + 59), 1000 * (y + 36))
+                                   for city, (x, y) in pampas.cities.cities.items()})
+            debug = DebugSink()
+            aff, crs = match(detected, pampas.cities, debug=debug)
+            self.assertEqual(crs, {'init': 'EPSG:32721'})
+            city_matches = [event['city_matches'] for event in debug.events if event['event'] == 'final_matches'][-1]
+            self.assertGreaterEqual(len(city_matches), 3)
+            self.assertEqual(city_matches, {city: city for city in city_matches})
+            self.assertGreater(np.abs(aff.determinant), 0)
+        finally:
+            del gazetteer._registry['pampas']
@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+import shapely.geometry
+from affine import Affine
+
+from cityfinder.gcp import GCP
+from cityfinder.geo import get_transformer, transform, transform_points, p_geographic, p_utm, GEOGRAPHIC, UTM, \
+    fit_affine_robust, affine_residuals
+
+
+class TestGeo(unittest.TestCase):
+    def test_transformer_cached(self):
+        self.assertIs(get_transformer(GEOGRAPHIC, UTM), get_transformer({'init': 'EPSG:4326'}, {'init': 'EPSG:32636'}))
+        self.assertIs(get_transformer(p_geographic, p_utm), get_transformer(p_geographic, p_utm))
+
+    def test_transform_points(self):
+        lons, lats = np.array([34.777303, 35.207415, 35.570337]), np.array([32.076025, 31.768136, 33.210001])
+        xs, ys = transform_points(lons, lats, p_geographic, p_utm)
+        for lon, lat, x, y in zip(lons, lats, xs, ys):
+            pt = transform(shapely.geometry.Point(lon, lat), p_geographic, p_utm)
+            self.assertAlmostEqual(pt.x, x)
+            self.assertAlmostEqual(pt.y, y)
+
+        xs_back, ys_back = transform_points(xs, ys, UTM, GEOGRAPHIC)
+        np.testing.assert_allclose(xs_back, lons)
+        np.testing.assert_allclose(ys_back, lats)
+
+    def test_fit_affine_robust(self):
+        rng = np.random.RandomState(0)
+        truth = Affine(20, 2, 650000, 1, -20, 3600000)  # pixel -> utm
+        pixels = rng.uniform(0, 4000, size=(12, 2))
+        lons, lats = transform_points(*zip(*[truth * (x, y) for x, y in pixels]), p_utm, p_geographic)
+        gcps = [GCP(lon, lat, None, '', x, y) for lon, lat, (x, y) in zip(lons, lats, pixels)]
+        for idx in [2, 7]:  # outliers, ~50km off
+            gcps[idx] = gcps[idx].copy_with(lon=gcps[idx].lon + 0.5)
+
+        for method, threshold, max_iterations in [('lmeds', None, 2000), ('ransac', 100, 2000), ('ransac', 100, 100)]:
+            affine, residuals, inliers = fit_affine_robust(gcps, p_utm, method=method, threshold=threshold,
+                                                           max_iterations=max_iterations, batch=20, seed=0)
+            self.assertEqual(np.nonzero(~inliers)[0].tolist(), [2, 7])
+            self.assertLess(np.max(residuals[inliers]), 1e-3)
+            self.assertGreater(np.min(residuals[~inliers]), 1e4)
+            np.testing.assert_allclose(residuals, affine_residuals(affine, gcps, p_utm), atol=1e-6)
+
+        # exactly representable gcps give zero robust sigma, outliers must still be rejected:
+        pixels = [(0, 0), (1024, 0), (0, 1024), (1024, 1024), (512, 2048), (2048, 512)]
+        gcps = [GCP(34 + x / 1024, 32 - y / 1024, None, '', x, y) for x, y in pixels]
+        for idx in [4, 5]:
+            gcps[idx] = gcps[idx].copy_with(lon=gcps[idx].lon + 0.3)
+        affine, residuals, inliers = fit_affine_robust(gcps, method='lmeds', seed=0)
+        self.assertEqual(np.nonzero(~inliers)[0].tolist(), [4, 5])
+        self.assertLess(np.max(residuals[inliers]), 1e-6)
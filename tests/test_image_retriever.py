@@ -1,7 +1,9 @@
 import unittest
 import os
 
-from cityfinder.image_retriever import ImageComposer
+import numpy as np
+
+from cityfinder.image_retriever import ImageComposer, VirtualMosaic
 
 
 class TestImageRetriever(unittest.TestCase):
@@ -16,3 +18,29 @@ class TestImageRetriever(unittest.TestCase):
         os.makedirs(os.path.join(self.out_folder, id), exist_ok=True)
         out_path = os.path.join(self.out_folder, id, '%s_composed.png' % id)
         img.save(out_path)
+
+    def test_compose_to_file(self):
+        id = 'tulkarm'
+        composer = ImageComposer(folder=self.base_folder, extension='jpg')
+        expected = np.asarray(composer.compose(id))
+        os.makedirs(os.path.join(self.out_folder, id), exist_ok=True)
+        out_path = os.path.join(self.out_folder, id, '%s_composed.npy' % id)
+        composer.compose_to_file(id, out_path)
+        np.testing.assert_array_equal(np.load(out_path, mmap_mode='r'), expected)
+
+    def test_virtual_mosaic_read(self):
+        id = 'tulkarm'
+        composer = ImageComposer(folder=self.base_folder, extension='jpg')
+        expected = np.asarray(composer.compose(id))
+        mosaic = VirtualMosaic(composer, id)
+        self.assertEqual(mosaic.shape, expected.shape)
+        np.testing.assert_array_equal(mosaic.read(150, 120, 300, 200), expected[120: 320, 150: 450])
+        np.testing.assert_array_equal(mosaic.read(500, 350, 200, 100)[:50, :100], expected[350:, 500:])
+
+    def test_compose_parallel(self):
+        id = 'tulkarm'
+        composer = ImageComposer(folder=self.base_folder, extension='jpg')
+        serial = np.asarray(composer.compose(id, workers=1))
+        self.assertEqual(serial.shape, (400, 600, 3))
+        np.testing.assert_array_equal(np.asarray(composer.compose(id, workers=4)), serial)
+        np.testing.assert_array_equal(np.asarray(composer.compose(id, workers=2, processes=True)), serial)
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import unittest
+
+import cv2
+import numpy as np
+
+from cityfinder.cache import hash_file
+from cityfinder.ingest import prefetch_images, aprefetch_images, read_image_hashed
+
+
+class TestIngest(unittest.TestCase):
+    out_folder = 'out/ingest'
+
+    def _paths(self, number):
+        os.makedirs(self.out_folder, exist_ok=True)
+        paths = []
+        for idx in range(number):
+            path = os.path.join(self.out_folder, '%d.png' % idx)
+            cv2.imwrite(path, np.full((20, 30, 3), idx, np.uint8))
+            paths.append(path)
+        return paths
+
+    def test_prefetch_bounded(self):
+        paths = self._paths(10)
+        consumed = []
+
+        def lazy_paths():
+            for path in paths[:5] + ['missing.png'] + paths[5:]:
+                consumed.append(path)
+                yield path
+
+        for idx, (path, img, error) in enumerate(prefetch_images(lazy_paths(), prefetch=3)):
+            self.assertLessEqual(len(consumed), idx + 4)  # current one and 3 ahead
+            if path == 'missing.png':
+                self.assertIsNone(img)
+                self.assertIsInstance(error, IOError)
+            else:
+                self.assertIsNone(error)
+                self.assertEqual(img.shape, (20, 30, 3))
+                self.assertEqual(img[0, 0, 0], int(os.path.basename(path)[:-4]))
+        self.assertEqual(len(consumed), 11)
+
+    def test_prefetch_hashed(self):
+        paths = self._paths(3) + ['missing.png']
+        results = list(prefetch_images(paths, prefetch=2, reader=read_image_hashed))
+        self.assertEqual([file_hash for path, img, error, file_hash in results[:3]], [hash_file(p) for p in paths[:3]])
+        self.assertEqual([img[0, 0, 0] for path, img, error, file_hash in results[:3]], list(range(3)))
+        path, img, error, file_hash = results[3]
+        self.assertIsNone(file_hash)
+        self.assertIn('failed to read image', str(error))
+
+    def test_aprefetch(self):
+        paths = self._paths(5)
+
+        async def read_all():
+            return [(path, img) async for path, img, error in aprefetch_images(paths, prefetch=2)]
+        results = asyncio.run(read_all())
+        self.assertEqual([path for path, img in results], paths)
+        self.assertEqual([img[0, 0, 0] for path, img in results], list(range(5)))
@@ -0,0 +1,50 @@
+import random
+import unittest
+
+import numpy as np
+
+from cityfinder.city_vector import CityVector, israel, match
+from cityfinder.instrumentation import BatchStats, Profiler, NULL_PROFILER
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_nested_stages_memory(self):
+        profiler = Profiler(memory=True)
+        with profiler.stage('outer'):
+            with profiler.stage('inner'):
+                big = np.ones(10 ** 6)  # 8 MB
+            del big
+        profiler.close()
+        report = profiler.report
+        self.assertEqual([stage.name for stage in report.stages], ['outer/inner', 'outer'])
+        self.assertGreaterEqual(report['outer/inner'].peak_bytes, 8 * 10 ** 6)
+        self.assertGreaterEqual(report['outer'].peak_bytes, report['outer/inner'].peak_bytes)
+        self.assertGreaterEqual(report['outer'].wall, report['outer/inner'].wall)
+
+    def test_match_stages(self):
+        random.seed(0)
+        detected = CityVector({city: (1000 * (x - 34), 1000 * (y - 31)) for city, (x, y) in israel.cities.items()})
+        profiler = Profiler()
+        match(detected, israel.add_outliers(5), profiler=profiler)
+        for name in ['find_gcps/potential_matches', 'find_gcps/consensus', 'find_gcps', 'fit_gcps']:
+            self.assertIn(name, profiler.report)
+        self.assertIsNone(profiler.report['fit_gcps'].peak_bytes)
+
+        with NULL_PROFILER.stage('anything'):
+            pass
+        self.assertEqual(len(NULL_PROFILER.report.stages), 0)
+
+    def test_batch_stats(self):
+        stats = BatchStats()
+        for wall in range(1, 101):
+            profiler = Profiler()
+            with profiler.stage('stage'):
+                pass
+            profiler.report.stages[0].wall = wall
+            stats.add(profiler.report.to_dict() if wall % 2 else profiler.report)
+        summary = stats.summary()['stage']
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['wall']['p50'], 50.5)
+        self.assertAlmostEqual(summary['wall']['p95'], 95.05)
+        self.assertNotIn('peak_bytes', summary)
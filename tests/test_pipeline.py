@@ -0,0 +1,67 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from cityfinder.cache import ResultCache
+from cityfinder.city_detector import CityDetector
+from cityfinder.city_vector import israel
+from cityfinder.pipeline import georeference_sheet, list_sheets, run_batch
+
+
+class TwoCitiesDetector(CityDetector):
+    calls = 0
+
+    def find_pink_blob(self, path, **kwargs):
+        self.calls += 1
+        return {'a': (0., 0.), 'b': (100., 0.)}
+
+
+class TestPipeline(unittest.TestCase):
+    in_folder = 'data/city'
+    out_folder = 'out/pipeline'
+
+    def test_list_sheets(self):
+        self.assertEqual(list_sheets(self.in_folder), [os.path.join(self.in_folder, 'tulkarm.png')])
+
+    def test_failures_dont_stop_batch(self):
+        os.makedirs(self.out_folder, exist_ok=True)
+        manifest = os.path.join(self.out_folder, 'manifest.txt')
+        with open(manifest, 'w') as f:
+            f.write('# sheets\n%s\n\nmissing.png\n' % os.path.join(self.in_folder, 'tulkarm.png'))
+
+        out_path = os.path.join(self.out_folder, 'results.jsonl')
+        succeeded, failed = run_batch(manifest, out_path, processes=2)
+        with open(out_path) as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual(succeeded + failed, 2)
+        self.assertEqual(sorted(r['path'] for r in results), sorted(list_sheets(manifest)))
+        self.assertIn('error', [r for r in results if r['path'] == 'missing.png'][0])
+
+    def test_stream_in_process(self):
+        os.makedirs(self.out_folder, exist_ok=True)
+        out_path = os.path.join(self.out_folder, 'results_stream.jsonl')
+        paths = [os.path.join(self.in_folder, 'tulkarm.png'), 'missing.png']
+        succeeded, failed = run_batch(paths, out_path, processes=1, prefetch=1)
+        with open(out_path) as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual([r['path'] for r in results], paths)  # in order
+        self.assertIn('failed to read image', results[1]['error'])
+
+    def test_cached_failure(self):
+        cache = ResultCache(os.path.join(self.out_folder, 'cache'))
+        cache.clear()
+        detector = TwoCitiesDetector()
+        for idx in range(2):
+            with self.assertRaises(ValueError):  # file_hash given - missing path isn't read
+                georeference_sheet('missing.png', detector, israel, cache=cache, file_hash='0' * 64)
+        self.assertEqual(detector.calls, 1)
+        self.assertEqual(cache.hits, 2)  # detection and failed matching
+
+    def test_lazy_imports(self):
+        code = ('import sys, cityfinder.pipeline; from cityfinder.city_detector import CityDetector; '
+                'CityDetector(); print(sorted(m for m in ["cv2", "pyproj", "shapely", "PIL"] if m in sys.modules))')
+        out = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+        self.assertEqual(out.strip(), '[]')
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+from cityfinder import synthetic
+from cityfinder.city_vector import default_match_config, find_gcps
+from cityfinder.debug import DebugSink
+from cityfinder.spatial_index import GridIndex
+
+
+class TestSpatialIndex(unittest.TestCase):
+    def test_grid_within(self):
+        rng = np.random.default_rng(0)
+        coords, points = rng.uniform(0, 10, (300, 2)), rng.uniform(-2, 12, (200, 2))
+        distances = np.linalg.norm(points[:, np.newaxis] - coords[np.newaxis], axis=2)
+        for cell_size, max_radius in [(0.1, 0.05), (1, 1), (1, 2.5)]:
+            grid = GridIndex(coords, cell_size)
+            radius = rng.uniform(0, max_radius, len(points))
+            rows, indices, found = grid.within(points, radius)
+            expected = np.argwhere(distances <= radius[:, np.newaxis])
+            np.testing.assert_array_equal(np.array(sorted(zip(rows, indices))).reshape(-1, 2), expected)
+            np.testing.assert_allclose(found, distances[rows, indices])
+            nearest, nearest_distances = grid.nearest(points, radius)
+            for row in range(len(points)):
+                if nearest[row] < 0:
+                    self.assertFalse(np.any(distances[row] <= radius[row]))
+                else:
+                    self.assertEqual(nearest_distances[row], np.min(distances[row]))
+
+    def test_reference_windows(self):
+        reference = synthetic.random_cities(3000, bounds=(0, 50, 0, 50), seed=2)
+        coords = reference.coords
+        grid = GridIndex(coords, 1.5)
+        for bounds in [(10, 13.3, 20, 21), (-5, 2, 48, 60), (50, 60, 0, 50), (7, 7, 7, 7)]:
+            expected = np.flatnonzero((bounds[0] <= coords[:, 0]) & (coords[:, 0] <= bounds[1]) &
+                                      (bounds[2] <= coords[:, 1]) & (coords[:, 1] <= bounds[3]))
+            np.testing.assert_array_equal(grid.query(bounds), expected)
+
+        sheet = np.flatnonzero((20 < coords[:, 0]) & (coords[:, 0] < 23) & (30 < coords[:, 1]) & (coords[:, 1] < 33))
+        sheet = reference.subset(sheet)
+        detected = synthetic.detected_cities(sheet, scale=1000, seed=1)
+        config = default_match_config()
+        config['threshold_azimuth'] = 1
+        config['scale_range'] = (950, 1050)
+        config['windows'] = True
+        debug = DebugSink()
+        gcps = find_gcps(detected, reference, config, debug)
+        self.assertEqual(len(gcps), 5)  # lstsq uses first 5
+        self.assertTrue(all((gcp.lon, gcp.lat) in sheet.cities.values() for gcp in gcps))
+        windows = [event for event in debug.events if event['event'] == 'reference_window']
+        self.assertTrue(windows[-1]['success'])
+        self.assertLess(windows[-1]['cities'], len(reference) / 20)
@@ -0,0 +1,33 @@
+import os
+import unittest
+
+import numpy as np
+
+from cityfinder import synthetic
+from cityfinder.city_detector import CityDetector
+from cityfinder.image_retriever import ImageComposer
+
+
+class TestSynthetic(unittest.TestCase):
+    out_folder = 'out/synthetic'
+
+    def test_pink_blob_raster_detected(self):
+        img, discs = synthetic.pink_blob_raster(2000, 1500, blobs=8, seed=1)
+        self.assertEqual(len(discs), 8)
+        path = synthetic.write_raster(img, os.path.join(self.out_folder, 'pink.png'))
+        self.assertEqual(len(CityDetector().find_pink_blob(path)), 8)
+
+    def test_write_tiles_compose(self):
+        img, discs = synthetic.pink_blob_raster(600, 500, blobs=3, seed=2)
+        self.assertEqual(synthetic.write_tiles(img, self.out_folder, 'tiles', tilesize=256), 6)
+        composed = np.asarray(ImageComposer(self.out_folder, extension='png').compose('tiles'))
+        np.testing.assert_array_equal(composed[:500, :600], img[:, :, ::-1])
+
+    def test_detected_cities(self):
+        cities = synthetic.random_cities(50, seed=3)
+        detected = synthetic.detected_cities(cities, rotation=90, scale=10, offset=(0, 0), subset=11, seed=3)
+        self.assertEqual(len(detected), 11)
+        self.assertEqual(len(synthetic.with_outliers(cities, 7)), 57)
+        a, b = detected.names[:2]
+        self.assertAlmostEqual(detected.dist(a, b), 10 * cities.dist(a, b))
+        self.assertAlmostEqual((detected.azimuth(a, b) - cities.azimuth(a, b)) % 360, 90)